@@ -23,6 +23,8 @@ Requirements:
 
 Usage:
     $ python utils/benchmarks.py --weights yolov5s.pt --img 640
+    $ python benchmarks.py --weights YOLOFlower.pt --data data/Flower.yaml --device cpu --sliced  # sliced frames/s
+    $ python benchmarks.py --weights YOLOFlower.pt --data data/Flower.yaml --device cpu --int8  # INT8 exports
 """
 
 import argparse
@@ -44,7 +46,8 @@ from models.experimental import attempt_load
 from models.yolo import SegmentationModel
 from segment.val import run as val_seg
 from utils import notebook_init
-from utils.general import LOGGER, check_yaml, file_size, print_args
+from utils.general import LOGGER, check_dataset, check_yaml, file_size, print_args
+from utils.sliced import create_sliced_dataloader
 from utils.torch_utils import select_device
 from val import run as val_det
 
@@ -56,13 +59,23 @@ def run(
         data=ROOT / 'data/coco128.yaml',  # dataset.yaml path
         device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
         half=False,  # use FP16 half-precision inference
+        int8=False,  # CoreML/TF/ONNX INT8 quantization, calibrated on the --data train images
         test=False,  # test exports only
         pt_only=False,  # test PyTorch only
         hard_fail=False,  # throw error on benchmark failure
+        sliced=False,  # benchmark sliced inference on full val frames, or on this frames directory
+        overlap=0.1,  # sliced tile overlap ratio
 ):
     y, t = [], time.time()
     device = select_device(device)
     model_type = type(attempt_load(weights, fuse=False))  # DetectionModel, SegmentationModel, etc.
+    if sliced:  # static exports with the tiles of the largest frame per batch
+        _, dataset = create_sliced_dataloader(sliced if isinstance(sliced, str) else check_dataset(data)['val'],
+                                              imgsz,
+                                              batch_size,
+                                              overlap=overlap,
+                                              workers=0)
+        batch_size = int(dataset.tile_counts.max())
     for i, (name, f, suffix, cpu, gpu) in export.export_formats().iterrows():  # index, (name, file, suffix, CPU, GPU)
         try:
             assert i not in (9, 10), 'inference not supported'  # Edge TPU and TF.js are unsupported
@@ -76,7 +89,14 @@ def run(
             if f == '-':
                 w = weights  # PyTorch format
             else:
-                w = export.run(weights=weights, imgsz=[imgsz], include=[f], device=device, half=half)[-1]  # all others
+                w = export.run(data=data,
+                               weights=weights,
+                               imgsz=[imgsz],
+                               batch_size=batch_size if sliced else 1,
+                               include=[f],
+                               device=device,
+                               half=half,
+                               int8=int8)[-1]  # all others
             assert suffix in str(w), 'export failed'
 
             # Validate
@@ -84,15 +104,26 @@ def run(
                 result = val_seg(data, w, batch_size, imgsz, plots=False, device=device, task='speed', half=half)
                 metric = result[0][7]  # (box(p, r, map50, map), mask(p, r, map50, map), *loss(box, obj, cls))
             else:  # DetectionModel:
-                result = val_det(data, w, batch_size, imgsz, plots=False, device=device, task='speed', half=half)
+                result = val_det(data,
+                                 w,
+                                 batch_size,
+                                 imgsz,
+                                 plots=False,
+                                 device=device,
+                                 task='speed',
+                                 half=half,
+                                 sliced=sliced,
+                                 overlap=overlap)
                 metric = result[0][3]  # (p, r, map50, map, *loss(box, obj, cls))
-            speed = result[2][1]  # times (preprocess, inference, postprocess)
+            speed = result[2][1]  # times (preprocess, inference, postprocess), per frame if sliced
             y.append([name, round(file_size(w), 1), round(metric, 4), round(speed, 2)])  # MB, mAP, t_inference
+            if sliced:
+                y[-1].append(round(1E3 / sum(result[2]), 2))  # frames/s
         except Exception as e:
             if hard_fail:
                 assert type(e) is AssertionError, f'Benchmark --hard-fail for {name}: {e}'
             LOGGER.warning(f'WARNING ⚠️ Benchmark failure for {name}: {e}')
-            y.append([name, None, None, None])  # mAP, t_inference
+            y.append([name, None, None, None] + [None] * bool(sliced))  # mAP, t_inference
         if pt_only and i == 0:
             break  # break after PyTorch
 
@@ -101,6 +132,9 @@ def run(
     parse_opt()
     notebook_init()  # print system info
     c = ['Format', 'Size (MB)', 'mAP50-95', 'Inference time (ms)'] if map else ['Format', 'Export', '', '']
+    if sliced:
+        c[3] = f'Inference time per frame (ms, {batch_size} tiles)'
+        c.append('Frames/s')
     py = pd.DataFrame(y, columns=c)
     LOGGER.info(f'\nBenchmarks complete ({time.time() - t:.2f}s)')
     LOGGER.info(str(py if map else py.iloc[:, :2]))
@@ -118,9 +152,12 @@ def test(
         data=ROOT / 'data/coco128.yaml',  # dataset.yaml path
         device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
         half=False,  # use FP16 half-precision inference
+        int8=False,  # unused, benchmark option
         test=False,  # test exports only
         pt_only=False,  # test PyTorch only
         hard_fail=False,  # throw error on benchmark failure
+        sliced=False,  # unused, benchmark option
+        overlap=0.1,  # unused, benchmark option
 ):
     y, t = [], time.time()
     device = select_device(device)
@@ -151,9 +188,12 @@ def parse_opt():
     parser.add_argument('--data', type=str, default=ROOT / 'data/coco128.yaml', help='dataset.yaml path')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
+    parser.add_argument('--int8', action='store_true', help='CoreML/TF/ONNX INT8 quantization')
     parser.add_argument('--test', action='store_true', help='test exports only')
     parser.add_argument('--pt-only', action='store_true', help='test PyTorch only')
     parser.add_argument('--hard-fail', nargs='?', const=True, default=False, help='Exception on error or < min metric')
+    parser.add_argument('--sliced', nargs='?', const=True, default=False, help='sliced inference on full frames dir')
+    parser.add_argument('--overlap', type=float, default=0.1, help='sliced tile overlap ratio')
     opt = parser.parse_args()
     opt.data = check_yaml(opt.data)  # check YAML
     print_args(vars(opt))
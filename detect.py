@@ -23,12 +23,17 @@ Usage - formats:
                                  yolov5s.tflite             # TensorFlow Lite
                                  yolov5s_edgetpu.tflite     # TensorFlow Edge TPU
                                  yolov5s_paddle_model       # PaddlePaddle
+
+Usage - batched directories:
+    $ python detect.py --weights yolov5s.pt --source path/ --batch-size 16 --workers 8 --save-txt --nosave
 """
 
 import argparse
 import os
 import platform
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import torch
@@ -40,13 +45,37 @@ if str(ROOT) not in sys.path:
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 from models.common import DetectMultiBackend
-from utils.dataloaders import IMG_FORMATS, VID_FORMATS, LoadImages, LoadScreenshots, LoadStreams
+from utils.dataloaders import (IMG_FORMATS, VID_FORMATS, LoadImages, LoadScreenshots, LoadStreams,
+                               create_image_dataloader)
 from utils.general import (LOGGER, Profile, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
                            increment_path, non_max_suppression, print_args, scale_boxes, strip_optimizer, xyxy2xywh)
 from utils.plots import Annotator, colors, save_one_box
 from utils.torch_utils import select_device, smart_inference_mode
 
 
+def save_one_result(det, im0, p, save_dir, names, save_img=True, save_txt=False, save_conf=False, save_crop=False,
+                    line_thickness=3, hide_labels=False, hide_conf=False):
+    # Save the label file, crops and annotated image of one image's detections (n,6) in im0 pixels, thread-safe
+    p = Path(p)
+    if save_txt and len(det):
+        gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
+        xywh = xyxy2xywh(det[:, :4]) / gn  # normalized xywh
+        lines = torch.cat((det[:, 5:6], xywh, det[:, 4:5]) if save_conf else (det[:, 5:6], xywh), 1)
+        with open(save_dir / 'labels' / f'{p.stem}.txt', 'a') as f:
+            f.writelines(('%g ' * lines.shape[1]).rstrip() % tuple(x) + '\n' for x in lines.flip(0).tolist())
+    if save_img or save_crop:
+        imc = im0.copy() if save_crop else im0  # for save_crop
+        annotator = Annotator(im0, line_width=line_thickness, example=str(names))
+        for *xyxy, conf, cls in reversed(det.tolist()):
+            c = int(cls)  # integer class
+            label = None if hide_labels else (names[c] if hide_conf else f'{names[c]} {conf:.2f}')
+            annotator.box_label(xyxy, label, color=colors(c, True))
+            if save_crop:
+                save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
+        if save_img:
+            cv2.imwrite(str(save_dir / p.name), annotator.result())
+
+
 @smart_inference_mode()
 def run(
         weights=ROOT / 'yolov5s.pt',  # model path or triton URL
@@ -76,6 +105,8 @@ def run(
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
         vid_stride=1,  # video frame-rate stride
+        batch_size=1,  # batch size of image and directory sources
+        workers=8,  # max dataloader workers of batched sources
 ):
     source = str(source)
     save_img = not nosave and not source.endswith('.txt')  # save inference images
@@ -98,7 +129,11 @@ def run(
 
     # Dataloader
     bs = 1  # batch_size
-    if webcam:
+    batched = batch_size > 1 and not (webcam or screenshot)
+    if batched:
+        dataset, _ = create_image_dataloader(source, imgsz, batch_size, stride, workers)
+        bs = dataset.batch_size
+    elif webcam:
         view_img = check_imshow(warn=True)
         dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
         bs = len(dataset)
@@ -109,9 +144,38 @@ def run(
     vid_path, vid_writer = [None] * bs, [None] * bs
 
     # Run inference
-    model.warmup(imgsz=(1 if pt or model.triton else bs, 3, *imgsz))  # warmup
+    model.warmup(imgsz=(1 if (pt or model.triton) and not batched else bs, 3, *imgsz))  # warmup
     seen, windows, dt = 0, [], (Profile(), Profile(), Profile())
-    for path, im, im0s, vid_cap, s in dataset:
+    if batched:  # decode in dataloader workers, write in threads, keep the model busy
+        writer, pending = ThreadPoolExecutor(min(os.cpu_count(), 4)), deque()
+        for im, im0s, paths, ss in dataset:
+            with dt[0]:
+                im = im.to(model.device, non_blocking=True)
+                im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
+                im /= 255  # 0 - 255 to 0.0 - 1.0
+            with dt[1]:
+                pred = model(im, augment=augment)
+            with dt[2]:
+                pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
+
+            s = []
+            for det, im0, p, si in zip(pred, im0s, paths, ss):
+                seen += 1
+                det = det.cpu()
+                det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()
+                n = det[:, 5].int().bincount(minlength=len(names)).tolist()  # detections per class
+                counts = ''.join(f"{k} {names[c]}{'s' * (k > 1)}, " for c, k in enumerate(n) if k)
+                s.append(f"{si}{'%gx%g ' % im.shape[2:]}{counts or '(no detections), '}")
+                if save_img or save_txt or save_crop:
+                    pending.append(writer.submit(save_one_result, det, im0, p, save_dir, names, save_img, save_txt,
+                                                 save_conf, save_crop, line_thickness, hide_labels, hide_conf))
+            while len(pending) > 2 * bs or (pending and pending[0].done()):
+                pending.popleft().result()  # bound memory, raise writer errors
+            LOGGER.info('\n'.join(s) + f'{dt[1].dt * 1E3:.1f}ms')
+        for f in pending:
+            f.result()
+        writer.shutdown()
+    for path, im, im0s, vid_cap, s in dataset if not batched else ():
         with dt[0]:
             im = torch.from_numpy(im).to(model.device)
             im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
@@ -205,7 +269,7 @@ def run(
 
     # Print results
     t = tuple(x.t / seen * 1E3 for x in dt)  # speeds per image
-    LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {(1, 3, *imgsz)}' % t)
+    LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {(bs, 3, *imgsz)}' % t)
     if save_txt or save_img:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
         LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
@@ -242,6 +306,8 @@ def parse_opt():
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
     parser.add_argument('--vid-stride', type=int, default=1, help='video frame-rate stride')
+    parser.add_argument('--batch-size', type=int, default=1, help='batch size of image and directory sources')
+    parser.add_argument('--workers', type=int, default=8, help='max dataloader workers of batched sources')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     print_args(vars(opt))
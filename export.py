@@ -23,6 +23,7 @@ Requirements:
 
 Usage:
     $ python export.py --weights yolov5s.pt --include torchscript onnx openvino engine coreml tflite ...
+    $ python export.py --weights YOLOFlower.pt --include onnx --int8 --data data/Flower.yaml --batch-size 6  # ORT INT8
 
 Inference:
     $ python detect.py --weights yolov5s.pt                 # PyTorch
@@ -56,6 +57,7 @@ import time
 import warnings
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import torch
 from torch.utils.mobile_optimizer import optimize_for_mobile
@@ -69,7 +71,7 @@ if platform.system() != 'Windows':
 
 from models.experimental import attempt_load
 from models.yolo import ClassificationModel, Detect, DetectionModel, SegmentationModel
-from utils.dataloaders import LoadImages
+from utils.dataloaders import LoadImages, LoadImagesAndLabels
 from utils.general import (LOGGER, Profile, check_dataset, check_img_size, check_requirements, check_version,
                            check_yaml, colorstr, file_size, get_default_args, print_args, url2file, yaml_save)
 from utils.torch_utils import select_device, smart_inference_mode
@@ -185,6 +187,66 @@ def export_onnx(model, im, file, opset, dynamic, simplify, prefix=colorstr('ONNX
     return f, model_onnx
 
 
+@try_export
+def export_onnx_int8(file, data, ncalib=256, prefix=colorstr('ONNX INT8:')):
+    # YOLOv5 ONNX Runtime static INT8 quantization of the ONNX export, calibrated on a sample of the --data train images
+    check_requirements('onnxruntime')
+    import onnx
+    import onnxruntime
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType, quant_pre_process,
+                                          quantize_static)
+
+    LOGGER.info(f'\n{prefix} starting export with onnxruntime {onnxruntime.__version__}...')
+    f_onnx = file.with_suffix('.onnx')
+    f_pre = str(file).replace('.pt', '-int8-pre.onnx')  # shape inference and graph optimization before quantization
+    f = str(file).replace('.pt', '-int8.onnx')
+    quant_pre_process(str(f_onnx), f_pre)
+    model_onnx = onnx.load(f_pre)
+    b, _, h, w = (d.dim_value or 1 for d in model_onnx.graph.input[0].type.tensor_type.shape.dim)  # dynamic to 1
+    assert h == w, f'INT8 calibration requires a square --imgsz, not {h}x{w}'
+
+    # Keep Detect() box decoding in FP32, all nodes between the last convolutions and the outputs
+    producers, exclude = {o: n for n in model_onnx.graph.node for o in n.output}, set()
+    queue = [x.name for x in model_onnx.graph.output]
+    while queue:
+        node = producers.get(queue.pop())
+        if node is not None and node.op_type != 'Conv' and node.name not in exclude:
+            exclude.add(node.name)
+            queue.extend(node.input)
+
+    # Calibration batches, a random sample of whole export batches
+    dataset = LoadImagesAndLabels(check_dataset(check_yaml(data))['train'], img_size=h, batch_size=b, pad=0.0)
+    n = max(min(ncalib, len(dataset)) // b, 1)  # batches
+    i = np.random.default_rng(0).permutation(max(len(dataset), n * b))[:n * b] % len(dataset)
+    name = model_onnx.graph.input[0].name
+
+    class Reader(CalibrationDataReader):
+        # Yields {input name: (b,3,h,w) float32} calibration batches
+        def __init__(self):
+            self.batches = iter(np.array_split(i, n))
+
+        def get_next(self):
+            j = next(self.batches, None)
+            return None if j is None else {name: torch.stack([dataset[k][0] for k in j]).float().numpy() / 255}
+
+    quantize_static(f_pre,
+                    f,
+                    Reader(),
+                    quant_format=QuantFormat.QDQ,
+                    activation_type=QuantType.QUInt8,
+                    weight_type=QuantType.QInt8,
+                    per_channel=True,
+                    nodes_to_exclude=sorted(exclude))
+    os.remove(f_pre)
+
+    # Metadata
+    model_int8, meta = onnx.load(f), onnx.load(f_onnx, load_external_data=False).metadata_props
+    model_int8.metadata_props.extend(meta)
+    onnx.save(model_int8, f)
+    LOGGER.info(f'{prefix} calibrated on {n * b} images, {len(exclude)} Detect() output nodes kept in FP32')
+    return f, model_int8
+
+
 @try_export
 def export_openvino(file, metadata, half, prefix=colorstr('OpenVINO:')):
     # YOLOv5 OpenVINO export
@@ -499,7 +561,7 @@ def run(
         inplace=False,  # set YOLOv5 Detect() inplace=True
         keras=False,  # use Keras
         optimize=False,  # TorchScript: optimize for mobile
-        int8=False,  # CoreML/TF INT8 quantization
+        int8=False,  # CoreML/TF/ONNX INT8 quantization
         dynamic=False,  # ONNX/TF/TensorRT: dynamic axes
         simplify=False,  # ONNX: simplify model
         opset=12,  # ONNX: opset version
@@ -562,6 +624,8 @@ def run(
         f[1], _ = export_engine(model, im, file, half, dynamic, simplify, workspace, verbose)
     if onnx or xml:  # OpenVINO requires ONNX
         f[2], _ = export_onnx(model, im, file, opset, dynamic, simplify)
+        if onnx and int8 and f[2]:  # ONNX Runtime INT8
+            f[2], _ = export_onnx_int8(file, data)
     if xml:  # OpenVINO
         f[3], _ = export_openvino(file, metadata, half)
     if coreml:  # CoreML
@@ -620,7 +684,7 @@ def parse_opt():
     parser.add_argument('--inplace', action='store_true', help='set YOLOv5 Detect() inplace=True')
     parser.add_argument('--keras', action='store_true', help='TF: use Keras')
     parser.add_argument('--optimize', action='store_true', help='TorchScript: optimize for mobile')
-    parser.add_argument('--int8', action='store_true', help='CoreML/TF INT8 quantization')
+    parser.add_argument('--int8', action='store_true', help='CoreML/TF/ONNX INT8 quantization')
     parser.add_argument('--dynamic', action='store_true', help='ONNX/TF/TensorRT: dynamic axes')
     parser.add_argument('--simplify', action='store_true', help='ONNX: simplify model')
     parser.add_argument('--opset', type=int, default=12, help='ONNX: opset version')
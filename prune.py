@@ -0,0 +1,193 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Structured channel pruning of a trained YOLOv5 model, with optional fine-tuning
+
+The least salient Conv/C3/SPPF output channels of the whole model are removed (see utils/pruning.py) and the thinner
+model is saved as an ordinary checkpoint with its own yaml. Fine-tuning runs train.py on the pruned weights. Parameters,
+GFLOPs, CPU latency and val mAP are reported before pruning, after pruning and after fine-tuning.
+
+Usage:
+    $ python prune.py --weights YOLOFlower.pt --data data/Flower.yaml --ratio 0.3  # BN scale saliency
+    $ python prune.py --weights YOLOFlower.pt --data data/Flower.yaml --ratio 0.5 --saliency taylor --epochs 30
+
+Usage - fine-tune later:
+    $ python train.py --weights runs/prune/exp/pruned.pt --data data/Flower.yaml --noautoanchor
+"""
+
+import argparse
+import os
+import sys
+from copy import deepcopy
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+import yaml
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+
+import train
+import val
+from models.experimental import attempt_load
+from utils.dataloaders import create_dataloader
+from utils.general import (LOGGER, check_dataset, check_img_size, check_yaml, colorstr, increment_path, print_args,
+                           yaml_save)
+from utils.loss import ComputeLoss
+from utils.pruning import bn_saliency, prune_model, taylor_saliency
+from utils.torch_utils import select_device, thop, time_sync
+
+
+def profile_model(model, imgsz=640, n=20):
+    # Return the parameters, GFLOPs and median CPU latency (ms, batch 1) of a fused copy of model
+    model = deepcopy(model).float().cpu().fuse().eval()
+    im = torch.zeros(1, 3, imgsz, imgsz)
+    params = sum(x.numel() for x in model.parameters())
+    flops = thop.profile(deepcopy(model), inputs=(im,), verbose=False)[0] / 1E9 * 2 if thop else 0  # GFLOPs
+    with torch.inference_mode():
+        for _ in range(3):
+            model(im)  # warmup
+        t = []
+        for _ in range(n):
+            t0 = time_sync()
+            model(im)
+            t.append(time_sync() - t0)
+    return params, flops, float(np.median(t)) * 1E3
+
+
+def run(
+        weights=ROOT / 'yolov5s.pt',  # trained model.pt path
+        data=ROOT / 'data/coco128.yaml',  # dataset.yaml path
+        imgsz=640,  # train, val image size (pixels)
+        batch_size=16,  # batch size
+        ratio=0.3,  # ratio of channels removed
+        saliency='bn',  # channel saliency, bn (BN scale) or taylor (first-order Taylor on train images)
+        min_keep=0.1,  # minimum ratio of channels kept per layer
+        divisor=8,  # kept channels are a multiple of divisor
+        batches=32,  # taylor saliency train batches
+        epochs=0,  # fine-tuning epochs, 0 to skip
+        hyp=ROOT / 'data/hyps/hyp.scratch-low.yaml',  # fine-tuning and taylor saliency hyperparameters path
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        workers=8,  # max dataloader workers
+        noval=False,  # skip val mAP
+        project=ROOT / 'runs/prune',  # save to project/name
+        name='exp',  # save to project/name
+        exist_ok=False,  # existing project/name ok, do not increment
+):
+    device = select_device(device, batch_size=batch_size)
+    save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)  # increment run
+    save_dir.mkdir(parents=True, exist_ok=True)
+    data_dict = check_dataset(data)
+    model = attempt_load(weights, device, fuse=False)  # unfused, BN layers are pruned
+    imgsz = check_img_size(imgsz, s=int(model.stride.max()))
+
+    # Saliency
+    if saliency == 'taylor':
+        if not isinstance(getattr(model, 'hyp', None), dict):  # hyp scaled as in train.py
+            with open(check_yaml(hyp), errors='ignore') as f:
+                h = yaml.safe_load(f)
+            nl, nc = model.model[-1].nl, model.model[-1].nc
+            h['box'] *= 3 / nl
+            h['cls'] *= nc / 80 * 3 / nl
+            h['obj'] *= (imgsz / 640) ** 2 * 3 / nl
+            model.hyp = h
+        dataloader = create_dataloader(data_dict['train'],
+                                       imgsz,
+                                       batch_size,
+                                       int(model.stride.max()),
+                                       hyp=model.hyp,
+                                       workers=workers,
+                                       prefix=colorstr('saliency: '),
+                                       shuffle=True)[0]
+        s = taylor_saliency(model, dataloader, ComputeLoss(model, None, False), batches)
+    elif saliency == 'bn':
+        s = bn_saliency(model)
+    else:
+        raise ValueError(f'Invalid saliency {saliency}, valid saliencies are bn and taylor')
+
+    # Prune
+    pruned = prune_model(model, s, ratio, min_keep, divisor)
+    f = save_dir / 'pruned.pt'
+    torch.save({'model': deepcopy(pruned).half(), 'date': datetime.now().isoformat()}, f)
+    yaml_save(save_dir / 'pruned.yaml', pruned.yaml)
+    LOGGER.info(f'Pruned model saved to {colorstr("bold", f)}')
+
+    # Fine-tune
+    models = [('original', weights, model), ('pruned', f, pruned)]
+    if epochs:
+        opt = train.run(weights=str(f),
+                        cfg='',
+                        data=data,
+                        hyp=hyp,
+                        epochs=epochs,
+                        batch_size=batch_size,
+                        imgsz=imgsz,
+                        device='cpu' if device.type == 'cpu' else str(device.index),
+                        workers=workers,
+                        noautoanchor=True,  # keep the trained anchors
+                        project=save_dir,
+                        name='finetune',
+                        exist_ok=True)
+        w = Path(opt.save_dir) / 'weights' / 'best.pt'
+        models.append(('fine-tuned', w, attempt_load(w, device, fuse=False)))
+
+    # Report
+    y = []
+    for label, w, m in models:
+        params, flops, ms = profile_model(m, imgsz)
+        mp = None if noval else val.run(data,
+                                        weights=w,
+                                        batch_size=batch_size,
+                                        imgsz=imgsz,
+                                        device=device,
+                                        workers=workers,
+                                        half=False,
+                                        plots=False,
+                                        project=save_dir,
+                                        name=f'val-{label}',
+                                        exist_ok=True)[0][2:4]
+        y.append([label, params, round(flops, 2), round(ms, 2), *([None] * 2 if mp is None else np.round(mp, 4))])
+    c = ['Model', 'Parameters', 'GFLOPs', f'CPU latency (ms, {imgsz})', 'mAP50', 'mAP50-95']
+    py = pd.DataFrame(y, columns=c)
+    py.to_csv(save_dir / 'prune.csv', index=False)
+    LOGGER.info(f'\n{py}\nResults saved to {colorstr("bold", save_dir)}')
+    return py
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default=ROOT / 'yolov5s.pt', help='trained model.pt path')
+    parser.add_argument('--data', type=str, default=ROOT / 'data/coco128.yaml', help='dataset.yaml path')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='train, val image size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=16, help='batch size')
+    parser.add_argument('--ratio', type=float, default=0.3, help='ratio of channels removed')
+    parser.add_argument('--saliency', type=str, choices=['bn', 'taylor'], default='bn', help='channel saliency')
+    parser.add_argument('--min-keep', type=float, default=0.1, help='minimum ratio of channels kept per layer')
+    parser.add_argument('--divisor', type=int, default=8, help='kept channels are a multiple of divisor')
+    parser.add_argument('--batches', type=int, default=32, help='taylor saliency train batches')
+    parser.add_argument('--epochs', type=int, default=0, help='fine-tuning epochs, 0 to skip')
+    parser.add_argument('--hyp', type=str, default=ROOT / 'data/hyps/hyp.scratch-low.yaml', help='hyperparameters path')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--workers', type=int, default=8, help='max dataloader workers')
+    parser.add_argument('--noval', action='store_true', help='skip val mAP')
+    parser.add_argument('--project', default=ROOT / 'runs/prune', help='save to project/name')
+    parser.add_argument('--name', default='exp', help='save to project/name')
+    parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
+    opt = parser.parse_args()
+    opt.data = check_yaml(opt.data)  # check YAML
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    run(**vars(opt))
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    main(opt)
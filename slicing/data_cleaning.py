@@ -9,39 +9,29 @@ from typing import List, Tuple, Dict
 def bboxesFromDirectory(dir: str) -> pandas.DataFrame:
     ###
     # Arguments:
-    #   dir: path to the directory containing the metadata files (assumes they are csv files with columns 'file', 'region_attributes' (class name) and 'region_shape_attributes' (bounding box coordinates))
-    # return: pandas.DataFrame with a row for each bounding box and three columns: 
+    #   dir: path to the directory containing the metadata files (assumes they are csv files with columns 'filename', 'region_attributes' (class name) and 'region_shape_attributes' (bounding box coordinates))
+    # return: pandas.DataFrame with a row for each bounding box and six columns: 
     #   'path' contains the file name of the image which the bounding box belongs to, 
-    #   'class' class label of the bounding box & 
-    #   'bbox' a list of length 4 which contains [xmax, ymax, width, height] as integer pixel coordinates  
+    #   'class' class label of the bounding box (missing if the region has no class) & 
+    #   'x', 'y', 'width', 'height' the top left corner and size of the bounding box in pixel coordinates (missing if the region is not a rectangle)
     ###
-    meta_data_paths = []
-    img_paths = []
+    meta_data_paths = [i for i in glob.iglob(dir + os.sep + "**", recursive = True) if re.search("\.csv$", i)]
+    columns = ["path", "class", "x", "y", "width", "height"]
+    if not meta_data_paths:
+        return pandas.DataFrame(columns=columns)
+
+    # Read all metadata files and parse them in one go, instead of one regex per row and one concat per file
+    combinedCSV = pandas.concat([pandas.read_csv(path, usecols=["filename", "region_attributes", "region_shape_attributes"]) for path in meta_data_paths], ignore_index=True)
+    regions = combinedCSV["region_attributes"].astype(str)
+    shapes = combinedCSV["region_shape_attributes"].astype(str)
+
+    combinedBBoxes = pandas.DataFrame({
+        "path" : combinedCSV["filename"],
+        "class" : regions.str.extract('"(?:stage|state)"\\s*:\\s*"([a-zA-Z]+)"', expand=False)
+    })
+    for key in columns[2:]:
+        combinedBBoxes[key] = pandas.to_numeric(shapes.str.extract(f'"{key}"\\s*:\\s*([0-9]+)', expand=False))
 
-    for i in glob.iglob(dir + os.sep + "**", recursive = True):
-        i = re.sub(f'[\/\\\\]+', "/", i)
-        if re.search("\.csv$", i):
-            meta_data_paths.append(i)
-        if re.search("\.JPG|\.jpg|\.jpeg|\.png", i):
-            img_paths.append(i)
-
-    combinedBBoxes = pandas.DataFrame({"path": [],"class" : [], "bbox" : []})
-
-    for path in meta_data_paths:
-        thisCSV = pandas.read_csv(path)
-
-        thisClasses = [re.findall("(?<=stage\"\:\")[a-zA-Z]+|(?<=state\"\:\")[a-zA-Z]+", i) for i in thisCSV["region_attributes"]]
-
-        thisBBoxes = [[int(j) for j in re.findall("[0-9]+", i)] for i in thisCSV["region_shape_attributes"]]
-
-        thisCSV = pandas.DataFrame({
-            "path" : thisCSV["filename"],
-            "class" : thisClasses,
-            "bbox" : thisBBoxes
-        })
-        
-        combinedBBoxes = pandas.concat([combinedBBoxes, thisCSV])
-    
     return combinedBBoxes
 
 class class_to_index:
@@ -156,50 +146,54 @@ def create_yolo_annotations(dir: str, out_dir: str, verbose: bool = False, exclu
         if not os.path.exists(sub):
             os.makedirs(sub, exist_ok=True)
 
-    image_names = []
+    image_names = set()
 
     for i in glob.iglob(f'{out_dir}{os.sep}images{os.sep}**{os.sep}**'):
         if len(i) > 0:
             try:
-                image_names.append(clean_filename(i, True, True, False))
+                image_names.add(clean_filename(i, True, True, False))
             except:
                 raise ValueError("Invalid image file name: " + i)
 
-    def extract_data(src: str, data: pandas.DataFrame) -> None:
+    # Match every annotated image to its cleaned name once, later files overwrite earlier ones with the same name
+    destinations = {}
+    for src in sorted(annotations["path"].unique()):
         newsrc = clean_filename(src, True, True, False)
-        img_series = get_series(newsrc)
-
         if newsrc not in image_names:
             if verbose:
                 print(newsrc + " could not find a matching image file! (" + src + ")")
-            return 
-
-        label_dst = f'{out_dir}{os.sep}labels{os.sep}{img_series}{os.sep}{newsrc}.txt'
-
-        xscale, yscale = (6080, 3420)
-
-        if os.path.exists(label_dst):
-            open_type = "w"
-        else:
-            open_type = "x"
-
-        with open(label_dst, open_type) as f:
-            for cls, bbox in zip(data["class"], data["bbox"]):
-                if not cls or cls[0] in excluded_classes:
-                    continue
-                cls = cls[0]
-                xmax, ymax, width, height = tuple(bbox)
-                xcenter = xmax + width/2
-                ycenter = ymax + height/2
-                xcenter /= xscale
-                width /= xscale
-                ycenter /= yscale
-                height /= yscale
-
-                f.write(f'{class_translator.translate(cls)} {round(xcenter, 7)} {round(ycenter, 7)} {round(width, 7)} {round(height, 7)}\n')
+            continue
+        destinations[newsrc] = src
+
+    boxes = annotations[annotations["class"].notna() & ~annotations["class"].isin(excluded_classes)]
+    unknown = set(boxes["class"]) - set(class_translator.dict)
+    if unknown:
+        raise ValueError(f'Unknown classes in metadata files: {", ".join(sorted(unknown))}')
+    missing = boxes[["x", "y", "width", "height"]].isna().any(axis=1)
+    if missing.any():
+        if verbose:
+            print(f'Skipping {missing.sum()} annotations without a rectangular bounding box!')
+        boxes = boxes[~missing]
+
+    # Convert all bounding boxes at once and join the label lines per image
+    xscale, yscale = (6080, 3420)
+    xcenter = ((boxes["x"] + boxes["width"] / 2) / xscale).tolist()
+    ycenter = ((boxes["y"] + boxes["height"] / 2) / yscale).tolist()
+    width = (boxes["width"] / xscale).tolist()
+    height = (boxes["height"] / yscale).tolist()
+    lines = [
+        f'{c} {round(x, 7)} {round(y, 7)} {round(w, 7)} {round(h, 7)}\n'
+        for c, x, y, w, h in zip(boxes["class"].map(class_translator.dict).tolist(), xcenter, ycenter, width, height)
+    ]
+    labels = pandas.Series(lines, index=boxes["path"].values, dtype=object).groupby(level=0, sort=False).agg("".join).to_dict()
+
+    def write_label(newsrc: str, src: str) -> None:
+        label_dst = f'{out_dir}{os.sep}labels{os.sep}{get_series(newsrc)}{os.sep}{newsrc}.txt'
+        with open(label_dst, "w") as f:
+            f.write(labels.get(src, ""))
 
     for i in file_cleaner.dict.keys():
         make_series_dir(i, out_dir)
 
     pool = mpd.Pool()
-    pool.starmap(extract_data, tqdm(annotations.groupby("path")))
\ No newline at end of file
+    pool.starmap(write_label, tqdm(destinations.items()))
@@ -1,109 +1,233 @@
+import hashlib
 import os
 
 import pandas as pd
-from torch.utils.data import Subset
 # from torch.utils.data import WeightedRandomSampler
 from typing import Dict, List, Tuple
 
 from utils.dataloaders import * 
+from slicing.slicing import get_slice_bboxes, load_slice_statistics
 
 class LoadFlower(LoadImagesAndLabels):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, nc: int = None, **kwargs):
         kwargs = {k : v for k, v in kwargs.items()}
         super().__init__(*args, **kwargs)
-        path_tree = pd.concat(
-                [
-                    pd.DataFrame(
-                        {level: [name] for level, name in enumerate(i.rsplit(os.sep))}
-                        ) for i in self.im_files
-                ]
-            )
-        path_tree_num_unique = path_tree.agg(lambda x: len({i for i in x}))
-        self.path_tree = path_tree.loc[:, path_tree_num_unique > 1]
+        self.path_levels, self.path_codes = self.encode_paths(self.im_files)
         self.batch_size = args[1]
+        self.class_counts = self.load_class_counts(nc)
 
-    def split_data(self, proportions: List[float] or List[int] = [80, 16, 4], stratification_level: int = 1) -> List[Subset]:
-        proportions = [i / sum(proportions) for i in proportions]
+    def load_class_counts(self, nc: int = None) -> np.ndarray:
+        # Per-image class histograms (n, nc), read from the slice statistics table when it matches the loaded labels.
+        # nc is the number of classes of the data yaml, widened to the largest label class if that exceeds it
+        n_labels = np.array([len(i) for i in self.labels])
+        statistics = load_slice_statistics(self.path) if isinstance(self.path, (str, Path)) else None
+        if statistics is not None:
+            try:
+                root = Path(self.path) / 'images'
+                keys = [Path(i).relative_to(root).with_suffix('').as_posix() for i in self.im_files]
+                statistics = statistics.reindex(keys)
+                if (statistics["n"].to_numpy() == n_labels).all(): # also False if any image is missing (NaN)
+                    columns = {int(i[4:]): i for i in statistics.columns if i.startswith("cls_")}
+                    counts = np.zeros((len(keys), max(columns, default=0) + 1), dtype=np.int64)
+                    for i, c in columns.items():
+                        counts[:, i] = statistics[c].to_numpy(np.int64)
+                    if (counts.sum(1) == n_labels).all(): # every label counted
+                        width = max(nc or 1, counts.any(0).nonzero()[0].max(initial=-1) + 1)
+                        return np.pad(counts, ((0, 0), (0, max(0, width - counts.shape[1]))))[:, :width]
+            except ValueError:
+                pass
+            LOGGER.warning("WARNING ⚠️ Slice statistics table does not match the dataset labels, recounting classes from labels")
+        classes = np.concatenate([i[:, 0] for i in self.labels] + [np.zeros(0)]).astype(np.int64)
+        nc = max(nc or 1, classes.max() + 1) if len(classes) else nc or 1
+        image = np.repeat(np.arange(len(self.labels)), n_labels) # Image index of each label
+        return np.bincount(image * nc + classes, minlength=len(self.labels) * nc).reshape(-1, nc)
 
-        def group_split(ind, proportions, groups):
-            group_set = {i for i in groups}
+    @staticmethod
+    def encode_paths(files: List[str]) -> Tuple[List[np.ndarray], np.ndarray]:
+        # Split paths into their directory levels and encode every level as integer codes, dropping levels that are
+        # identical for all files. Returns the sorted names of each level and the (n, levels) code array.
+        parts = pd.DataFrame([i.split(os.sep) for i in files]).fillna("")
+        levels, codes = [], []
+        for column in parts.columns:
+            names, code = np.unique(parts[column].to_numpy(str), return_inverse=True)
+            if len(names) > 1:
+                levels.append(names)
+                codes.append(code.reshape(-1))
+        codes = np.stack(codes, 1).astype(np.int32) if codes else np.zeros((len(files), 0), dtype=np.int32)
+        return levels, codes
 
-            n = len(group_set)
-            splits = [int(n * i) for i in proportions]
-            left = n - sum(splits)
-            assert left >= 0, print("Number of splits must be smaller than or equal to number of groups.")
-            
-            for i in range(left):
-                splits[i] += 1
+    def split_groups(self, stratification_level: int = 1) -> np.ndarray:
+        # Group id of every image, images share a group if their first 'stratification_level' path levels are equal
+        codes = self.path_codes[:, :stratification_level]
+        if codes.shape[1] == 0:
+            return np.zeros(len(self), dtype=np.int64)
+        return np.unique(codes, axis=0, return_inverse=True)[1].reshape(-1)
 
-            try:
-                assert n == sum(splits)
-            except:
-                raise ValueError(splits)
-
-            group_splits = []
-            for i in splits:
-                this_split = set(random.sample(group_set, i))
-                group_splits.append(this_split)
-                group_set = group_set - this_split
-
-            assert len(group_set) == 0
-
-            return [[ind for g, ind in zip(groups, ind) if g in i] for i in group_splits]
-
-        splits = group_split(
-            ind=range(len(self)),
-            proportions=proportions,
-            groups=self.path_tree.iloc[:, :stratification_level].apply(
-                lambda x: ','.join(x.dropna().astype(str)), axis=1)
-        )
-        
-        print("TESTING:", len(self.im_files), len(self))
-        print("TESTING:", [len(i) for i in splits])
-        
-        datasets = [self.__subset_dataset(ind) for ind in splits]
-
-        return tuple([*datasets])
-    
-    def __subset_dataset(self, ind):
-        n = len(self)
-        
-        sub = Subset(self, indices=ind)
-        
-        for k, v in self.__dict__.items():
-            if hasattr(v, "__len__") and not n == 0 and len(v) % n == 0:
-                if isinstance(v, pd.DataFrame):
-                    setattr(sub, k, v.iloc[ind,:])
-                elif isinstance(v, np.ndarray):
-                    setattr(sub, k, v[ind])
-                elif isinstance(v, torch.Tensor):
-                    setattr(sub, k, v[ind])
-                else:
-                    try:
-                        setattr(sub, k, [v[i] for i in ind])
-                    except:
-                        raise ValueError("Length of", k, "is", len(k))
-            else:
-                setattr(sub, k, v)
-                
-        return sub
+    def split_assignment(self, proportions: List[float], stratification_level: int = 1, seed: int = 0) -> np.ndarray:
+        # Split index of every image, whole groups are assigned to splits in the given proportions of the number of groups.
+        # Assignments are cached next to the labels cache, keyed by the file list and the split parameters.
+        key = hashlib.sha256("\n".join(self.im_files + [str(proportions), str(stratification_level), str(seed)]).encode()).hexdigest()
+        cache_path = Path(self.cache_path).with_suffix(".splits")
+        try:
+            cache = np.load(cache_path, allow_pickle=True).item()
+        except Exception:
+            cache = {}
+        if key in cache and len(cache[key]) == len(self):
+            return cache[key]
+
+        groups = self.split_groups(stratification_level)
+        n = groups.max() + 1 if len(groups) else 0
+        splits = [int(n * i) for i in proportions]
+        left = n - sum(splits)
+        if not 0 <= left <= len(splits):
+            raise ValueError("Number of splits must be smaller than or equal to number of groups.")
+        for i in range(left):
+            splits[i] += 1
+
+        # Randomly ordered groups are cut into consecutive chunks of the split sizes
+        group_split = np.empty(n, dtype=np.int8)
+        group_split[np.random.default_rng(seed).permutation(n)] = np.repeat(np.arange(len(splits)), splits)
+        assignment = group_split[groups]
+
+        cache[key] = assignment
+        try:
+            np.save(cache_path, cache)
+            cache_path.with_suffix(".splits.npy").rename(cache_path) # remove .npy suffix
+        except Exception as e:
+            LOGGER.warning(f"WARNING ⚠️ Split cache directory {cache_path.parent} is not writeable: {e}")
+        return assignment
+
+    def split_data(self, proportions: List[float] or List[int] = [80, 16, 4], stratification_level: int = 1, seed: int = 0) -> Tuple["LoadFlowerView", ...]:
+        proportions = [i / sum(proportions) for i in proportions]
+        assignment = self.split_assignment(proportions, stratification_level, seed)
+        splits = [np.flatnonzero(assignment == i) for i in range(len(proportions))]
+        LOGGER.info(f"Split {len(self)} images into {', '.join(str(len(i)) for i in splits)} images")
+
+        return tuple(LoadFlowerView(self, ind) for ind in splits)
     
-    def weights(self, gamma):
-        def single_weight(image_label, gamma):
-            if image_label.shape[0] == 1:
-                weight = -1/2 * np.log(1/2) * np.log(2)
-            else:
-                labels = np.round(image_label[:, 0]).astype(np.int64) # Subset only the labels, i.e. remove the coordinates
-                counts = np.bincount(labels, minlength=5).astype(np.float64)
-                counts[counts == 0] = 1
-                counts = counts/np.sum(counts) # Normalize counts
-                entropy = counts * np.log(counts) # Calculate Shannon Entropy
-                # Isn't needed as long as counts cannot contains zeros 
-                # entropy[np.isnan(entropy)] = 0 # Set NaN to zero, since these are generated when a count = 0, where log(0) = Inf-
-                weight = -np.sum(entropy, 0) * np.log(max(5, len(labels))) # Return the product of the entropy and the log of the number of labels (+1).
-            return weight / (weight ** (1 - gamma))
-        
-        return [single_weight(i, gamma=gamma) for i in self.labels]
+    def weights(self, gamma: float) -> np.ndarray:
+        # Entropy based sample weights of all images at once from the (n, nc) class histograms
+        counts = self.class_counts.astype(np.float64)
+        n = counts.sum(1) # Number of labels
+        counts[counts == 0] = 1 # No zero counts, so the entropy has no NaN from log(0)
+        counts /= counts.sum(1, keepdims=True) # Normalize counts
+        entropy = -np.sum(counts * np.log(counts), 1) # Shannon entropy
+        weight = entropy * np.log(np.maximum(5, n)) # Product of the entropy and the log of the number of labels
+        weight[n <= 1] = -1/2 * np.log(1/2) * np.log(2) # Background slices (no labels) are weighted like single label slices
+        return weight / (weight ** (1 - gamma))
+
+
+class LoadFlowerCrops(LoadFlower):
+    # LoadFlower on full (e.g. Reduced) frames instead of pre-sliced images, every item is a new random img_size x img_size
+    # crop of its frame at the original resolution, so no sliced dataset has to be materialized on disk.
+    # With --cache ram/disk the full frames are cached in a memory-mapped arena, so only the crop is read.
+    resize_on_load = False
+
+    def __init__(self, *args, annotation_bias: float = 0.8, min_area_ratio: float = 0.1, **kwargs):
+        self.annotation_bias = annotation_bias # Probability of centering a crop on a random annotation instead of a uniform position
+        self.min_area_ratio = min_area_ratio # Boxes with less of their area inside the crop are dropped, as in slice_image
+        kwargs["rect"] = False # Crops are square
+        super().__init__(*args, **kwargs)
+
+    def crop_origin(self, i: int, shape: Tuple[int, int]) -> Tuple[int, int]:
+        # Top left corner of a random crop of frame i, biased towards containing a random annotation
+        h, w = shape
+        s = self.img_size
+        labels = self.labels[i]
+        if len(labels) and random.random() < self.annotation_bias:
+            x1, y1, x2, y2 = xywhn2xyxy(labels[random.randrange(len(labels)), 1:][None], w, h)[0]
+            x_lo, x_hi = max(0, int(np.ceil(x2)) - s), min(int(x1), w - s) # Crops containing the whole box
+            y_lo, y_hi = max(0, int(np.ceil(y2)) - s), min(int(y1), h - s)
+            if x_lo > x_hi: # Box wider than the crop, contain its center instead
+                x_lo, x_hi = min(max(0, int((x1 + x2) / 2) - s + 1), w - s), min(max(0, int((x1 + x2) / 2)), w - s)
+            if y_lo > y_hi:
+                y_lo, y_hi = min(max(0, int((y1 + y2) / 2) - s + 1), h - s), min(max(0, int((y1 + y2) / 2)), h - s)
+        else:
+            x_lo, x_hi, y_lo, y_hi = 0, w - s, 0, h - s
+        return random.randint(max(0, x_lo), max(0, x_hi)), random.randint(max(0, y_lo), max(0, y_hi))
+
+    def load_image_and_labels(self, i):
+        im, (h0, w0), _ = self.load_image(i)
+        x0, y0 = self.crop_origin(i, (h0, w0))
+        return self.crop(i, im, x0, y0)
+
+    def crop(self, i: int, im: np.ndarray, x0: int, y0: int):
+        # img_size x img_size crop of frame i (im) at top left corner x0, y0 and its labels, as load_image_and_labels()
+        h0, w0 = im.shape[:2]
+        im = im[y0:y0 + self.img_size, x0:x0 + self.img_size].copy() # Always a copy, frames may be cached or memory-mapped and are augmented in place
+        h, w = im.shape[:2]
+
+        # Clip all boxes to the crop at once and keep those with enough of their area inside it
+        labels = self.labels[i]
+        if labels.size:
+            xyxy = xywhn2xyxy(labels[:, 1:], w0, h0, padw=-x0, padh=-y0)
+            clipped = np.clip(xyxy, 0, [w, h, w, h])
+            area = np.prod(xyxy[:, 2:] - xyxy[:, :2], 1)
+            area_inside = np.prod(clipped[:, 2:] - clipped[:, :2], 1)
+            keep = (area_inside > 0) & (area_inside >= self.min_area_ratio * area)
+            labels = np.concatenate((labels[keep, :1], xyxy2xywhn(clipped[keep], w, h)), 1)
+        else:
+            labels = labels.copy()
+        return im, (h, w), (h, w), labels, []
+
+
+class LoadFlowerView(Dataset):
+    # Index view of a LoadFlower dataset (e.g. a train/val/test split) sharing all of the parent's storage, including
+    # the RAM image cache. Items are loaded by the parent, so the returned index is the parent index.
+    # Per-image attributes are remapped on access, everything else is read from the parent.
+    per_image_attributes = ("im_files", "label_files", "labels", "shapes", "segments", "class_counts", "path_codes")
+
+    def __init__(self, dataset: LoadFlower, indices: np.ndarray):
+        self.dataset = dataset
+        self.parent_indices = np.asarray(indices, dtype=np.int64) # View index -> parent index
+        self.n = len(self.parent_indices)
+        self.indices = range(self.n) # linear or image_weights sampling order, like LoadImagesAndLabels.indices
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, index):
+        return self.dataset[self.parent_indices[self.indices[index]]]
+
+    def __getattr__(self, name):
+        if name.startswith("__") or name in ("dataset", "parent_indices"): # not set yet, e.g. while unpickling
+            raise AttributeError(name)
+        v = getattr(self.dataset, name)
+        if name in self.per_image_attributes:
+            return v[self.parent_indices] if isinstance(v, (np.ndarray, torch.Tensor)) else [v[i] for i in self.parent_indices]
+        return v
+
+
+class LoadFlowerTiles(LoadFlowerView):
+    # Deterministic view of a LoadFlowerCrops split for validation, every item is one tile of the overlapping
+    # img_size x img_size slice grid of its frame (get_slice_bboxes, with the 0.1 overlap finalizeDataset.py cuts the
+    # sliced datasets with and val.py --sliced tiles frames with), without augmentation, so every epoch validates on
+    # the same images at the training resolution.
+    # Per-image attributes are those of each tile's frame.
+    def __init__(self, dataset: LoadFlowerCrops, indices: np.ndarray, overlap: float = 0.1):
+        s = dataset.img_size
+        tiles = [(i, *b) for i in np.asarray(indices, dtype=np.int64)
+                 for b in get_slice_bboxes(*dataset.shapes[i][::-1], s, s, False, overlap, overlap)] # (frame, x1, y1, x2, y2)
+        tiles = np.array(tiles, dtype=np.int64).reshape(-1, 5)
+        super().__init__(dataset, tiles[:, 0])
+        self.origins = tiles[:, 1:3] # Top left corner of every tile
+        LOGGER.info(f"Validating on {self.n} tiles of {len(np.unique(self.parent_indices))} frames")
+
+    def __getitem__(self, index):
+        index = self.indices[index]
+        i = self.parent_indices[index]
+        d = self.dataset
+        im, _, (h, w), labels, _ = d.crop(i, d.load_image(i)[0], *self.origins[index])
+        im, ratio, pad = letterbox(im, d.img_size, auto=False, scaleup=False) # Pad edge tiles of small frames
+
+        labels_out = torch.zeros((len(labels), 6))
+        if len(labels):
+            xyxy = xywhn2xyxy(labels[:, 1:], ratio[0] * w, ratio[1] * h, padw=pad[0], padh=pad[1])
+            labels_out[:, 1] = torch.from_numpy(labels[:, 0])
+            labels_out[:, 2:] = torch.from_numpy(xyxy2xywhn(xyxy, w=im.shape[1], h=im.shape[0], clip=True, eps=1E-3))
+
+        im = np.ascontiguousarray(im.transpose((2, 0, 1))[::-1]) # HWC to CHW, BGR to RGB
+        return torch.from_numpy(im), labels_out, d.im_files[i], i
 
 
 def create_dataset_flower(path,
@@ -120,9 +244,11 @@ def create_dataset_flower(path,
                           prefix='',
                           rank=-1,
                           num_files=None,
-                          min_items=1):
+                          min_items=1,
+                          crops=False,  # random crops of full frames (LoadFlowerCrops)
+                          nc=None):  # number of classes of the class counts, from the data yaml
     with torch_distributed_zero_first(rank):  # init dataset *.cache only once if DDP
-        dataset = LoadFlower(
+        dataset = (LoadFlowerCrops if crops else LoadFlower)(
             path,
             imgsz,
             batch_size,
@@ -136,7 +262,8 @@ def create_dataset_flower(path,
             image_weights=image_weights,
             prefix=prefix,
             num_files=num_files,
-            min_items=min_items)
+            min_items=min_items,
+            nc=nc)
 
     return dataset
 
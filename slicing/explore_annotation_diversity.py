@@ -1,4 +1,4 @@
-from slicing import read_yolo
+from slicing import read_yolo, load_slice_statistics
 import glob
 from tqdm import tqdm
 import pandas as pd
@@ -22,10 +22,20 @@ def tab_yolo(path: str, ind: int) -> pd.DataFrame:
                 "Mature" : tab[4]
             }, index=[ind])
 
-all_ann_paths = glob.glob("../Sliced/labels/*.txt")[0:100]
+def tab_statistics(table: pd.DataFrame) -> pd.DataFrame:
+    # Same layout as tab_yolo, built from the slice statistics table written during slicing
+    tab = table[[f"cls_{i}" for i in range(5)]].set_axis(["Bud", "Flower", "Withered", "Immature", "Mature"], axis=1)
+    return tab.rename_axis("path").reset_index()
 
-with tqdm(all_ann_paths, total = len(all_ann_paths)) as t:
-  all_tab = pd.concat([tab_yolo(i, ind=ind) for ind, i in enumerate(t)])
+statistics = load_slice_statistics("../Sliced")
+
+if statistics is not None:
+  all_tab = tab_statistics(statistics)
+else:
+  all_ann_paths = glob.glob("../Sliced/labels/*.txt")[0:100]
+
+  with tqdm(all_ann_paths, total = len(all_ann_paths)) as t:
+    all_tab = pd.concat([tab_yolo(i, ind=ind) for ind, i in enumerate(t)])
 
 
 # for path, tab in all_ann.items():
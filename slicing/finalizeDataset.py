@@ -2,13 +2,15 @@ import glob
 import os
 import re
 import sys
+import zlib
 from shutil import rmtree
 
 from slicing.data_cleaning import create_yolo_annotations
 from slicing.image_resizing import resize_images
-from p_tqdm import p_map
+from p_tqdm import p_map, p_imap
 
-from slicing.slicing import slice_image
+from slicing.slicing import slice_image, encode_image, yolo_to_text, save_slice_statistics
+from utils.shards import ShardWriter
 
 from typing import Dict, List, Tuple
 
@@ -21,7 +23,7 @@ def read_directories(path : str) -> Tuple[str, str, str]:
 
     return tuple(lines)
 
-def tile_one_image(reduced_file: str, sliced_directory: str) -> None:
+def tile_one_image(reduced_file: str, sliced_directory: str, packed: bool = False, adaptive: bool = False, background_ratio: float = 0.0) -> Tuple[List[Tuple[str, bytes, str]] or None, List[Dict]]:
         image = re.sub("[/\\\\]+", "/", reduced_file)
         annotation = re.sub("(?<=/)images(?=/)", "labels", image)
         annotation = re.sub("\.[a-zA-Z]+$", ".txt", annotation)
@@ -31,20 +33,42 @@ def tile_one_image(reduced_file: str, sliced_directory: str) -> None:
         series = "_".join(uuid_parts[:2]) # Image series
         local_id = "_".join(uuid_parts[2:]) # Series unique image identifier
 
-        slice_image(
+        # If packed, slice in memory and return the encoded slices as shard records, otherwise export them as files
+        result = slice_image(
             image=image,
             yolo_annotation=annotation,
-            output_dir=f'{sliced_directory}{os.sep}*{os.sep}{series}{os.sep}{local_id}', 
+            output_dir=None if packed else f'{sliced_directory}{os.sep}*{os.sep}{series}{os.sep}{local_id}', 
             output_file_name=image_uuid + "_bbox",
             slice_height=640,
             slice_width=640,
             overlap_height_ratio=0.1,
             overlap_width_ratio=0.1,
             min_out_slice_annotations=1,
+            adaptive=adaptive, # Place the slices around the annotations instead of on the fixed grid
+            background_ratio=background_ratio,
+            seed=zlib.crc32(image_uuid.encode()), # Same background slices every time the dataset is built
             verbose=False
         )
+        if result is None: # Too few bounding boxes for any slice to be exported
+            return ([] if packed else None), []
 
-def main(downscaling_factor : str = "4", num_subset : str = None, verbose : str = "False", workers : str = "8", slice : bool = True, excluded_classes : List[str] or str = "Gone") -> None:
+        # Per-slice label statistics of the exported slices, keyed like the slice image paths relative to images/
+        statistics = result.statistics(nc=5, min_annotations=1)
+        for row in statistics:
+            row["file"] = f'{series}/{local_id}/{os.path.splitext(row.pop("file_name"))[0]}'
+            row["series"] = series
+            row["parent"] = image_uuid
+
+        if packed:
+            records = [
+                (f'{series}/{local_id}/{os.path.splitext(i.file_name)[0]}', encode_image(i.image), yolo_to_text(i.annotation))
+                for i in result.sliced_image_list if len(i.annotation) >= 1 or i.background
+            ]
+            return records, statistics
+
+        return None, statistics
+
+def main(downscaling_factor : str = "4", num_subset : str = None, verbose : str = "False", workers : str = "8", slice : bool = True, excluded_classes : List[str] or str = "Gone", packed : bool or str = False, adaptive : bool or str = False, background_ratio : str = "0", output_directory : str = None) -> None:
 
     if not num_subset is None:
         try:
@@ -58,6 +82,20 @@ def main(downscaling_factor : str = "4", num_subset : str = None, verbose : str
     if verbose is None:
         raise ValueError("Argument verbose must be one of either 'True' or 'False'")
 
+    packed = packed if isinstance(packed, bool) else True if packed == "True" else False if packed == "False" else None
+    if packed is None:
+        raise ValueError("Argument packed must be one of either 'True' or 'False'")
+
+    adaptive = adaptive if isinstance(adaptive, bool) else True if adaptive == "True" else False if adaptive == "False" else None
+    if adaptive is None:
+        raise ValueError("Argument adaptive must be one of either 'True' or 'False'")
+
+    try:
+        background_ratio = float(background_ratio)
+        assert background_ratio >= 0
+    except:
+        raise ValueError("Argument 'background_ratio' must be a non-negative number.")
+
     try:
         if downscaling_factor.count(",") > 0:
             downscaling_factor = [float(i) for i in downscaling_factor.rsplit(",")]
@@ -73,6 +111,9 @@ def main(downscaling_factor : str = "4", num_subset : str = None, verbose : str
         raise ValueError("Argument 'workers' must be an integer.")
     
     source_directory, reduced_directory, sliced_directory = read_directories("directories.txt") 
+    if output_directory is not None:
+        # Write this dataset variant to its own directory (e.g. one per sweep dataset) instead of the shared ones
+        reduced_directory, sliced_directory = os.path.join(output_directory, "Reduced"), os.path.join(output_directory, "Sliced")
 
     in_resolution = (6080, 3420)
     out_resolution = tuple([int(i/D) for i, D in zip(in_resolution, downscaling_factor)])
@@ -96,7 +137,17 @@ def main(downscaling_factor : str = "4", num_subset : str = None, verbose : str
         verbose=verbose,
         excluded_classes=excluded_classes,
     )
-    if slice is True:
+    if slice is True and packed:
+        # Write the slices into shards (see utils/shards.py) instead of one image and label file per slice
+        image_paths = glob.glob(f'{reduced_directory}{os.sep}images{os.sep}**{os.sep}**.jpg')
+        statistics = []
+        with ShardWriter(sliced_directory) as writer:
+            for records, image_statistics in p_imap(tile_one_image, image_paths, [sliced_directory] * len(image_paths), [True] * len(image_paths), [adaptive] * len(image_paths), [background_ratio] * len(image_paths)):
+                for key, image, label in records:
+                    writer.add(key, image, label)
+                statistics += image_statistics
+        save_slice_statistics(statistics, sliced_directory)
+    elif slice is True:
         image_path_pattern = f'{reduced_directory}{os.sep}images{os.sep}**{os.sep}**.jpg'
         sliced_image_path_pattern = f'{sliced_directory}{os.sep}images{os.sep}**.jpg'
         # annotation_path_pattern = f'{reduced_directory}{os.sep}labels{os.sep}**{os.sep}**.txt' # Not used currently
@@ -116,7 +167,8 @@ def main(downscaling_factor : str = "4", num_subset : str = None, verbose : str
                 continue
             left_image_paths.append(possible_left[0])
             
-        p_map(tile_one_image, left_image_paths, [sliced_directory for i in left_image_paths])
+        results = p_map(tile_one_image, left_image_paths, [sliced_directory for i in left_image_paths], [False for i in left_image_paths], [adaptive for i in left_image_paths], [background_ratio for i in left_image_paths])
+        save_slice_statistics([row for _, image_statistics in results for row in image_statistics], sliced_directory)
 
 if __name__ == '__main__':
     kwargs = {}
@@ -2,6 +2,7 @@
 # Code written by Fatih C Akyon, 2020.
 
 import concurrent.futures
+import io
 import logging
 import os
 import re
@@ -12,6 +13,7 @@ from pathlib import Path
 from typing import Dict, List, Optional, Union, Tuple
 
 import numpy as np
+import pandas as pd
 from slicing.coco import Coco, CocoAnnotation, CocoImage, create_coco_dict
 from slicing.cv import read_image_as_pil
 from slicing.file import load_json, save_json
@@ -91,6 +93,95 @@ def get_slice_bboxes(
     return slice_bboxes
 
 
+def get_adaptive_slice_bboxes(
+    image_height: int,
+    image_width: int,
+    boxes: np.ndarray,
+    slice_height: int,
+    slice_width: int,
+    overlap_height_ratio: float = 0.1,
+    overlap_width_ratio: float = 0.1,
+    background_ratio: float = 0.0,
+    seed: Optional[int] = None,
+) -> Tuple[List[List[int]], List[List[int]]]:
+    """Places slices around the annotations instead of tiling the whole image.
+    Every slice centred on a box center is a candidate, and slices are chosen greedily (set cover) by the number of
+    boxes they contain that are not yet contained in a chosen slice, until every box is contained in at least one
+    slice. Boxes larger than a slice count as contained when their central slice-sized part is, boxes crossing the
+    image border when their part inside the image is, and every box by the slice centred on it. Background slices are
+    sampled from the regular grid of `get_slice_bboxes` among the slices that do not touch any box.
+    Args:
+        image_height (int): Height of the original image.
+        image_width (int): Width of the original image.
+        boxes (np.ndarray): Boxes in pixel coordinates, shape (n, 4) as [x_min, y_min, x_max, y_max].
+        slice_height (int): Height of each slice.
+        slice_width (int): Width of each slice.
+        overlap_height_ratio (float): Fractional overlap in height of the background slice grid. Default 0.1.
+        overlap_width_ratio (float): Fractional overlap in width of the background slice grid. Default 0.1.
+        background_ratio (float): Expected number of background slices per annotated slice, fractional counts are
+            rounded stochastically. Default 0.0.
+        seed (int, optional): Seed of the background slice sampling.
+    Returns:
+        Tuple[List[List[int]], List[List[int]]]: Corner coordinates [x_min, y_min, x_max, y_max] of the annotated
+            slices and of the background slices.
+    """
+    slice_width, slice_height = min(slice_width, image_width), min(slice_height, image_height)
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    slice_bboxes = []
+    if len(boxes):
+        # Candidate slices centred on the box centers, shifted inside the image
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        x_min = np.clip(np.round(centers[:, 0] - slice_width / 2), 0, image_width - slice_width)
+        y_min = np.clip(np.round(centers[:, 1] - slice_height / 2), 0, image_height - slice_height)
+        candidates = np.stack([x_min, y_min, x_min + slice_width, y_min + slice_height], 1).astype(np.int64)
+        candidates, own = np.unique(candidates, axis=0, return_inverse=True) # own: candidate centred on each box
+        own = own.reshape(-1)
+
+        # Central part of every box that has to lie inside a slice, i.e. the box itself clipped to the image unless it
+        # is larger than a slice, with a half pixel tolerance for the rounded slice corners
+        half = np.minimum(boxes[:, 2:] - boxes[:, :2], [slice_width, slice_height]) / 2
+        core = np.concatenate([centers - half, centers + half], 1)
+        core = np.clip(core, 0, [image_width, image_height, image_width, image_height])
+        contains = (
+            (candidates[:, None, 0] <= core[None, :, 0] + 0.5) & (candidates[:, None, 1] <= core[None, :, 1] + 0.5) &
+            (candidates[:, None, 2] >= core[None, :, 2] - 0.5) & (candidates[:, None, 3] >= core[None, :, 3] - 0.5)
+        ) # (candidates, boxes)
+        contains[own, np.arange(len(boxes))] = True # every box is covered by the slice centred on it
+
+        # Greedy set cover, every uncovered box has a slice that covers it, so every step covers at least one box
+        uncovered = np.ones(len(boxes), dtype=bool)
+        while uncovered.any():
+            gain = contains[:, uncovered].sum(1)
+            best = gain.argmax()
+            if gain[best] == 0: # unreachable, guards against an endless loop
+                break
+            slice_bboxes.append(candidates[best].tolist())
+            uncovered &= ~contains[best]
+
+    # Background slices from the regular grid that do not intersect any box
+    background_bboxes = []
+    if background_ratio > 0 and slice_bboxes:
+        grid = np.array(get_slice_bboxes(
+            image_height=image_height,
+            image_width=image_width,
+            slice_height=slice_height,
+            slice_width=slice_width,
+            overlap_height_ratio=overlap_height_ratio,
+            overlap_width_ratio=overlap_width_ratio,
+        ))
+        touches = (
+            (boxes[None, :, 0] < grid[:, None, 2]) & (boxes[None, :, 1] < grid[:, None, 3]) &
+            (boxes[None, :, 2] > grid[:, None, 0]) & (boxes[None, :, 3] > grid[:, None, 1])
+        ).any(1)
+        empty = grid[~touches]
+        rng = np.random.default_rng(seed)
+        expected = background_ratio * len(slice_bboxes)
+        n = min(int(expected) + int(rng.random() < expected % 1), len(empty))
+        background_bboxes = empty[np.sort(rng.choice(len(empty), n, replace=False))].tolist()
+
+    return slice_bboxes, background_bboxes
+
+
 def annotation_inside_slice(annotation: Dict, slice_bbox: List[int]) -> bool:
     """Check whether annotation coordinates lie inside slice coordinates.
     Args:
@@ -141,7 +232,7 @@ def process_coco_annotations(coco_annotation_list: List[CocoAnnotation], slice_b
 
 
 class SlicedImage:
-    def __init__(self, image, annotation, starting_pixel):
+    def __init__(self, image, annotation, starting_pixel, file_name=None, background=False):
         """
         image: np.array
             Sliced image.
@@ -149,10 +240,16 @@ class SlicedImage:
             Coco styled image object that belong to sliced image.
         starting_pixel: list of list of int
             Starting pixel coordinates of the sliced image.
+        file_name: str
+            File name of the sliced image export.
+        background: bool
+            Sampled background slice, exported regardless of its number of annotations.
         """
         self.image = image
         self.annotation = annotation
         self.starting_pixel = starting_pixel
+        self.file_name = file_name
+        self.background = background
 
 
 class SliceImageResult:
@@ -231,12 +328,71 @@ class SliceImageResult:
         """
         filenames = []
         for sliced_image in self._sliced_image_list:
-            filenames.append(sliced_image.coco_image.file_name)
+            filenames.append(sliced_image.file_name)
         return filenames
 
+    def statistics(self, nc: int = 5, min_annotations: int = 0) -> List[Dict]:
+        """Returns per-slice label statistics, the rows of the slice statistics table.
+        Args:
+            nc (int): Minimum number of classes in the class histogram, larger classes add columns. Default 5.
+            min_annotations (int): Slices with fewer annotations are skipped (i.e. pruned from export), unless they are
+                background slices. Default 0.
+        Returns:
+            statistics: a list of dicts with the slice file name, box count 'n', class histogram 'cls_0'...'cls_{nc-1}'
+                and the 'area_min', 'area_median' and 'area_max' of the boxes as a fraction of the slice area.
+        """
+        rows = []
+        for sliced_image in self._sliced_image_list:
+            if len(sliced_image.annotation) < min_annotations and not sliced_image.background:
+                continue
+            classes = np.array([int(i[0]) for i in sliced_image.annotation], dtype=np.int64)
+            areas = np.array([i[3] * i[4] for i in sliced_image.annotation], dtype=np.float64)
+            row = {"file_name": sliced_image.file_name, "n": len(classes)}
+            row.update({f"cls_{c}": int(k) for c, k in enumerate(np.bincount(classes, minlength=nc))})
+            row.update({
+                "area_min": areas.min() if len(areas) else 0.0,
+                "area_median": float(np.median(areas)) if len(areas) else 0.0,
+                "area_max": areas.max() if len(areas) else 0.0,
+            })
+            rows.append(row)
+        return rows
+
     def __len__(self):
         return len(self._sliced_image_list)
 
+STATISTICS_FILE = "slice_statistics.csv"
+
+def save_slice_statistics(statistics: List[Dict], directory: str) -> str:
+    """Write (or extend) the slice statistics table of a sliced dataset.
+    Args:
+        statistics (list(dict)): Rows as returned by `SliceImageResult.statistics`, extended with 'file' (image path
+            relative to the images directory without suffix), 'series' and 'parent'.
+        directory (str): Root directory of the sliced dataset.
+    Returns:
+        path (str): Path of the written table.
+    """
+    path = os.path.join(directory, STATISTICS_FILE)
+    table = pd.DataFrame(statistics)
+    if os.path.exists(path):
+        table = pd.concat([pd.read_csv(path), table]).drop_duplicates("file", keep="last")
+    cls_columns = sorted([i for i in table.columns if i.startswith("cls_")], key=lambda x: int(x[4:]))
+    table[cls_columns] = table[cls_columns].fillna(0).astype(np.int64)
+    columns = ["file", "series", "parent", "n"] + cls_columns + ["area_min", "area_median", "area_max"]
+    table[columns].to_csv(path, index=False)
+    return path
+
+def load_slice_statistics(directory: str) -> Optional[pd.DataFrame]:
+    """Load the slice statistics table of a sliced dataset.
+    Args:
+        directory (str): Root directory of the sliced dataset.
+    Returns:
+        table (pandas.DataFrame or None): One row per slice indexed by 'file', or None if the dataset has no table.
+    """
+    path = os.path.join(directory, STATISTICS_FILE)
+    if not os.path.exists(path):
+        return None
+    return pd.read_csv(path, dtype={"file": str, "series": str, "parent": str}).set_index("file")
+
 def read_yolo(path: str) -> List[Tuple]:
     if not os.path.exists(path):
         return []
@@ -251,6 +407,29 @@ def read_yolo(path: str) -> List[Tuple]:
 
     return yolo
 
+def yolo_to_text(yolo: List[Tuple]) -> str:
+    """Format pythonized YOLO annotations as the contents of a YOLO annotation file.
+    Args:
+        yolo (list(tuple)): an object containing YOLO style annotations as tuples (lines) nested in a list.
+    Returns:
+        text (str): One "class_id center_x center_y width height" line per annotation, without a trailing newline.
+    """
+    return "\n".join(" ".join(str(j) for j in i) for i in yolo)
+
+def encode_image(image: np.ndarray, ext: str = ".jpg") -> bytes:
+    """Encode an image array the same way exported slices are saved to disk.
+    Args:
+        image (np.ndarray): RGB image array.
+        ext (str): Image file extension determining the encoding. Default ".jpg".
+    Returns:
+        encoded (bytes): The encoded image file contents.
+    """
+    image_pil = read_image_as_pil(image)
+    buffer = io.BytesIO()
+    image_pil.save(buffer, format=Image.registered_extensions()[ext.lower()])
+    image_pil.close()
+    return buffer.getvalue()
+
 def yolo_to_coco(yolo: List[Tuple], width: int, height: int) -> List[CocoAnnotation]:
     """Convert a CocoAnnotation object to a pythonized YOLO annotation file.
     Args:
@@ -305,6 +484,9 @@ def slice_image(
     min_area_ratio: float = 0.1,
     out_ext: Optional[str] = ".jpg",
     min_out_slice_annotations: Optional[int] = None,
+    adaptive: bool = False,
+    background_ratio: float = 0.0,
+    seed: Optional[int] = None,
     verbose: bool = False,
 ) -> SliceImageResult:
     """Slice a large image into smaller windows. If output_file_name is given export
@@ -330,6 +512,11 @@ def slice_image(
         out_ext (str, optional): Extension of saved images. Default is the
             original suffix.
         min_out_slice_annotations (int, optional): Minimum number of output annotations before a slice is pruned from export.
+        adaptive (bool, optional): Place slices around the annotations with `get_adaptive_slice_bboxes` instead of
+            tiling the whole image. Default 'False'.
+        background_ratio (float, optional): Number of background slices sampled per annotated slice in adaptive mode,
+            background slices are exported regardless of 'min_out_slice_annotations'. Default 0.0.
+        seed (int, optional): Seed of the background slice sampling in adaptive mode.
         verbose (bool, optional): Switch to print relevant values to screen.
             Default 'False'.
     Returns:
@@ -355,8 +542,8 @@ def slice_image(
         if yolo_annotation is not None:
             Path(label_dst).mkdir(parents=True, exist_ok=True)
 
-    def export_single_slice(image: np.ndarray, annotation: Optional[List[Tuple]], slice_file_name: str):
-        if annotation is not None and len(annotation) < min_out_slice_annotations:
+    def export_single_slice(image: np.ndarray, annotation: Optional[List[Tuple]], slice_file_name: str, background: bool = False):
+        if annotation is not None and len(annotation) < min_out_slice_annotations and not background:
             return
         slice_file_name_base = re.sub(f"{out_ext}$", "", slice_file_name)
         ## Export image
@@ -374,9 +561,7 @@ def slice_image(
             if verbose:
                 print("Attempting to save annotation at", annotation_slice_file_path)
             with open(annotation_slice_file_path, "x") as f:
-                lines = [" ".join((str(j) for j in i)) for i in annotation]
-                lines[:-1] = [i + "\n" for i in lines[:-1]]
-                f.writelines(lines)
+                f.write(yolo_to_text(annotation))
             verboselog("sliced annotation path: " + annotation_slice_file_path)
 
     # read image
@@ -386,15 +571,6 @@ def slice_image(
     image_width, image_height = image_pil.size
     if not (image_width != 0 and image_height != 0):
         raise RuntimeError(f"invalid image size: {image_pil.size} for 'slice_image'.")
-    slice_bboxes = get_slice_bboxes(
-        image_height=image_height,
-        image_width=image_width,
-        auto_slice_resolution=auto_slice_resolution,
-        slice_height=slice_height,
-        slice_width=slice_width,
-        overlap_height_ratio=overlap_height_ratio,
-        overlap_width_ratio=overlap_width_ratio,
-    )
 
     if yolo_annotation is not None:
         annotations = read_yolo(yolo_annotation)
@@ -402,6 +578,35 @@ def slice_image(
         annotations = []
     # print(annotations)
 
+    if adaptive:
+        if not (slice_height and slice_width):
+            raise ValueError("Adaptive slicing requires slice width and height.")
+        boxes = np.array([[(x - w / 2) * image_width, (y - h / 2) * image_height, (x + w / 2) * image_width, (y + h / 2) * image_height] for _, x, y, w, h in annotations]).reshape(-1, 4)
+        object_bboxes, background_bboxes = get_adaptive_slice_bboxes(
+            image_height=image_height,
+            image_width=image_width,
+            boxes=boxes,
+            slice_height=slice_height,
+            slice_width=slice_width,
+            overlap_height_ratio=overlap_height_ratio or 0.0,
+            overlap_width_ratio=overlap_width_ratio or 0.0,
+            background_ratio=background_ratio,
+            seed=seed,
+        )
+        slice_bboxes = object_bboxes + background_bboxes
+        backgrounds = [False] * len(object_bboxes) + [True] * len(background_bboxes)
+    else:
+        slice_bboxes = get_slice_bboxes(
+            image_height=image_height,
+            image_width=image_width,
+            auto_slice_resolution=auto_slice_resolution,
+            slice_height=slice_height,
+            slice_width=slice_width,
+            overlap_height_ratio=overlap_height_ratio,
+            overlap_width_ratio=overlap_width_ratio,
+        )
+        backgrounds = [False] * len(slice_bboxes)
+
     if output_file_name and output_dir and len(annotations) < min_out_slice_annotations:
         if verbose:
             print("Too few bounding boxes in original image for any slices to possibly be exported! (" + yolo_annotation + ")")
@@ -415,7 +620,7 @@ def slice_image(
 
     image_pil_arr = np.asarray(image_pil)
     # iterate over slices
-    for slice_bbox in slice_bboxes:
+    for slice_bbox, background in zip(slice_bboxes, backgrounds):
         n_ims += 1
 
         # extract image
@@ -459,18 +664,23 @@ def slice_image(
 
         # create sliced image and append to sliced_image_result
         sliced_image = SlicedImage(
-            image=image_pil_slice, annotation=sliced_yolo_annotation_list, starting_pixel=[slice_bbox[0], slice_bbox[1]]
+            image=image_pil_slice,
+            annotation=sliced_yolo_annotation_list,
+            starting_pixel=[slice_bbox[0], slice_bbox[1]],
+            file_name=slice_file_name,
+            background=background,
         )
         sliced_image_result.add_sliced_image(sliced_image)
 
     # export slices if output directory is provided
     if output_file_name and output_dir:
-        for img, ann, file in zip(
+        for img, ann, file, background in zip(
             sliced_image_result.images,
             sliced_image_result.annotations if yolo_annotation is not None else None,
-            slice_file_names):
+            slice_file_names,
+            backgrounds):
             
-            export_single_slice(img, ann, file)
+            export_single_slice(img, ann, file, background)
         # conc_exec = concurrent.futures.ThreadPoolExecutor(max_workers=8)
         # conc_exec.map(
         #     export_single_slice,
@@ -0,0 +1,349 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Run a declarative grid or random search over train.py options, hyperparameters and dataset preprocessing
+
+Every run gets its own data.yaml and hyp.yaml, nothing shared is modified. Dataset variants (downscaling factor,
+slicing, ...) are preprocessed once into the sweep directory and shared by all runs using them, together with their
+labels caches. Runs are scheduled over a pool of processes, one device per process, and the final metrics of all runs
+are collected into <sweep>/results.csv.
+
+Usage:
+    $ python sweep.py --spec data/sweeps/experiment2.yaml --device 0,1
+    $ python sweep.py --spec data/sweeps/experiment2.yaml --device 0 --shard 1/2  # runs 1, 3, 5, ... on this machine
+    $ python sweep.py --spec data/sweeps/experiment2.yaml --collect  # results table only
+
+Spec:
+    name: experiment2  # sweep directory runs/sweep/<name>
+    method: grid  # grid or random
+    samples: 8  # number of random search runs
+    seed: 0  # random search seed
+    train: {epochs: 25, data: data/Flower.yaml, hyp: data/hyps/FlowerHyp.yaml}  # train.run() options of all runs
+    hyp: {fl_gamma: 0}  # hyperparameter overrides of all runs
+    dataset: {downscaling_factor: '4'}  # slicing/finalizeDataset.py options of all runs, omit to use the data as is
+    parameters:  # searched values, 'hyp.<key>' and 'dataset.<key>' select hyperparameters and dataset options
+      gamma: [0, 1, 2]  # list: grid values or random choice
+      dataset.downscaling_factor,anchors: [['2.5', 20], ['4.5', 10]]  # comma-joined keys take their values together
+      hyp.lr0: {loguniform: [1.0e-4, 1.0e-2]}  # random search only, also {uniform: [low, high]}
+    scheduler: {min_epochs: 2, reduction: 3}  # optional asynchronous successive halving, see ASHA
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from copy import deepcopy
+from pathlib import Path
+
+import pandas as pd
+import numpy as np
+import yaml
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+
+from utils.general import LOGGER, check_yaml, colorstr, print_args, yaml_save
+from utils.metrics import fitness
+
+METRICS = 'metrics/precision', 'metrics/recall', 'metrics/mAP_0.5', 'metrics/mAP_0.5:0.95'  # fitness() column order
+DEVICE = ''  # device of this pool process, set by init_worker()
+
+
+def sample_value(v, rng):
+    # Draw a random search value, v is a list of choices or {'uniform': [low, high]} or {'loguniform': [low, high]}
+    if isinstance(v, dict):
+        (kind, (low, high)), = v.items()
+        if kind == 'uniform':
+            return float(rng.uniform(low, high))
+        if kind == 'loguniform':
+            return float(math.exp(rng.uniform(math.log(low), math.log(high))))
+        raise ValueError(f'Unknown distribution {kind}, use uniform or loguniform')
+    return rng.choice(v)
+
+
+def expand_spec(spec):
+    # Return the list of run configs {'name', 'params', 'train', 'hyp', 'dataset'} of a sweep spec
+    parameters = spec.get('parameters', {})
+    if spec.get('method', 'grid') == 'grid':
+        assert all(isinstance(v, list) for v in parameters.values()), 'grid search parameters must be lists'
+        points = [dict(zip(parameters, x)) for x in itertools.product(*parameters.values())]
+    elif spec['method'] == 'random':
+        rng = random.Random(spec.get('seed', 0))
+        points = [{k: sample_value(v, rng) for k, v in parameters.items()} for _ in range(spec.get('samples', 8))]
+    else:
+        raise ValueError(f"Unknown sweep method {spec['method']}, use grid or random")
+
+    runs = []
+    for i, point in enumerate(points):
+        params = {}
+        for k, v in point.items():  # unpack comma-joined keys
+            keys = k.split(',')
+            params.update(zip(keys, v) if len(keys) > 1 else [(k, v)])
+        cfg = {
+            'params': params,
+            'train': deepcopy(spec.get('train', {})),
+            'hyp': deepcopy(spec.get('hyp', {})),
+            'dataset': deepcopy(spec['dataset']) if 'dataset' in spec else None}
+        for k, v in params.items():
+            group, _, key = k.rpartition('.')
+            if group == 'dataset':
+                assert cfg['dataset'] is not None, f'{k} requires a dataset section in the sweep spec'
+            cfg[group or 'train'][key] = v
+        label = '_'.join(f'{k.rpartition(".")[2]}{v:.3g}' if isinstance(v, float) else f'{k.rpartition(".")[2]}{v}'
+                         for k, v in params.items())
+        cfg['name'] = re.sub(r'[^\w-]', '', f'{i:03d}_{label}'.replace('.', 'dot'))
+        runs.append(cfg)
+    return runs
+
+
+def dataset_dir(dataset, sweep_dir):
+    # Return the directory of a preprocessed dataset variant, shared by all runs with the same dataset options
+    key = hashlib.sha256(json.dumps(dataset, sort_keys=True, default=str).encode()).hexdigest()[:8]
+    return sweep_dir / 'datasets' / key
+
+
+def prepare_dataset(dataset, sweep_dir):
+    # Preprocess a dataset variant with slicing/finalizeDataset.py unless it exists, returns its directory
+    d = dataset_dir(dataset, sweep_dir)
+    if not (d / 'dataset.yaml').is_file():
+        from slicing.finalizeDataset import main as finalize_dataset
+        LOGGER.info(f'{colorstr("sweep: ")}Preprocessing dataset {dataset} into {d}')
+        finalize_dataset(**{k: v if isinstance(v, (bool, list)) or v is None else str(v) for k, v in dataset.items()},
+                         output_directory=str(d))
+        yaml_save(d / 'dataset.yaml', dataset)  # written last, marks a complete dataset
+    return d
+
+
+def write_run_config(cfg, sweep_dir):
+    # Write the data.yaml and hyp.yaml of one run into its config directory, returns the train.run() options
+    d = sweep_dir / 'configs' / cfg['name']
+    d.mkdir(parents=True, exist_ok=True)
+    opt = deepcopy(cfg['train'])
+    with open(check_yaml(opt.get('hyp', ROOT / 'data/hyps/FlowerHyp.yaml')), errors='ignore') as f:
+        hyp = yaml.safe_load(f)
+    hyp.update(cfg['hyp'])
+    with open(check_yaml(opt.get('data', ROOT / 'data/Flower.yaml')), errors='ignore') as f:
+        data = yaml.safe_load(f)
+    if cfg['dataset'] is not None:  # point the run at its preprocessed dataset variant
+        data['path'] = str(dataset_dir(cfg['dataset'], sweep_dir).resolve())
+        data['train'] = 'Sliced' if cfg['dataset'].get('slice', True) in (True, 'True') else 'Reduced'
+    yaml_save(d / 'hyp.yaml', hyp)
+    yaml_save(d / 'data.yaml', data)
+    yaml_save(d / 'run.yaml', cfg)
+    opt.update(data=str(d / 'data.yaml'), hyp=str(d / 'hyp.yaml'), project=str(sweep_dir / 'runs'), name=cfg['name'],
+               exist_ok=True)
+    return opt
+
+
+class ASHA:
+    # Asynchronous successive halving, https://arxiv.org/abs/1810.05934. Runs report their best fitness at rung epochs
+    # min_epochs * reduction^k and are paused there unless they are in the top 1/reduction of the runs reported at that
+    # rung so far. Paused runs are promoted later, resuming from their last.pt, once enough worse runs have reported.
+    # Rung results are files in the sweep directory, so sweeps sharded over machines share one set of rungs.
+    def __init__(self, sweep_dir, min_epochs=1, reduction=3):
+        self.dir = Path(sweep_dir) / 'configs'
+        self.min_epochs = min_epochs
+        self.reduction = reduction
+
+    def rungs(self, epochs):
+        # Rung epochs of a run with an epochs budget, the full budget is not a rung
+        rungs, r = [], self.min_epochs
+        while r < epochs:
+            rungs.append(r)
+            r *= self.reduction
+        return rungs
+
+    def reported(self, name):
+        # {epochs: fitness} reported by run name
+        f = self.dir / name / 'rungs.json'
+        return {int(k): v for k, v in json.loads(f.read_text()).items()} if f.is_file() else {}
+
+    def report(self, name, epochs, fitness):
+        rungs = self.reported(name)
+        rungs[epochs] = fitness
+        f = self.dir / name / 'rungs.json'
+        tmp = f.with_name(f'{f.name}.{os.getpid()}.tmp')
+        tmp.write_text(json.dumps(rungs))
+        os.replace(tmp, f)  # atomic, other processes read rungs.json in promotable()
+
+    def promotable(self, name, epochs):
+        # Is run name in the top 1/reduction of all runs reported at rung epochs?
+        results = {f.parent.name: self.reported(f.parent.name).get(epochs) for f in self.dir.glob('*/rungs.json')}
+        results = {k: v for k, v in results.items() if v is not None}
+        return name in sorted(results, key=results.get, reverse=True)[:len(results) // self.reduction]
+
+    def promotion(self, paused):
+        # Return the paused run config to promote next, highest rung first, or None
+        rungs = {name: max(self.reported(name)) for name in paused}
+        for name in sorted(rungs, key=rungs.get, reverse=True):
+            if self.promotable(name, rungs[name]):
+                return paused[name]
+        return None
+
+    def register(self, callbacks, name, epochs):
+        # Pause run name at rungs where it is not promoted, through train.py's on_fit_epoch_end callback
+        rungs = set(self.rungs(epochs))
+
+        def on_fit_epoch_end(log_vals, epoch, best_fitness, fi):
+            if epoch + 1 in rungs:
+                self.report(name, epoch + 1, float(np.max(best_fitness)))
+                callbacks.stop_training = not self.promotable(name, epoch + 1)
+
+        callbacks.register_action('on_fit_epoch_end', name='asha', callback=on_fit_epoch_end)
+
+
+def run_status(cfg, sweep_dir):
+    # Return 'done', 'paused' or '' for a run that has not finished a job yet
+    f = sweep_dir / 'configs' / cfg['name'] / 'status'
+    return f.read_text() if f.is_file() else ''
+
+
+def init_worker(devices):
+    # Pin this pool process to the next free device
+    global DEVICE
+    DEVICE = devices.get()
+
+
+def train_run(cfg, sweep_dir, scheduler=None, resume=False):
+    # Train one run in a pool process until it finishes or the scheduler pauses it, returns its name and status
+    import train  # imported per process, so every run starts from a fresh CUDA context
+    from utils.callbacks import Callbacks
+    callbacks = Callbacks()
+    opt = write_run_config(cfg, sweep_dir)
+    opt.setdefault('device', DEVICE)
+    if scheduler:
+        scheduler.register(callbacks, cfg['name'], opt.get('epochs', 100))
+    if resume:  # continue a paused run from its last checkpoint, on this process' device
+        save_dir = sweep_dir / 'runs' / cfg['name']
+        with open(save_dir / 'opt.yaml', errors='ignore') as f:
+            d = yaml.safe_load(f)
+        d['device'] = opt['device']
+        yaml_save(save_dir / 'opt.yaml', d)
+        train.run(callbacks, resume=str(save_dir / 'weights' / 'last.pt'))
+    else:
+        train.run(callbacks, **opt)
+    status = 'paused' if callbacks.stop_training else 'done'
+    (sweep_dir / 'configs' / cfg['name'] / 'status').write_text(status)
+    return cfg['name'], status
+
+
+def collect_results(runs, sweep_dir):
+    # Collect the best epoch of every finished run into one table, saved to <sweep>/results.csv
+    rows = []
+    for cfg in runs:
+        f = sweep_dir / 'runs' / cfg['name'] / 'results.csv'
+        if not f.is_file():
+            continue
+        x = pd.read_csv(f)
+        x.columns = x.columns.str.strip()
+        fi = fitness(x[list(METRICS)].values)
+        best = int(fi.argmax())
+        rows.append({'name': cfg['name'], **cfg['params'], 'status': run_status(cfg, sweep_dir) or 'running',
+                     'epochs': len(x), 'best_epoch': int(x['epoch'][best]),
+                     'fitness': float(fi[best]), **x[list(METRICS)].iloc[best].to_dict()})
+    table = pd.DataFrame(rows)
+    if len(table):
+        table = table.sort_values('fitness', ascending=False)
+        table.to_csv(sweep_dir / 'results.csv', index=False)
+    return table
+
+
+def run(
+        spec=ROOT / 'data/sweeps/experiment2.yaml',  # sweep spec yaml
+        project=ROOT / 'runs/sweep',  # save to project/name
+        name='',  # sweep name, defaults to the spec name
+        device='',  # devices to run on, i.e. 0,1 or cpu, one run per device at a time
+        processes=0,  # pool processes, defaults to one per device
+        shard='1/1',  # run every n-th run starting at i on this machine, i/n
+        collect=False,  # only collect the results of finished runs
+):
+    with open(check_yaml(spec), errors='ignore') as f:
+        spec = yaml.safe_load(f)
+    sweep_dir = Path(project) / (name or spec.get('name', 'sweep'))
+    sweep_dir.mkdir(parents=True, exist_ok=True)
+    runs = expand_spec(spec)
+    yaml_save(sweep_dir / 'sweep.yaml', spec)
+
+    if not collect:
+        i, n = (int(x) for x in shard.split('/'))
+        runs_here = runs[i - 1::n]
+        todo = [cfg for cfg in runs_here if not run_status(cfg, sweep_dir)]
+        paused = {cfg['name']: cfg for cfg in runs_here if run_status(cfg, sweep_dir) == 'paused'}
+        for dataset in {json.dumps(cfg['dataset'], sort_keys=True) for cfg in todo if cfg['dataset'] is not None}:
+            prepare_dataset(json.loads(dataset), sweep_dir)  # once per dataset variant, before any run starts
+        scheduler = ASHA(sweep_dir, **spec['scheduler']) if spec.get('scheduler') else None
+
+        devices = [x.strip() for x in str(device).split(',')]
+        processes = processes or len(devices)
+        ctx = multiprocessing.get_context('spawn')  # CUDA can not be re-initialized in forked processes
+        queue = ctx.Manager().Queue()
+        for k in range(processes):
+            queue.put(devices[k % len(devices)])
+        LOGGER.info(f'{colorstr("sweep: ")}{len(todo)}/{len(runs)} runs on {processes} processes, saving to {sweep_dir}')
+        with ProcessPoolExecutor(processes, mp_context=ctx, initializer=init_worker, initargs=(queue,)) as pool:
+            running = {}  # future: run name
+            while True:
+                # Fill free processes, promoting paused runs before starting new ones
+                while len(running) < processes:
+                    cfg = scheduler.promotion(paused) if scheduler else None
+                    if cfg:
+                        del paused[cfg['name']]
+                        LOGGER.info(f'{colorstr("sweep: ")}{cfg["name"]} promoted')
+                        running[pool.submit(train_run, cfg, sweep_dir, scheduler, True)] = cfg['name']
+                    elif todo:
+                        cfg = todo.pop(0)
+                        running[pool.submit(train_run, cfg, sweep_dir, scheduler)] = cfg['name']
+                    else:
+                        break
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        _, status = future.result()
+                        LOGGER.info(f'{colorstr("sweep: ")}{name} {"paused" if status == "paused" else "finished"}')
+                        if status == 'paused':
+                            paused[name] = next(cfg for cfg in runs_here if cfg['name'] == name)
+                    except Exception as e:
+                        LOGGER.warning(f'{colorstr("sweep: ")}WARNING ⚠️ {name} failed: {e}')
+        if paused:
+            LOGGER.info(f'{colorstr("sweep: ")}{len(paused)} runs stopped early by successive halving')
+
+    table = collect_results(runs, sweep_dir)
+    LOGGER.info(f'{colorstr("sweep: ")}{len(table)}/{len(runs)} runs finished, results saved to {sweep_dir / "results.csv"}')
+    if len(table):
+        LOGGER.info(table.to_string(index=False))
+    return table
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spec', type=str, default=ROOT / 'data/sweeps/experiment2.yaml', help='sweep spec yaml path')
+    parser.add_argument('--project', default=ROOT / 'runs/sweep', help='save to project/name')
+    parser.add_argument('--name', default='', help='sweep name, defaults to the spec name')
+    parser.add_argument('--device', default='', help='cuda devices, i.e. 0,1 or cpu, one run per device at a time')
+    parser.add_argument('--processes', type=int, default=0, help='pool processes, defaults to one per device')
+    parser.add_argument('--shard', default='1/1', help='run every n-th run starting at i on this machine, i/n')
+    parser.add_argument('--collect', action='store_true', help='only collect the results of finished runs')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    run(**vars(opt))
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    main(opt)
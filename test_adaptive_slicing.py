@@ -0,0 +1,48 @@
+# Regression tests for slicing.slicing.get_adaptive_slice_bboxes
+# python -m pytest test_adaptive_slicing.py
+
+import numpy as np
+import pytest
+
+from slicing.slicing import get_adaptive_slice_bboxes
+
+H, W, S = 855, 1520, 640  # frame height, width and slice size
+
+
+def contained(box, slices, tol=0.5):
+    # Is the central slice-sized part of box, clipped to the frame, inside one of the slices?
+    c = (box[:2] + box[2:]) / 2
+    half = np.minimum(box[2:] - box[:2], S) / 2
+    core = np.clip(np.concatenate([c - half, c + half]), 0, [W, H, W, H])
+    return any((s[0] <= core[0] + tol) & (s[1] <= core[1] + tol) & (s[2] >= core[2] - tol) & (s[3] >= core[3] - tol)
+               for s in np.asarray(slices))
+
+
+@pytest.mark.parametrize('boxes', [
+    [[0, 100, 641, 300]],  # one pixel wider than a slice
+    [[0, 100, 640, 740]],  # exactly a slice
+    [[0, 0, W, H]],  # the whole frame
+    [[100, 50, 1400, 120], [300, 200, 320, 900]],  # wider and taller than a slice
+    [[-20, -20, 30, 30], [W - 30, H - 30, W + 20, H + 20]],  # crossing the frame corners
+    [[0, 0, 10, 10], [W - 10, 0, W, 10], [0, H - 10, 10, H], [W - 10, H - 10, W, H]],  # at the frame corners
+    [[W - 641, 0, W, H]],  # larger than a slice at the right edge
+])
+def test_large_and_edge_boxes(boxes):
+    boxes = np.array(boxes, dtype=np.float64)
+    slices, background = get_adaptive_slice_bboxes(H, W, boxes, S, S)
+    assert background == []
+    assert 0 < len(slices) <= len(boxes)
+    for s in slices:
+        assert s[2] - s[0] == S and s[3] - s[1] == S
+        assert 0 <= s[0] and 0 <= s[1] and s[2] <= W and s[3] <= H
+    for b in boxes:
+        assert contained(b, slices)
+
+
+def test_random_boxes():
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        xy = rng.uniform(-50, [W, H], (20, 2))
+        boxes = np.concatenate([xy, xy + rng.uniform(1, 900, (20, 2))], 1)
+        slices, _ = get_adaptive_slice_bboxes(H, W, boxes, S, S)
+        assert all(contained(b, slices) for b in boxes)
@@ -0,0 +1,72 @@
+# Checks and benchmarks utils.sliced.merge_detections against sahi's postprocessing of the same predictions
+# merge='nms' is sahi's NMSPostprocess, merge='nmm' its GreedyNMMPostprocess (sahi's default for sliced prediction)
+# python -m pytest test_merge_sahi.py
+# python test_merge_sahi.py  # timing
+
+import time
+
+import pytest
+import torch
+
+from utils.sliced import merge_detections
+
+sahi = pytest.importorskip('sahi')
+from sahi.postprocess.combine import GreedyNMMPostprocess, NMSPostprocess  # noqa: E402
+from sahi.prediction import ObjectPrediction  # noqa: E402
+
+POSTPROCESS = {'nms': NMSPostprocess, 'nmm': GreedyNMMPostprocess}
+
+
+def random_detections(n=300, nc=3, size=1000, seed=0):
+    # Random (n,6) [xyxy, conf, cls] detections in clusters of 5 around n/5 objects, as tiles of one frame predict them
+    g = torch.Generator().manual_seed(seed)
+    xy = torch.rand((n // 5, 2), generator=g).repeat_interleave(5, 0) * size
+    xy = (xy + torch.randn(xy.shape, generator=g) * 8).clamp(40)
+    wh = torch.rand(xy.shape, generator=g) * 60 + 10
+    conf = torch.rand((len(xy), 1), generator=g)
+    cls = torch.randint(0, nc, (len(xy), 1), generator=g).float()
+    return torch.cat((xy - wh / 2, xy + wh / 2, conf, cls), 1).double()
+
+
+def to_sahi(det):
+    return [
+        ObjectPrediction(bbox=d[:4].tolist(), category_id=int(d[5]), score=float(d[4]), category_name=str(int(d[5])))
+        for d in det]
+
+
+def from_sahi(predictions):
+    y = [[*p.bbox.to_xyxy(), p.score.value, p.category.id] for p in predictions]
+    return torch.tensor(y, dtype=torch.float64).reshape(-1, 6)
+
+
+def by_conf(det):
+    return det[det[:, 4].argsort(descending=True)]
+
+
+@pytest.mark.parametrize('method', ['nms', 'nmm'])
+@pytest.mark.parametrize('metric', ['iou', 'ios'])
+@pytest.mark.parametrize('agnostic', [False, True])
+def test_same_as_sahi(method, metric, agnostic):
+    for seed in range(10):
+        det = random_detections(seed=seed)
+        y = merge_detections(det.clone(), method, 0.5, agnostic, metric)
+        ys = POSTPROCESS[method](0.5, metric.upper(), agnostic)(to_sahi(det))
+        assert len(y) == len(ys)
+        torch.testing.assert_close(by_conf(y), by_conf(from_sahi(ys)), rtol=0, atol=1e-4)
+
+
+if __name__ == '__main__':
+    for n in 100, 1000, 5000:
+        det = random_detections(n)
+        predictions = to_sahi(det)
+        for method, metric in ('nms', 'iou'), ('nmm', 'iou'), ('nmm', 'ios'):
+            postprocess = POSTPROCESS[method](0.5, metric.upper(), False)
+            t = []
+            for f in lambda: merge_detections(det.float(), method, 0.5, False, metric), lambda: postprocess(predictions):
+                f()  # warmup
+                t0 = time.perf_counter()
+                for _ in range(3):
+                    f()
+                t.append((time.perf_counter() - t0) / 3 * 1E3)
+            print(f'{n:>5} detections {method} {metric}: merge_detections {t[0]:8.1f} ms, sahi {t[1]:8.1f} ms, '
+                  f'{t[1] / t[0]:.1f}x')
@@ -0,0 +1,94 @@
+# Checks and benchmarks utils.general.non_max_suppression against the per-image loop it replaced
+# python -m pytest test_nms.py
+# python test_nms.py  # timing
+
+import time
+
+import pytest
+import torch
+import torchvision
+
+from utils.general import non_max_suppression, xywh2xyxy
+
+
+def nms_per_image(prediction, conf_thres=0.25, iou_thres=0.45, agnostic=False, multi_label=False, max_det=300):
+    # Reference, the former per-image non_max_suppression() loop without its time limit
+    bs, nc = prediction.shape[0], prediction.shape[2] - 5
+    max_wh, max_nms = 7680, 30000
+    multi_label &= nc > 1
+    output = [torch.zeros((0, 6))] * bs
+    for xi, x in enumerate(prediction):
+        x = x[x[:, 4] > conf_thres].clone()
+        if not x.shape[0]:
+            continue
+        x[:, 5:] *= x[:, 4:5]
+        box = xywh2xyxy(x[:, :4])
+        if multi_label:
+            i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+            x = torch.cat((box[i], x[i, 5 + j, None], j[:, None].float()), 1)
+        else:
+            conf, j = x[:, 5:].max(1, keepdim=True)
+            x = torch.cat((box, conf, j.float()), 1)[conf.view(-1) > conf_thres]
+        if not x.shape[0]:
+            continue
+        x = x[x[:, 4].argsort(descending=True)[:max_nms]]
+        c = x[:, 5:6] * (0 if agnostic else max_wh)
+        i = torchvision.ops.nms(x[:, :4] + c, x[:, 4], iou_thres)[:max_det]
+        output[xi] = x[i]
+    return output
+
+
+def random_prediction(bs=8, n=2000, nc=4, lo=-100, hi=740, seed=0):
+    # Random (bs,n,5+nc) xywh predictions, box centers in [lo, hi) so boxes cross the image borders
+    g = torch.Generator().manual_seed(seed)
+    p = torch.rand((bs, n, 5 + nc), generator=g)
+    p[..., :2] = p[..., :2] * (hi - lo) + lo
+    p[..., 2:4] = p[..., 2:4] * 120 + 2
+    return p
+
+
+def assert_equal(a, b):
+    assert len(a) == len(b)
+    for x, y in zip(a, b):
+        assert torch.equal(x, y), f'{len(x)} vs {len(y)} detections'
+
+
+def test_negative_coordinates():
+    # A box at negative coordinates of image 1 must not suppress a box of image 0 after the image offset
+    p = torch.zeros((2, 1, 6))
+    p[0, 0] = torch.tensor([620, 620, 40, 40, 0.9, 1])
+    p[1, 0] = torch.tensor([-17.5, -17.5, 55, 55, 0.8, 1])
+    assert [len(x) for x in non_max_suppression(p)] == [1, 1]
+    assert_equal(non_max_suppression(p), nms_per_image(p))
+
+
+@pytest.mark.parametrize('n', [100, 2000])  # one batched call, per image calls
+@pytest.mark.parametrize('lo, hi', [(0, 640), (-100, 740), (-2000, -500)])
+@pytest.mark.parametrize('multi_label, agnostic', [(False, False), (True, False), (False, True)])
+def test_per_image_equal(n, lo, hi, multi_label, agnostic):
+    p = random_prediction(n=n, lo=lo, hi=hi, seed=n + lo)
+    kw = dict(conf_thres=0.25, iou_thres=0.45, multi_label=multi_label, agnostic=agnostic)
+    assert_equal(non_max_suppression(p.clone(), **kw), nms_per_image(p.clone(), **kw))
+
+
+def test_empty_images():
+    p = random_prediction(bs=4, n=200)
+    p[1::2, :, 4] = 0  # no candidates in images 1 and 3
+    assert_equal(non_max_suppression(p.clone()), nms_per_image(p.clone()))
+
+
+if __name__ == '__main__':
+    for bs, n in (1, 25200), (16, 25200), (32, 6300), (64, 1000):
+        p = random_prediction(bs=bs, n=n)
+        p[..., 4] **= 200  # few candidates above conf_thres, as in trained models
+        for f in non_max_suppression, nms_per_image:
+            f(p.clone(), 0.001, 0.6, multi_label=True)  # warmup
+        t = []
+        for f in non_max_suppression, nms_per_image:
+            t0 = time.perf_counter()
+            for _ in range(5):
+                f(p.clone(), 0.001, 0.6, multi_label=True)
+            t.append((time.perf_counter() - t0) / 5 * 1E3)
+        assert_equal(non_max_suppression(p.clone(), 0.001, 0.6, multi_label=True),
+                     nms_per_image(p.clone(), 0.001, 0.6, multi_label=True))
+        print(f'batch {bs:>3} x {n:>5} boxes: batched {t[0]:8.1f} ms, per image {t[1]:8.1f} ms, {t[1] / t[0]:.1f}x')
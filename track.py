@@ -11,9 +11,8 @@ from tracker.byte_tracker import BYTETracker
 from tracker.custom_utils import * # Custom utils for BYTETracker (Author: Asger Svenning)
 
 # Model modules
-from sahi.models.yolov5 import Yolov5DetectionModel
-from sahi.predict import get_sliced_prediction
-from sahi.postprocess.combine import NMSPostprocess
+from models.common import DetectMultiBackend
+from utils.sliced import merge_detections, predict_tiles, slice_frame
 
 # Image alignment module
 import imreg_dft as ird
@@ -22,6 +21,7 @@ import lodgepole.image_tools as lit
 # Extra modules
 import numpy as np
 import torch
+import yaml
 import os
 
 # Progress bar module
@@ -32,30 +32,44 @@ tracking_dir = "runs/tracking_v2/"
 # Path to the folder where the images are stored
 data_dir = "../Resized_dataset/"
 
+# Path to the model weights, any format supported by DetectMultiBackend (see export.py), e.g. YOLOFlower.pt,
+# YOLOFlower.onnx or YOLOFlower_openvino_model/. For the fastest CPU inference export a static batch of all tiles
+# of one frame, e.g. python export.py --weights YOLOFlower.pt --include onnx openvino --batch-size 6
+weights = "YOLOFlower.pt"
+# Number of CPU threads (intra-op, inter-op) used by the model runtime, 0 uses the runtime default
+threads = (0, 0)
+# Tile size and overlap ratio of the sliced inference
+tile_size, overlap = 640, .1
+# Minimum confidence of the raw detections, class-specific thresholds are applied afterwards
+confidence_threshold = 0.2
+# Optional class handler config from tune_thresholds.py, overrides the class handler and confidence threshold below
+class_config = None
+
 # Initialize torch device as cuda if available, otherwise use cpu (slow)
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-sahi_model = Yolov5DetectionModel(
-    model_path='YOLOFlower.pt', # Path to the model weights
-    confidence_threshold=0.2,
-    device=device,
-    category_mapping={
-        "0" : "Bud",
-        "1" : "Flower",
-        "2" : "Immature",
-        "3" : "Mature"
-    }
-)
+torch.set_grad_enabled(False) # Inference only
+model = DetectMultiBackend(weights, device=device, threads=threads)
+# Static exports take tile batches padded to their fixed batch size, other models take all tiles of a frame at once
+static_batch = getattr(model, "batch_size", None)
+names = model.names
 
 # Initialize the class handler, change the parameters if needed!
 cls_handler = Class_handler(classes = ["Bud", "Flower", "Immature", "Mature"],
                             colors = ["#1B9E77", "#D95F02", "#E7298A", "#66A61E"],
                             thresholds = [0.4, 0.4, 0.5, 0.5])
+if class_config is not None:
+    with open(class_config) as f:
+        class_config = yaml.safe_load(f)
+    cls_handler = Class_handler(**class_config["class_handler"])
+    confidence_threshold = class_config["confidence_threshold"]
+# Class-specific detection thresholds, indexed by the model class indices
+cls_thresholds = torch.tensor([cls_handler.cls_thresh[names[i]] for i in range(len(names))], device=model.device)
 
 # Initialize the tracker, change the parameters if needed!
 tracker = BYTETracker(DUMMY_args(track_thresh = 0.5, match_thresh = 0.05, track_buffer = 1000, mot20 = True, min_distance = 0.01))
 
-# Initialize the nonmax-suppression postprocessor, change the parameters if needed!
-postprocess = NMSPostprocess(match_threshold = 0.9)
+# Class-agnostic non-maximum suppression threshold of the merged tile predictions, change if needed!
+match_threshold = 0.9
 
 # Flag to enable/disable image alignment (recommended, but slow!)
 alignImages = True
@@ -81,30 +95,30 @@ with tqdm() as t:
                     except:
                         raise Exception("Image alignment failed", image.shape, last_image.shape)
                 w, h = image.shape[:2]
-                # Perform the object detection on the image using SAHI and the YOLOFlower model
-                raw_predictions = get_sliced_prediction(image, sahi_model, 
-                                                        640, 640, .1, .1, 
-                                                        perform_standard_pred=False,
-                                                        postprocess_type=None, 
-                                                        postprocess_match_threshold=0, 
-                                                        verbose=0)
-                
-                # Normalize the scores based on the class-specific detection thresholds
-                for obj in raw_predictions.object_prediction_list:
-                    obj.score.value = cls_handler.normalize_score(obj.category.name, obj.score.value)
+                # Perform the sliced object detection on the image with the YOLOFlower model, all tiles in one batch
+                tiles, slices = slice_frame(image, tile_size, overlap, bgr=False)
+                det = predict_tiles(model, tiles, slices, torch.zeros(len(tiles), dtype=torch.long), 1, model.device,
+                                    batch_size=static_batch or len(tiles),
+                                    conf_thres=confidence_threshold,
+                                    iou_thres=0.45,
+                                    max_det=1000,
+                                    merge="none",
+                                    static=static_batch is not None)[0]
                 
-                # Remove all objects with a score below the threshold
-                raw_predictions.object_prediction_list = [i for i in raw_predictions.object_prediction_list if i.score.value]
+                # Remove all objects with a score below the class-specific threshold and normalize the scores,
+                # such that threshold -> 0.5 and 1 -> 1 (see Class_handler.normalize_score)
+                det = det[det[:, 4] > cls_thresholds[det[:, 5].long()]]
+                det_thresholds = cls_thresholds[det[:, 5].long()]
+                det[:, 4] = 1/2 + (det[:, 4] - det_thresholds) / (2 * (1 - det_thresholds))
                 
-                # Perform non-maximum suppression on the predictions
-                raw_predictions.object_prediction_list = postprocess(raw_predictions.object_prediction_list)
+                # Perform class-agnostic non-maximum suppression on the predictions
+                det = merge_detections(det, "nms", match_threshold, agnostic=True)
                 
-                # Collect the predictions in a list of lists
-                array_predictions = [obj.bbox.to_xyxy() + [obj.score.value] for obj in raw_predictions.object_prediction_list]
-                classes = [obj.category.name for obj in raw_predictions.object_prediction_list]
+                # Collect the predictions in an array and the class names in a list
+                array_predictions = det[:, :5].cpu().numpy().astype(np.float64)
+                classes = [names[int(c)] for c in det[:, 5].tolist()]
                 classes_ind = [cls_handler.get_index(cls) for cls in classes]
                 
-                array_predictions = np.array(array_predictions, dtype = np.float64)
                 # Update the progress bar
                 series.num_detected(len(array_predictions))
                 
@@ -6,6 +6,7 @@ Models and datasets download automatically from the latest YOLOv5 release.
 Usage - Single-GPU training:
     $ python train.py --data coco128.yaml --weights yolov5s.pt --img 640  # from pretrained (recommended)
     $ python train.py --data coco128.yaml --weights '' --cfg yolov5s.yaml --img 640  # from scratch
+    $ python train.py --data Flower.yaml --weights '' --cfg yolov5n.yaml --teacher YOLOFlower.pt  # distillation
 
 Usage - Multi-GPU DDP training:
     $ python -m torch.distributed.run --nproc_per_node 4 --master_port 1 train.py --data coco128.yaml --weights yolov5s.pt --img 640 --device 0,1,2,3
@@ -28,9 +29,11 @@ from utils.general import (LOGGER, check_amp, check_dataset, check_file, check_g
                            one_cycle, print_args, print_mutation, strip_optimizer, yaml_save)
 from utils.downloads import attempt_download, is_url
 from utils.dataloaders import create_dataloader
+from utils.distill import AUGMENT_KEYS, ComputeDistillLoss, detect_inputs
 from utils.callbacks import Callbacks
 from utils.autobatch import check_train_batch_size
 from utils.autoanchor import check_anchors
+from utils.batch_augmentations import BatchAugment
 from models.yolo import Model
 from models.experimental import attempt_load
 import val as validate  # for end-of-epoch mAP
@@ -40,6 +43,7 @@ import os
 import random
 import sys
 import time
+from contextlib import nullcontext
 from copy import deepcopy
 from datetime import datetime
 from pathlib import Path
@@ -52,7 +56,7 @@ import yaml
 from torch.optim import lr_scheduler
 from tqdm import tqdm
 
-from slicing.dataset_splitting import create_dataset_flower, create_dataloader_from_dataset_flower, LoadFlower
+from slicing.dataset_splitting import create_dataset_flower, create_dataloader_from_dataset_flower, LoadFlower, LoadFlowerTiles
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[0]  # YOLOv5 root directory
@@ -146,6 +150,11 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
             LOGGER.info(f'freezing {k}')
             v.requires_grad = False
 
+    # Distillation
+    distill = None
+    if opt.teacher:
+        distill = ComputeDistillLoss(model, attempt_load(opt.teacher, device), hyp)  # student takes the teacher anchors
+
     # Image size
     gs = max(int(model.stride.max()), 32)  # grid size (max stride)
     imgsz = check_img_size(opt.imgsz, gs, floor=gs * 2)  # verify imgsz is gs-multiple
@@ -160,6 +169,8 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
     accumulate = max(round(nbs / batch_size), 1)  # accumulate loss before optimizing
     hyp['weight_decay'] *= batch_size * accumulate / nbs  # scale weight_decay
     optimizer = smart_optimizer(model, opt.optimizer, hyp['lr0'], hyp['momentum'], hyp['weight_decay'])
+    if distill:
+        optimizer.add_param_group({'params': distill.adapt.parameters(), 'weight_decay': hyp['weight_decay']})
 
     # Scheduler
     if opt.cos_lr:
@@ -197,24 +208,30 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
             batch_size // WORLD_SIZE,
             gs,
             hyp=hyp,
-            augment=True,
+            augment=not opt.batch_augment,  # --batch-augment moves train augmentation to the device
             cache=None if opt.cache == 'val' else opt.cache,
             rect=opt.rect,
             prefix=colorstr('train: '),
+            rank=LOCAL_RANK,
             num_files=dataset_size,
-            min_items=min_items
+            min_items=min_items,
+            crops=opt.random_crops,
+            nc=nc
         )
     
     if not gamma == 0:
         sample_weights = all_data.weights(gamma=gamma)
-        sample_weights = [len(sample_weights)/sum(sample_weights) *  i for i in sample_weights]
+        sample_weights *= len(sample_weights) / sample_weights.sum()  # mean weight 1
     else:
         sample_weights = None
     
     train_dataset, val_dataset, test_dataset = all_data.split_data(
             proportions=[80, 20, 0],
-            stratification_level=1
+            stratification_level=1,
+            seed=opt.seed
         )
+    if opt.random_crops:  # validate on the fixed slice grid of the val/test frames instead of new random crops
+        val_dataset, test_dataset = (LoadFlowerTiles(all_data, i.parent_indices) for i in (val_dataset, test_dataset))
         
     train_loader, val_loader, test_loader = (
         create_dataloader_from_dataset_flower(
@@ -247,8 +264,15 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
     #                                           quad=opt.quad,
     #                                           prefix=colorstr('train: '),
     #                                           shuffle=True)
+    if distill and opt.teacher_cache:  # cached teacher outputs are only valid if the training images are fixed
+        if opt.multi_scale or opt.random_crops or opt.batch_augment or any(hyp.get(k) for k in AUGMENT_KEYS) or \
+                getattr(all_data.albumentations, 'transform', None):
+            LOGGER.warning('WARNING ⚠️ --teacher-cache requires training without augmentation, not caching')
+        else:
+            distill.set_cache(opt.teacher_cache if isinstance(opt.teacher_cache, str) else save_dir / 'teacher')
+
     labels = np.concatenate(train_dataset.labels, 0)
-    mlc = int(labels[:, 0].max())  # max label class
+    mlc = int(train_dataset.class_counts.sum(0).nonzero()[0].max())  # max label class
     assert mlc < nc, f'Label class {mlc} exceeds nc={nc} in {data}. Possible class labels are 0-{nc - 1}'
 
     # Process 0
@@ -267,8 +291,10 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
         #                                prefix=colorstr('val: '))[0]
 
         if not resume:
-            if not opt.noautoanchor:
-                check_anchors(train_dataset, model=model, thr=hyp['anchor_t'], imgsz=imgsz)  # run AutoAnchor
+            if not opt.noautoanchor and not distill:  # distillation keeps the teacher anchors
+                # random crops keep the frame resolution, so labels are scaled to the frame size instead of imgsz
+                anchor_imgsz = int(train_dataset.shapes.max()) if opt.random_crops else imgsz
+                check_anchors(train_dataset, model=model, thr=hyp['anchor_t'], imgsz=anchor_imgsz)  # run AutoAnchor
             model.half().float()  # pre-reduce anchor precision
 
         callbacks.run('on_pretrain_routine_end', labels, names)
@@ -285,7 +311,8 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
     hyp['label_smoothing'] = opt.label_smoothing
     model.nc = nc  # attach number of classes to model
     model.hyp = hyp  # attach hyperparameters to model
-    model.class_weights = labels_to_class_weights(train_dataset.labels, nc).to(device) * nc  # attach class weights
+    model.class_weights = labels_to_class_weights(train_dataset.labels, nc,
+                                                  class_counts=train_dataset.class_counts).to(device) * nc  # attach class weights
     model.names = names
 
     # Start training
@@ -300,6 +327,7 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
     scaler = torch.cuda.amp.GradScaler(enabled=amp)
     stopper, stop = EarlyStopping(patience=opt.patience), False
     compute_loss = ComputeLoss(model, sample_weights, use_class_weights)  # init loss class
+    batch_augment = BatchAugment(hyp) if opt.batch_augment else None  # on-device mosaic, affine, mixup, hsv, flips
     callbacks.run('on_train_start')
     LOGGER.info(f'Image sizes {imgsz} train, {imgsz} val\n'
                 f'Using {train_loader.num_workers * WORLD_SIZE} dataloader workers\n'
@@ -313,7 +341,8 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
         # Update image weights (optional, single-GPU only)
         if opt.image_weights:
             cw = model.class_weights.cpu().numpy() * (1 - maps) ** 2 / nc  # class weights
-            iw = labels_to_image_weights(train_dataset.labels, nc=nc, class_weights=cw)  # image weights
+            iw = labels_to_image_weights(train_dataset.labels, nc=nc, class_weights=cw,
+                                         class_counts=train_dataset.class_counts)  # image weights
             train_dataset.indices = random.choices(range(train_dataset.n), weights=iw, k=train_dataset.n)  # rand weighted idx
 
         # Update mosaic border (optional)
@@ -321,6 +350,7 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
         # dataset.mosaic_border = [b - imgsz, -b]  # height, width borders
 
         mloss = torch.zeros(3, device=device)  # mean losses
+        mdloss = torch.zeros(3, device=device)  # mean distillation losses
         if RANK != -1:
             train_loader.sampler.set_epoch(epoch)
         pbar = enumerate(train_loader)
@@ -332,6 +362,9 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
             callbacks.run('on_train_batch_start')
             ni = i + nb * epoch  # number integrated batches (since train start)
             imgs = imgs.to(device, non_blocking=True).float() / 255  # uint8 to float32, 0-255 to 0.0-1.0
+            ind = ind.to(device, non_blocking=True)  # dataset indices for the sample weights
+            if batch_augment:
+                imgs, targets = batch_augment(imgs, targets.to(device, non_blocking=True))
 
             # Warmup
             if ni <= nw:
@@ -354,8 +387,13 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
 
             # Forward
             with torch.cuda.amp.autocast(amp):
-                pred = model(imgs)  # forward
+                with detect_inputs(model) if distill else nullcontext() as features:
+                    pred = model(imgs)  # forward
                 loss, loss_items = compute_loss(pred, targets.to(device), ind)  # loss scaled by batch_size
+                if distill:
+                    dloss, dloss_items = distill(imgs, pred, features, ind)  # teacher soft targets and features
+                    loss += dloss
+                    mdloss = (mdloss * i + dloss_items) / (i + 1)
                 if RANK != -1:
                     loss *= WORLD_SIZE  # gradient averaged between devices in DDP mode
                 if opt.quad:
@@ -385,10 +423,13 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
                 if callbacks.stop_training:
                     return
             # end batch ------------------------------------------------------------------------------------------------
+        if distill and RANK in {-1, 0}:
+            LOGGER.info(f"{colorstr('distill: ')}obj_loss {mdloss[0]:.4g}, cls_loss {mdloss[1]:.4g}, "
+                        f'feat_loss {mdloss[2]:.4g}')
 
         compute_loss.training = False
         # Scheduler
-        lr = [x['lr'] for x in optimizer.param_groups]  # for loggers
+        lr = [x['lr'] for x in optimizer.param_groups[:3]]  # for loggers, without the distillation group
         scheduler.step()
 
         if RANK in {-1, 0}:
@@ -440,10 +481,12 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
 
         # EarlyStopping
         if RANK != -1:  # if DDP training
-            broadcast_list = [stop if RANK == 0 else None]
+            broadcast_list = [(stop, callbacks.stop_training) if RANK == 0 else None]
             dist.broadcast_object_list(broadcast_list, 0)  # broadcast 'stop' to all ranks
             if RANK != 0:
-                stop = broadcast_list[0]
+                stop, callbacks.stop_training = broadcast_list[0]
+        if callbacks.stop_training:  # paused by a callback (i.e. a sweep scheduler), last.pt can be resumed
+            return results
         if stop:
             break  # must break all DDP ranks
 
@@ -530,12 +573,16 @@ def parse_opt(known=False):
     parser.add_argument('--dataset_size', type=int, default=None, help='Maximum number of images in dataset.')
     parser.add_argument('--deterministic', type=bool, default=True, help='Train the model deterministically?')
     parser.add_argument('--class_weights', type=bool, default=False, help='Use inverse class frequency weighted loss.')
+    parser.add_argument('--random-crops', action='store_true', help='train on random imgsz crops of full frames (e.g. Reduced) instead of slices')
+    parser.add_argument('--batch-augment', action='store_true', help='augment collated batches on the training device')
+    parser.add_argument('--teacher', type=str, default='', help='distill from this frozen teacher model.pt')
+    parser.add_argument('--teacher-cache', nargs='?', const=True, default=False, help='cache teacher outputs to dir')
 
     return parser.parse_known_args()[0] if known else parser.parse_args()
 
 
-def main(opt, callbacks=Callbacks()):
-    callbacks=Callbacks()
+def main(opt, callbacks=None):
+    callbacks = callbacks or Callbacks()  # fresh callbacks per run unless given
     
     # Checks
     if RANK in {-1, 0}:
@@ -681,12 +728,12 @@ def main(opt, callbacks=Callbacks()):
                     f'Usage example: $ python train.py --hyp {evolve_yaml}')
 
 
-def run(**kwargs):
+def run(callbacks=None, **kwargs):
     # Usage: import train; train.run(data='coco128.yaml', imgsz=320, weights='yolov5m.pt')
     opt = parse_opt(True)
     for k, v in kwargs.items():
         setattr(opt, k, v)
-    main(opt)
+    main(opt, callbacks)
     return opt
 
 
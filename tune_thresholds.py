@@ -0,0 +1,148 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Tune per-class confidence thresholds on the predictions and matches cached by val.py --save-matches
+
+All thresholds of all classes are evaluated at once from the cache, no inference is repeated. The objective is F1,
+F-beta or detection-level MOTA 1 - (FP + FN) / GT, which weighs every spurious and every missed detection as one
+tracking error. The best thresholds are written as Class_handler arguments for track.py, together with the lowest of
+them as the detector confidence threshold.
+
+Usage:
+    $ python val.py --data data/Flower.yaml --weights YOLOFlower.pt --task val --sliced --save-matches
+    $ python tune_thresholds.py --matches runs/val/exp/matches.npz --objective mota
+    $ python tune_thresholds.py --matches runs/val/exp/matches.npz --objective fbeta --beta 0.5 --iou 0.5
+
+Usage - track.py:
+    cls_handler = Class_handler(**yaml.safe_load(open('runs/val/exp/thresholds.yaml'))['class_handler'])
+"""
+
+import argparse
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+
+from utils.general import LOGGER, colorstr, print_args, yaml_save
+from utils.plots import colors
+
+OBJECTIVES = 'f1', 'fbeta', 'mota'
+
+
+def load_matches(file, iou=0.5):
+    # Return the (conf, cls, tp) predictions, per-class label counts and class names of a val.py matches.npz at IoU iou
+    x = np.load(file)
+    iouv, names = x['iouv'], x['names'].tolist()
+    j = int(np.abs(iouv - iou).argmin())  # IoU column
+    if not np.isclose(iouv[j], iou):
+        LOGGER.warning(f'WARNING ⚠️ IoU {iou} not in matches, using {iouv[j]:.2f}')
+    tp = np.unpackbits(x['correct'], axis=1, count=len(iouv))[:, j].astype(bool)
+    nt = np.bincount(x['tcls'], minlength=len(names))[:len(names)]
+    return x['conf'], x['cls'].astype(int), tp, nt, names
+
+
+def threshold_counts(conf, cls, tp, nt, thresholds):
+    # Return the TP and FP counts (nc, n) of every class at every threshold of an ascending uniform grid in [0, 1]
+    # A detection is kept if conf > threshold, as Class_handler.normalize_score() and track.py apply the thresholds
+    nc, n = len(nt), len(thresholds)
+    b = np.minimum(np.ceil(conf * (n - 1) - 1e-6).astype(int), n) - 1  # highest threshold kept, conf > thresholds[b]
+    i = (cls * n + b)[b >= 0]  # conf 0 is kept at no threshold
+    tp = tp[b >= 0]
+    tpc = np.bincount(i[tp], minlength=nc * n).reshape(nc, n)
+    fpc = np.bincount(i[~tp], minlength=nc * n).reshape(nc, n)
+    return tpc[:, ::-1].cumsum(1)[:, ::-1], fpc[:, ::-1].cumsum(1)[:, ::-1]  # reverse cumsum, conf > threshold
+
+
+def objective_scores(tp, fp, nt, objective='f1', beta=0.5, eps=1e-16):
+    # Return precision, recall and the objective of TP and FP counts (..., n) of classes with nt (..., 1) labels
+    p = tp / (tp + fp + eps)
+    r = tp / (nt + eps)
+    if objective == 'f1':
+        score = 2 * p * r / (p + r + eps)
+    elif objective == 'fbeta':
+        score = (1 + beta ** 2) * p * r / (beta ** 2 * p + r + eps)
+    elif objective == 'mota':
+        score = (tp - fp) / (nt + eps)  # 1 - (FP + FN) / GT
+    else:
+        raise ValueError(f'Unknown objective {objective}, use one of {OBJECTIVES}')
+    return p, r, score
+
+
+def run(
+        matches=ROOT / 'runs/val/exp/matches.npz',  # val.py --save-matches cache
+        objective='f1',  # f1, fbeta or mota
+        beta=0.5,  # fbeta recall weight, < 1 favours precision
+        iou=0.5,  # IoU threshold of a true positive
+        steps=1001,  # thresholds evaluated in [0, 1]
+        colors_=None,  # Class_handler colors, defaults to the plot palette
+        out='',  # output yaml, defaults to thresholds.yaml next to matches
+):
+    conf, cls, tp, nt, names = load_matches(matches, iou)
+    thresholds = np.linspace(0, 1, steps)
+    tpc, fpc = threshold_counts(conf, cls, tp, nt, thresholds)
+
+    # Best single threshold of all classes, then the best threshold of every class with labels
+    p, r, score = objective_scores(tpc.sum(0), fpc.sum(0), nt.sum(), objective, beta)
+    g = int(score.argmax())
+    pc, rc, scorec = objective_scores(tpc, fpc, nt[:, None], objective, beta)
+    k = np.where(nt > 0, scorec.argmax(1), g)  # classes without labels keep the global threshold
+    c = np.arange(len(nt))
+    best = thresholds[k]
+
+    # Print results
+    s = ('%22s' + '%11s' * 6) % ('Class', 'Labels', 'Threshold', 'P', 'R', objective, f'@{thresholds[g]:.3f}')
+    LOGGER.info(f'{colorstr("thresholds: ")}{len(conf)} predictions, IoU {iou}\n{s}')
+    pf = '%22s' + '%11i' + '%11.3g' * 5  # print format
+    LOGGER.info(pf % ('all', nt.sum(), thresholds[g], p[g], r[g], score[g], score[g]))
+    for i in c:
+        LOGGER.info(pf % (names[i], nt[i], best[i], pc[i, k[i]], rc[i, k[i]], scorec[i, k[i]], scorec[i, g]))
+    tp_, fp_ = tpc[c, k].sum(), fpc[c, k].sum()  # per-class thresholds combined
+    p_, r_, score_ = objective_scores(tp_, fp_, nt.sum(), objective, beta)
+    LOGGER.info(f'Per-class thresholds: P {p_:.3g}, R {r_:.3g}, {objective} {score_:.3g} '
+                f'(single threshold {thresholds[g]:.3f}: {score[g]:.3g})')
+
+    # Save Class_handler config
+    out = Path(out or Path(matches).with_name('thresholds.yaml'))
+    colors_ = colors_ or ['#%02X%02X%02X' % colors(i) for i in c]
+    assert len(colors_) == len(names), f'{len(colors_)} colors for {len(names)} classes'
+    cfg = {
+        'objective': objective,
+        'iou': iou,
+        'confidence_threshold': round(float(best.min()), 3),  # detector threshold, lowest class threshold
+        'cutoff': 'conf > threshold',  # detections kept strictly above their class threshold
+        'class_handler': {
+            'classes': names,
+            'colors': colors_,
+            'thresholds': [round(float(x), 3) for x in best]}}
+    yaml_save(out, cfg)
+    LOGGER.info(f'Class_handler config saved to {colorstr("bold", out)}')
+    return cfg
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--matches', type=str, default=ROOT / 'runs/val/exp/matches.npz', help='val.py matches.npz')
+    parser.add_argument('--objective', type=str, choices=OBJECTIVES, default='f1', help='optimized objective')
+    parser.add_argument('--beta', type=float, default=0.5, help='fbeta recall weight, < 1 favours precision')
+    parser.add_argument('--iou', type=float, default=0.5, help='IoU threshold of a true positive')
+    parser.add_argument('--steps', type=int, default=1001, help='thresholds evaluated in [0, 1]')
+    parser.add_argument('--colors', dest='colors_', nargs='+', type=str, help='Class_handler colors, i.e. #1B9E77')
+    parser.add_argument('--out', type=str, default='', help='output yaml, defaults to thresholds.yaml next to matches')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    run(**vars(opt))
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    main(opt)
@@ -0,0 +1,176 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Image arenas
+
+An image arena packs many decoded uint8 images into one flat file with an offset/shape index. Readers memory-map the
+file, so every dataloader worker and every DDP rank on a node shares a single copy of the images through the page cache.
+Arenas placed in /dev/shm live in shared memory (RAM) and are removed when the process that built them exits, arenas
+left behind by crashed processes are removed by remove_stale_arenas().
+
+Layout:
+    <stem>.arena  ← concatenated HWC uint8 images
+    <stem>.index  ← {'version', 'files', 'offsets': (n + 1,), 'shapes': (n, 3), 'hw0': (n, 2), 'pid'}, written last
+
+Usage:
+    from utils.arena import ImageArena, ImageArenaWriter, shm_path
+    with ImageArenaWriter(shm_path('images', 'datasets', nbytes), shapes, hw0, files) as w:
+        w.write(0, im)
+    im, hw0, hw = ImageArena(w.path).get(0)
+"""
+
+import atexit
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+ARENA_VERSION = 1  # arena index version
+SHM_DIR = Path('/dev/shm')  # shared memory file system, if available
+
+
+def shm_path(name, fallback, nbytes=0, safety_margin=0.1):
+    # Return an arena path in shared memory, or in directory fallback if there is no shared memory file system or it has
+    # not enough free space for nbytes, /dev/shm is usually limited to half of the RAM
+    shm = SHM_DIR.is_dir() and os.access(SHM_DIR, os.W_OK)
+    shm = shm and nbytes * (1 + safety_margin) < shutil.disk_usage(SHM_DIR).free
+    return (SHM_DIR if shm else Path(fallback)) / name
+
+
+def pid_alive(pid):
+    # Whether process pid is running
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # running, owned by another user
+        return True
+    return True
+
+
+def remove_stale_arenas(directory=SHM_DIR, prefix='yolov5_'):
+    # Delete the arenas and partial arena files in directory whose building process is no longer running, i.e. shared
+    # memory left behind by crashed runs. Returns the number of bytes freed
+    b = 0
+    for f in Path(directory).glob(f'{prefix}*'):
+        if f.suffix == '.tmp':  # <stem>.arena.<pid>.tmp, <stem>.index.<pid>.tmp
+            pid = int(f.suffixes[-2][1:]) if f.suffixes[-2][1:].isdigit() else None
+        elif f.suffix == '.index':
+            try:
+                pid = np.load(f, allow_pickle=True).item().get('pid')
+            except Exception:
+                pid = None  # unreadable
+        elif f.suffix == '.arena' and not f.with_suffix('.index').exists() and \
+                not any(f.parent.glob(f'{f.stem}.index.*.tmp')):  # data published, index neither published nor written
+            pid = None
+        else:
+            continue
+        if pid is None or not pid_alive(pid):
+            files = [f] if f.suffix == '.tmp' else arena_files(f.with_suffix(''))
+            for x in files:
+                try:
+                    b += x.stat().st_size
+                    x.unlink()
+                except OSError:  # removed by another process, or not ours to remove
+                    pass
+    return b
+
+
+def arena_files(path):
+    # Return the (data, index) files of arena path
+    path = Path(path)
+    return path.with_name(path.name + '.arena'), path.with_name(path.name + '.index')
+
+
+def remove_arena(path):
+    # Delete arena files, open memory maps stay valid until they are closed
+    for f in arena_files(path):
+        f.unlink(missing_ok=True)
+
+
+class ImageArenaWriter:
+    # Build an arena from planned image shapes, images may be written in any order and from several threads
+    def __init__(self, path, shapes, hw0, files):
+        self.path = Path(path)
+        self.shapes = np.asarray(shapes, dtype=np.int64).reshape(-1, 3)  # hwc
+        self.hw0 = np.asarray(hw0, dtype=np.int64).reshape(-1, 2)  # original hw
+        self.files = list(files)
+        self.offsets = np.concatenate(([0], np.cumsum(self.shapes.prod(1))))
+        self.data_file, self.index_file = arena_files(self.path)
+        self.tmp = self.data_file.with_name(f'{self.data_file.name}.{os.getpid()}.tmp')
+        self.data = np.memmap(self.tmp, dtype=np.uint8, mode='w+', shape=(max(int(self.offsets[-1]), 1),))
+
+    @property
+    def nbytes(self):
+        return int(self.offsets[-1])
+
+    def write(self, i, im):
+        # Store image i, its shape must match the planned shape
+        assert im.shape == tuple(self.shapes[i]), f'image {i} has shape {im.shape}, expected {tuple(self.shapes[i])}'
+        self.data[self.offsets[i]:self.offsets[i + 1]] = im.reshape(-1)
+
+    def close(self):
+        # Publish the arena, data first and index last so readers never attach to a partial arena
+        self.data.flush()
+        del self.data
+        os.replace(self.tmp, self.data_file)
+        tmp = self.index_file.with_name(f'{self.index_file.name}.{os.getpid()}.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, {
+                'version': ARENA_VERSION,
+                'files': self.files,
+                'offsets': self.offsets,
+                'shapes': self.shapes,
+                'hw0': self.hw0,
+                'pid': os.getpid()})  # builder, see remove_stale_arenas()
+        os.replace(tmp, self.index_file)
+
+    def abort(self):
+        # Discard a partially written arena
+        del self.data
+        self.tmp.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        self.abort() if exc_type else self.close()
+
+
+class ImageArena:
+    # Read-only random access to arena images through a memory map, safe to pickle into dataloader workers
+    def __init__(self, path):
+        self.path = Path(path)
+        self.data_file, self.index_file = arena_files(self.path)
+        index = np.load(self.index_file, allow_pickle=True).item()
+        assert index['version'] == ARENA_VERSION, f'Unsupported arena version {index["version"]} in {self.index_file}'
+        self.files, self.offsets, self.shapes, self.hw0 = index['files'], index['offsets'], index['shapes'], index['hw0']
+        self.map = None  # opened lazily per process
+
+    @staticmethod
+    def exists(path):
+        return all(f.is_file() for f in arena_files(path))
+
+    def remove_at_exit(self):
+        # Delete the arena files when this process exits, i.e. for shared memory arenas built by this process
+        atexit.register(remove_arena, self.path)
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['map'] = None  # memory map is re-opened in the receiving process
+        return state
+
+    def __len__(self):
+        return len(self.files)
+
+    @property
+    def nbytes(self):
+        return int(self.offsets[-1])
+
+    def get(self, i):
+        # Return image i as a read-only array view, with its original and stored hw like LoadImagesAndLabels.load_image()
+        if self.map is None:
+            self.map = np.memmap(self.data_file, dtype=np.uint8, mode='r')
+        im = self.map[self.offsets[i]:self.offsets[i + 1]].reshape(self.shapes[i])
+        return im, tuple(self.hw0[i].tolist()), im.shape[:2]
@@ -3,7 +3,9 @@
 AutoAnchor utils
 """
 
-import random
+import hashlib
+import math
+from pathlib import Path
 
 import numpy as np
 import torch
@@ -35,9 +37,7 @@ def check_anchors(dataset, model, thr=4.0, imgsz=640):
     wh = torch.tensor(np.concatenate([l[:, 3:5] * s for s, l in zip(shapes * scale, dataset.labels)])).float()  # wh
 
     def metric(k):  # compute metric
-        r = wh[:, None] / k[None]
-        x = torch.min(r, 1 / r).min(2)[0]  # ratio metric
-        best = x.max(1)[0]  # best_x
+        x, best = (y[0] for y in anchor_metric(torch.as_tensor(k, dtype=torch.float32)[None], wh))  # ratio metric, best_x
         aat = (x > 1 / thr).float().sum(1).mean()  # anchors above threshold
         bpr = (best > 1 / thr).float().mean()  # best possible recall
         return bpr, aat
@@ -64,7 +64,25 @@ def check_anchors(dataset, model, thr=4.0, imgsz=640):
         LOGGER.info(s)
 
 
-def kmean_anchors(dataset='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen=1000, verbose=True):
+def anchor_metric(k, wh):
+    # Ratio metric of label wh (m,2) to anchor sets k (p,n,2), min(r, 1/r) over w and h computed in log space
+    # Returns x (p,m,n) and best x (p,m)
+    lw, lk = wh.log(), k.log()
+    x = torch.exp(-torch.maximum((lw[:, 0, None] - lk[:, None, :, 0]).abs(), (lw[:, 1, None] - lk[:, None, :, 1]).abs()))
+    return x, x.max(2)[0]
+
+
+def anchor_fitness(k, wh, w, thr, batch=1 << 24):
+    # Fitness of a population of anchor sets k (p,n,2) on unique label wh (m,2) with counts w (m,), returns (p,)
+    chunk = max(1, batch // (len(wh) * k.shape[1]))  # anchor sets per chunk, bounds memory to batch elements
+    f = []
+    for kc in k.split(chunk):
+        best = anchor_metric(kc, wh)[1]
+        f.append((best * (best > thr).float()) @ w / w.sum())
+    return torch.cat(f)
+
+
+def kmean_anchors(dataset='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen=1000, verbose=True, pop=16, cache=True):
     """ Creates kmeans-evolved anchors from training dataset
 
         Arguments:
@@ -72,8 +90,10 @@ def kmean_anchors(dataset='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen
             n: number of anchors
             img_size: image size used for training
             thr: anchor-label wh ratio threshold hyperparameter hyp['anchor_t'] used for training, default=4.0
-            gen: generations to evolve anchors using genetic algorithm
+            gen: mutations to evaluate using genetic algorithm
             verbose: print all results
+            pop: mutations evaluated at once per generation
+            cache: reuse and save anchors in the dataset's *.anchors cache next to its labels cache
 
         Return:
             k: kmeans evolved anchors
@@ -85,20 +105,11 @@ def kmean_anchors(dataset='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen
 
     npr = np.random
     thr = 1 / thr
-
-    def metric(k, wh):  # compute metrics
-        r = wh[:, None] / k[None]
-        x = torch.min(r, 1 / r).min(2)[0]  # ratio metric
-        # x = wh_iou(wh, torch.tensor(k))  # iou metric
-        return x, x.max(1)[0]  # x, best_x
-
-    def anchor_fitness(k):  # mutation fitness
-        _, best = metric(torch.tensor(k, dtype=torch.float32), wh)
-        return (best * (best > thr).float()).mean()  # fitness
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
     def print_results(k, verbose=True):
         k = k[np.argsort(k.prod(1))]  # sort small to large
-        x, best = metric(k, wh0)
+        x, best = (y[0] for y in anchor_metric(torch.tensor(k, dtype=torch.float32)[None], wh0))
         bpr, aat = (best > thr).float().mean(), (x > thr).float().mean() * n  # best possible recall, anch > thr
         s = f'{PREFIX}thr={thr:.2f}: {bpr:.4f} best possible recall, {aat:.2f} anchors past thr\n' \
             f'{PREFIX}n={n}, img_size={img_size}, metric_all={x.mean():.3f}/{best.mean():.3f}-mean/best, ' \
@@ -119,6 +130,18 @@ def kmean_anchors(dataset='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen
     shapes = img_size * dataset.shapes / dataset.shapes.max(1, keepdims=True)
     wh0 = np.concatenate([l[:, 3:5] * s for s, l in zip(shapes, dataset.labels)])  # wh
 
+    # Cached anchors of identical labels and settings
+    key = hashlib.sha256(wh0.astype(np.float32).tobytes() + f'{n} {img_size} {thr} {gen} {pop}'.encode()).hexdigest()
+    cache_path = Path(dataset.cache_path).with_suffix('.anchors') if cache and hasattr(dataset, 'cache_path') else None
+    try:
+        anchors = np.load(cache_path, allow_pickle=True).item()
+    except Exception:
+        anchors = {}
+    if key in anchors:
+        LOGGER.info(f'{PREFIX}Using cached anchors from {cache_path}')
+        wh0 = torch.tensor(wh0, dtype=torch.float32)
+        return print_results(anchors[key]).astype(np.float32)
+
     # Filter
     i = (wh0 < 3.0).any(1).sum()
     if i:
@@ -136,7 +159,9 @@ def kmean_anchors(dataset='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen
     except Exception:
         LOGGER.warning(f'{PREFIX}WARNING ⚠️ switching strategies from kmeans to random init')
         k = np.sort(npr.rand(n * 2)).reshape(n, 2) * img_size  # random init
-    wh, wh0 = (torch.tensor(x, dtype=torch.float32) for x in (wh, wh0))
+    wh, counts = np.unique(wh, axis=0, return_counts=True)  # fitness of unique wh weighted by their counts
+    wh, w = torch.tensor(wh, device=device), torch.tensor(counts, dtype=torch.float32, device=device)
+    wh0 = torch.tensor(wh0, dtype=torch.float32)
     k = print_results(k, verbose=False)
 
     # Plot
@@ -151,19 +176,27 @@ def kmean_anchors(dataset='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen
     # ax[1].hist(wh[wh[:, 1]<100, 1],400)
     # fig.savefig('wh.png', dpi=200)
 
-    # Evolve
-    f, sh, mp, s = anchor_fitness(k), k.shape, 0.9, 0.1  # fitness, generations, mutation prob, sigma
-    pbar = tqdm(range(gen), bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}')  # progress bar
+    # Evolve, a population of pop mutations of the best anchors per generation
+    kt = torch.tensor(k, dtype=torch.float32, device=device)
+    f, sh, mp, s = anchor_fitness(kt[None], wh, w, thr)[0], (pop, *k.shape), 0.9, 0.1  # fitness, shape, prob, sigma
+    pbar = tqdm(range(math.ceil(gen / pop)), bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}')  # progress bar
     for _ in pbar:
-        v = np.ones(sh)
-        while (v == 1).all():  # mutate until a change occurs (prevent duplicates)
-            v = ((npr.random(sh) < mp) * random.random() * npr.randn(*sh) * s + 1).clip(0.3, 3.0)
-        kg = (k.copy() * v).clip(min=2.0)
-        fg = anchor_fitness(kg)
-        if fg > f:
-            f, k = fg, kg.copy()
+        v = ((npr.random(sh) < mp) * npr.random((pop, 1, 1)) * npr.randn(*sh) * s + 1).clip(0.3, 3.0)  # mutations
+        kg = (kt * torch.tensor(v, dtype=torch.float32, device=device)).clamp(min=2.0)
+        fg = anchor_fitness(kg, wh, w, thr)
+        i = int(fg.argmax())
+        if fg[i] > f:
+            f, kt = fg[i], kg[i]
             pbar.desc = f'{PREFIX}Evolving anchors with Genetic Algorithm: fitness = {f:.4f}'
             if verbose:
-                print_results(k, verbose)
-
-    return print_results(k).astype(np.float32)
+                print_results(kt.cpu().numpy(), verbose)
+
+    k = print_results(kt.cpu().numpy()).astype(np.float32)
+    if cache_path:
+        anchors[key] = k
+        try:
+            np.save(cache_path.with_suffix('.anchors.npy'), anchors)
+            cache_path.with_suffix('.anchors.npy').replace(cache_path)  # remove .npy suffix
+        except Exception as e:
+            LOGGER.warning(f'{PREFIX}WARNING ⚠️ Cache directory {cache_path.parent} is not writeable: {e}')
+    return k
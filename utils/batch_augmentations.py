@@ -0,0 +1,179 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Batched image augmentation
+
+Torch versions of the LoadImagesAndLabels train augmentations (mosaic, random_perspective, mixup, augment_hsv and flips)
+that run on a whole collated batch on the training device, so dataloader workers only decode and letterbox.
+
+Usage:
+    from utils.batch_augmentations import BatchAugment
+    augment = BatchAugment(hyp)
+    imgs, targets = augment(imgs, targets)  # imgs (b,3,h,w) RGB 0.0-1.0, targets (n,6) [image, class, xywh normalized]
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+FILL = 114 / 255  # letterbox/border fill value
+
+
+def rgb_to_hsv(x, eps=1e-8):
+    # RGB to HSV for (b,3,h,w) tensors in 0.0-1.0, hue in 0.0-1.0
+    r, g, b = x.unbind(1)
+    v, i = x.max(1)
+    delta = v - x.min(1)[0]
+    s = delta / (v + eps)
+    d = delta + eps
+    h = torch.where(i == 0, ((g - b) / d) % 6, torch.where(i == 1, (b - r) / d + 2, (r - g) / d + 4)) / 6
+    h = torch.where(delta > 0, h, torch.zeros_like(h))
+    return torch.stack((h, s, v), 1)
+
+
+def hsv_to_rgb(x):
+    # HSV to RGB for (b,3,h,w) tensors in 0.0-1.0
+    h, s, v = x.unbind(1)
+    h6 = (h % 1) * 6
+    i = h6.floor()
+    f = h6 - i
+    p, q, t = v * (1 - s), v * (1 - s * f), v * (1 - s * (1 - f))
+    i = i.long().unsqueeze(1) % 6
+    r = torch.stack((v, q, p, p, t, v), 1).gather(1, i)
+    g = torch.stack((t, v, v, q, p, p), 1).gather(1, i)
+    b = torch.stack((p, p, t, v, v, q), 1).gather(1, i)
+    return torch.cat((r, g, b), 1)
+
+
+def xywhn2xyxy_torch(x, w, h):
+    # Normalized xywh to pixel xyxy boxes, (n,4) tensor
+    return torch.stack((x[:, 0] - x[:, 2] / 2, x[:, 1] - x[:, 3] / 2, x[:, 0] + x[:, 2] / 2, x[:, 1] + x[:, 3] / 2), 1) * \
+        x.new_tensor([w, h, w, h])
+
+
+def xyxy2xywhn_torch(x, w, h, eps=1E-3):
+    # Pixel xyxy to normalized xywh boxes clipped to the image, (n,4) tensor
+    x = torch.stack((x[:, 0].clamp(0, w - eps), x[:, 1].clamp(0, h - eps), x[:, 2].clamp(0, w - eps),
+                     x[:, 3].clamp(0, h - eps)), 1)
+    return torch.stack(((x[:, 0] + x[:, 2]) / 2 / w, (x[:, 1] + x[:, 3]) / 2 / h, (x[:, 2] - x[:, 0]) / w,
+                        (x[:, 3] - x[:, 1]) / h), 1)
+
+
+def box_candidates_torch(box1, box2, wh_thr=2, ar_thr=100, area_thr=0.1, eps=1e-16):
+    # utils.augmentations.box_candidates() for (n,4) xyxy tensors
+    w1, h1 = box1[:, 2] - box1[:, 0], box1[:, 3] - box1[:, 1]
+    w2, h2 = box2[:, 2] - box2[:, 0], box2[:, 3] - box2[:, 1]
+    ar = torch.maximum(w2 / (h2 + eps), h2 / (w2 + eps))  # aspect ratio
+    return (w2 > wh_thr) & (h2 > wh_thr) & (w2 * h2 / (w1 * h1 + eps) > area_thr) & (ar < ar_thr)
+
+
+class BatchAugment:
+    # Batched YOLOv5 train augmentations, every image of the batch draws its own random parameters
+    def __init__(self, hyp):
+        self.hyp = hyp
+
+    def uniform(self, n, low, high, device):
+        return torch.rand(n, device=device) * (high - low) + low
+
+    def perspective_matrices(self, n, canvas, size, device):
+        # Random canvas to output homographies (n,3,3) like random_perspective(), canvas (n,) and size are square sides
+        hyp = self.hyp
+        eye = torch.eye(3, device=device).repeat(n, 1, 1)
+        C, P, R, S, T = eye.clone(), eye.clone(), eye.clone(), eye.clone(), eye.clone()
+        C[:, 0, 2] = C[:, 1, 2] = -canvas / 2  # center
+        P[:, 2, 0] = self.uniform(n, -hyp['perspective'], hyp['perspective'], device)  # x perspective (about y)
+        P[:, 2, 1] = self.uniform(n, -hyp['perspective'], hyp['perspective'], device)  # y perspective (about x)
+        a = self.uniform(n, -hyp['degrees'], hyp['degrees'], device) * math.pi / 180  # rotation
+        s = self.uniform(n, 1 - hyp['scale'], 1 + hyp['scale'], device)  # scale
+        R[:, 0, 0], R[:, 0, 1], R[:, 1, 0], R[:, 1, 1] = s * a.cos(), s * a.sin(), -s * a.sin(), s * a.cos()
+        S[:, 0, 1] = torch.tan(self.uniform(n, -hyp['shear'], hyp['shear'], device) * math.pi / 180)  # x shear
+        S[:, 1, 0] = torch.tan(self.uniform(n, -hyp['shear'], hyp['shear'], device) * math.pi / 180)  # y shear
+        T[:, 0, 2] = self.uniform(n, 0.5 - hyp['translate'], 0.5 + hyp['translate'], device) * size  # x translation
+        T[:, 1, 2] = self.uniform(n, 0.5 - hyp['translate'], 0.5 + hyp['translate'], device) * size  # y translation
+        return T @ S @ R @ P @ C, s  # order of operations (right to left) is IMPORTANT
+
+    def warp(self, imgs, sources, offsets, M):
+        # Sample the (b,3,s,s) output of homographies M from canvases composed of source images at pixel offsets,
+        # sources and offsets are lists of (b,) indices into imgs and (b,2) offsets, -1 marks unused sources
+        b, c, h, w = imgs.shape
+        y, x = torch.meshgrid(torch.arange(h, device=imgs.device, dtype=imgs.dtype),
+                              torch.arange(w, device=imgs.device, dtype=imgs.dtype), indexing='ij')
+        xy = torch.stack((x, y, torch.ones_like(x)), -1).view(1, -1, 3)  # output pixel coordinates
+        xy = xy @ torch.linalg.inv(M).transpose(1, 2)  # canvas coordinates
+        xy = xy[..., :2] / xy[..., 2:]
+        out = torch.full_like(imgs, FILL)
+        for src, offset in zip(sources, offsets):
+            grid = (xy - offset[:, None]) * xy.new_tensor([2 / w, 2 / h]) + xy.new_tensor([1 / w - 1, 1 / h - 1])
+            grid[src < 0] = 2  # outside, contributes nothing
+            out += F.grid_sample(imgs[src.clamp(0)] - FILL, grid.view(b, h, w, 2), align_corners=False)
+        return out
+
+    def targets(self, targets, sources, offsets, M, s, canvas, size):
+        # Move the targets of the source images onto their canvases and transform them with M, returns pixel xyxy
+        labels = []
+        for src, offset in zip(sources, offsets):
+            i, j = ((targets[:, 0][None] == src[:, None]) & (src[:, None] >= 0)).nonzero(as_tuple=True)  # image, target
+            boxes = xywhn2xyxy_torch(targets[j, 2:6], size, size) + offset[i].repeat(1, 2)
+            labels.append(torch.cat((i[:, None].to(boxes), targets[j, 1:2], boxes.clamp(0).minimum(canvas[i, None])), 1))
+        labels = torch.cat(labels, 0)
+        n, i = len(labels), labels[:, 0].long()
+
+        # Warp box corners, x1y1, x2y2, x1y2, x2y1
+        xy = torch.cat((labels[:, [2, 3, 4, 5, 2, 5, 4, 3]].view(n, 4, 2), labels.new_ones(n, 4, 1)), 2)
+        xy = xy @ M[i].transpose(1, 2)
+        xy = xy[..., :2] / xy[..., 2:]
+        new = torch.cat((xy.min(1)[0], xy.max(1)[0]), 1).clamp(0, size)
+
+        keep = box_candidates_torch(labels[:, 2:6] * s[i, None], new)
+        return torch.cat((labels[keep, :2], new[keep]), 1)
+
+    def __call__(self, imgs, targets):
+        # Augment images (b,3,s,s) RGB 0.0-1.0 and targets (n,6) [image, class, x, y, w, h] normalized
+        hyp, device = self.hyp, imgs.device
+        b, _, h, w = imgs.shape
+        assert h == w, f'BatchAugment requires square images, not {h}x{w}'
+        size = w
+        targets = targets.to(device)
+
+        # Mosaic canvases of 2x2 batch images around a random center, or the image itself
+        mosaic = torch.rand(b, device=device) < hyp['mosaic']
+        order = torch.rand(b, 4, device=device).argsort(1)  # random position of the image itself in its mosaic
+        sources = torch.randint(0, b, (b, 4), device=device)
+        sources = torch.where(order == 0, torch.arange(b, device=device)[:, None], sources)
+        sources = torch.where(mosaic[:, None] | (order == 0), sources, -1)
+        center = self.uniform(b * 2, size / 2, 3 * size / 2, device).view(b, 2)  # mosaic center x, y
+        center = torch.where(mosaic[:, None], center, torch.full_like(center, size))
+        quadrant = torch.tensor([[-1, -1], [0, -1], [-1, 0], [0, 0]], device=device) * size  # tl, tr, bl, br offsets
+        offsets = [torch.where(mosaic[:, None], center + quadrant[k], torch.zeros_like(center)) for k in range(4)]
+        sources = list(sources.T)
+
+        canvas = torch.where(mosaic, 2.0 * size, 1.0 * size)
+        M, s = self.perspective_matrices(b, canvas, size, device)
+        labels = self.targets(targets, sources, offsets, M, s, canvas, size)
+        imgs = self.warp(imgs, sources, offsets, M)
+
+        # MixUp of mosaics, https://arxiv.org/pdf/1710.09412.pdf
+        if hyp.get('mixup', 0):
+            mix = mosaic & (torch.rand(b, device=device) < hyp['mixup'])
+            partner = torch.where(mix, torch.randperm(b, device=device), -1)
+            r = torch.distributions.Beta(32.0, 32.0).sample((b,)).to(device)  # mixup ratio, alpha=beta=32.0
+            r = torch.where(mix, r, torch.ones_like(r)).view(b, 1, 1, 1)
+            imgs = imgs * r + imgs[partner.clamp(0)] * (1 - r)
+            i, j = ((labels[:, 0][None] == partner[:, None]) & (partner[:, None] >= 0)).nonzero(as_tuple=True)
+            labels = torch.cat((labels, torch.cat((i[:, None].to(labels), labels[j, 1:]), 1)), 0)
+
+        # HSV color-space
+        if hyp['hsv_h'] or hyp['hsv_s'] or hyp['hsv_v']:
+            r = (torch.rand(b, 3, device=device) * 2 - 1) * imgs.new_tensor([hyp['hsv_h'], hyp['hsv_s'], hyp['hsv_v']]) + 1
+            hsv = rgb_to_hsv(imgs.clamp(0, 1)) * r[..., None, None]
+            imgs = hsv_to_rgb(torch.cat((hsv[:, :1] % 1, hsv[:, 1:].clamp(0, 1)), 1))
+
+        # Flips
+        xywh = xyxy2xywhn_torch(labels[:, 2:6], size, size)
+        i = labels[:, 0].long()
+        for p, dim, k in ((hyp['flipud'], 2, 1), (hyp['fliplr'], 3, 0)):  # up-down, left-right
+            flip = torch.rand(b, device=device) < p
+            imgs = torch.where(flip.view(b, 1, 1, 1), imgs.flip(dim), imgs)
+            xywh[:, k] = torch.where(flip[i], 1 - xywh[:, k], xywh[:, k])
+
+        return imgs.contiguous(), torch.cat((labels[:, :2], xywh), 1)
@@ -6,6 +6,7 @@ Dataloaders and dataset utils
 import contextlib
 import glob
 import hashlib
+import io
 import json
 import math
 import os
@@ -33,6 +34,8 @@ from utils.augmentations import (Albumentations, augment_hsv, classify_albumenta
 from utils.general import (DATASETS_DIR, LOGGER, NUM_THREADS, check_dataset, check_requirements, check_yaml, clean_str,
                            colorstr, cv2, is_colab, is_kaggle, segments2boxes, unzip_file, xyn2xy, xywh2xyxy,
                            xywhn2xyxy, xyxy2xywhn)
+from utils.arena import SHM_DIR, ImageArena, ImageArenaWriter, remove_stale_arenas, shm_path
+from utils.shards import ShardReader, is_sharded, open_shards
 from utils.torch_utils import torch_distributed_zero_first
 
 # Parameters
@@ -337,6 +340,45 @@ class LoadImages:
         return self.nf  # number of files
 
 
+class LoadImageBatches(LoadImages, Dataset):
+    # YOLOv5 batched image dataset, i.e. `python detect.py --source path/ --batch-size 16`
+    def __init__(self, path, img_size=640, stride=32, transforms=None):
+        super().__init__(path, img_size=img_size, stride=stride, auto=False, transforms=transforms)  # equal shapes
+        assert not any(self.video_flag), 'Batched inference supports images only, use --batch-size 1 for videos'
+
+    def __getitem__(self, index):
+        path = self.files[index]
+        im0 = cv2.imread(path)  # BGR
+        assert im0 is not None, f'Image Not Found {path}'
+        if self.transforms:
+            im = self.transforms(im0)  # transforms
+        else:
+            im = letterbox(im0, self.img_size, stride=self.stride, auto=False)[0]  # padded resize
+            im = np.ascontiguousarray(im.transpose((2, 0, 1))[::-1])  # HWC to CHW, BGR to RGB
+            im = torch.from_numpy(im)
+        return im, torch.from_numpy(im0), path, f'image {index + 1}/{self.nf} {path}: '  # tensors use shared memory
+
+    @staticmethod
+    def collate_fn(batch):
+        # Returns images (n,3,h,w), original images [(h0,w0,3)] as numpy, paths and print strings
+        im, im0, path, s = zip(*batch)
+        return torch.stack(im, 0), [x.numpy() for x in im0], path, s
+
+
+def create_image_dataloader(path, imgsz=640, batch_size=16, stride=32, workers=8):
+    # Dataloader of image files decoded and letterboxed by worker processes, in file order
+    dataset = LoadImageBatches(path, img_size=imgsz, stride=stride)
+    batch_size = min(batch_size, len(dataset))
+    nw = min([os.cpu_count(), batch_size if batch_size > 1 else 0, workers])  # number of workers
+    return DataLoader(dataset,
+                      batch_size=batch_size,
+                      shuffle=False,
+                      num_workers=nw,
+                      pin_memory=PIN_MEMORY,
+                      collate_fn=LoadImageBatches.collate_fn,
+                      prefetch_factor=4 if nw else None), dataset
+
+
 class LoadStreams:
     # YOLOv5 streamloader, i.e. `python detect.py --source 'rtsp://example.com/media.mp4'  # RTSP, RTMP, HTTP streams`
     def __init__(self, sources='streams.txt', img_size=640, stride=32, auto=True, transforms=None, vid_stride=1):
@@ -430,7 +472,8 @@ def img2label_paths(img_paths):
 
 class LoadImagesAndLabels(Dataset):
     # YOLOv5 train_loader/val_loader, loads images and labels for training and validation
-    cache_version = 0.6  # dataset labels *.cache version
+    cache_version = 0.7  # dataset labels *.cache version
+    resize_on_load = True  # resize images to img_size in load_image(), False keeps the original resolution
     rand_interp_methods = [cv2.INTER_NEAREST, cv2.INTER_LINEAR, cv2.INTER_CUBIC, cv2.INTER_AREA, cv2.INTER_LANCZOS4]
 
     def __init__(self,
@@ -459,11 +502,16 @@ class LoadImagesAndLabels(Dataset):
         self.path = path
         self.albumentations = Albumentations(size=img_size) if augment else None
 
+        self.shards = None  # ShardReader if the dataset is packed into shards
         try:
             f = []  # image files
             for p in path if isinstance(path, list) else [path]:
                 p = Path(p)  # os-agnostic
-                if p.is_dir():  # dir
+                if p.is_dir() and is_sharded(p):  # packed shards
+                    assert self.shards is None, 'only one sharded dataset directory is supported per dataset'
+                    self.shards = ShardReader(p)
+                    f += self.shards.im_files()
+                elif p.is_dir():  # dir
                     f += glob.glob(str(p / 'images' /  '**' / '*.*'), recursive=True)
                     # f = list(p.rglob('*.*'))  # pathlib
                 elif p.is_file():  # file
@@ -485,13 +533,12 @@ class LoadImagesAndLabels(Dataset):
         
         # Check cache
         self.label_files = img2label_paths(self.im_files)  # labels
-        cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')
-        try:
-            cache, exists = np.load(cache_path, allow_pickle=True).item(), True  # load dict
-            assert cache['version'] == self.cache_version  # matches current version
-            assert cache['hash'] == get_hash(self.label_files + self.im_files)  # identical hash
-        except Exception:
-            cache, exists = self.cache_labels(cache_path, prefix), False  # run cache ops
+        if self.shards:
+            cache_path = self.shards.index_path.with_suffix('.cache')
+        else:
+            cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')
+        self.cache_path = cache_path  # labels *.cache path, derived caches are stored next to it
+        cache, exists = self.cache_labels(cache_path, prefix)  # verifies new and changed files only
 
         # Display cache
         nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupt, total
@@ -503,7 +550,7 @@ class LoadImagesAndLabels(Dataset):
         assert nf > 0 or not augment, f'{prefix}No labels found in {cache_path}, can not start training. {HELP_URL}'
 
         # Read cache
-        [cache.pop(k) for k in ('hash', 'version', 'msgs')]  # remove items
+        cache.pop('msgs')  # remove items
         labels, shapes, self.segments = zip(*cache.values())
         nl = len(np.concatenate(labels, 0))  # number of labels
         assert nl > 0 or not augment, f'{prefix}All labels empty in {cache_path}, can not start training. {HELP_URL}'
@@ -570,34 +617,20 @@ class LoadImagesAndLabels(Dataset):
             self.batch_shapes = np.ceil(np.array(shapes) * img_size / stride + pad).astype(int) * stride
 
         # Cache images into RAM/disk for faster training
-        if cache_images == 'ram' and not self.check_cache_ram(prefix=prefix):
-            cache_images = False
-        self.ims = [None] * n
-        self.npy_files = [Path(f).with_suffix('.npy') for f in self.im_files]
-        if cache_images:
-            b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
-            self.im_hw0, self.im_hw = [None] * n, [None] * n
-            fcn = self.cache_images_to_disk if cache_images == 'disk' else self.load_image
-            results = ThreadPool(NUM_THREADS).imap(fcn, range(n))
-            pbar = tqdm(enumerate(results), total=n, bar_format=BAR_FORMAT, disable=LOCAL_RANK > 0)
-            for i, x in pbar:
-                if cache_images == 'disk':
-                    b += self.npy_files[i].stat().st_size
-                else:  # 'ram'
-                    self.ims[i], self.im_hw0[i], self.im_hw[i] = x  # im, hw_orig, hw_resized = load_image(self, i)
-                    b += self.ims[i].nbytes
-                pbar.desc = f'{prefix}Caching images ({b / gb:.1f}GB {cache_images})'
-            pbar.close()
+        self.arena = None  # resized image cache, see utils/arena.py
+        if cache_images in ('ram', 'disk'):
+            self.arena = self.cache_images_to_arena(cache_images, prefix=prefix)
 
-    def check_cache_ram(self, safety_margin=0.1, prefix=''):
+    def check_cache_ram(self, safety_margin=0.1, prefix='', mem_required=None):
         # Check image caching requirements vs available memory
         b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
-        n = min(self.n, 30)  # extrapolate from 30 random images
-        for _ in range(n):
-            im = cv2.imread(random.choice(self.im_files))  # sample image
-            ratio = self.img_size / max(im.shape[0], im.shape[1])  # max(h, w)  # ratio
-            b += im.nbytes * ratio ** 2
-        mem_required = b * self.n / n  # GB required to cache dataset into RAM
+        if mem_required is None:  # estimate
+            n = min(self.n, 30)  # extrapolate from 30 random images
+            for _ in range(n):
+                im = self.imread(random.choice(self.im_files))  # sample image
+                ratio = self.img_size / max(im.shape[0], im.shape[1]) if self.resize_on_load else 1  # max(h, w)  # ratio
+                b += im.nbytes * ratio ** 2
+            mem_required = b * self.n / n  # GB required to cache dataset into RAM
         mem = psutil.virtual_memory()
         cache = mem_required * (1 + safety_margin) < mem.available  # to cache or not to cache, that is the question
         if not cache:
@@ -606,43 +639,185 @@ class LoadImagesAndLabels(Dataset):
                         f"{'caching images ✅' if cache else 'not caching images ⚠️'}")
         return cache
 
+    def cache_images_to_arena(self, cache='ram', prefix=''):
+        # Cache resized images into one memory-mapped arena, built by the first process and attached by all dataloader
+        # workers and DDP ranks. 'ram' arenas live in shared memory for the duration of the run (next to the labels
+        # cache if shared memory is too small), 'disk' arenas are kept next to the labels cache and reused by later runs.
+        # Returns the ImageArena, or None if the images do not fit
+        key = hashlib.sha256(f'{self.get_hash()}{self.img_size}{self.augment}{self.resize_on_load}'.encode()).hexdigest()
+        if cache == 'ram':
+            name = f'yolov5_{key[:16]}'
+            b = sum(remove_stale_arenas(d) for d in (SHM_DIR, self.cache_path.parent))  # left behind by crashed runs
+            if b:
+                LOGGER.info(f'{prefix}Removed {b / (1 << 30):.1f}GB of stale cached images')
+            paths = SHM_DIR / name, self.cache_path.parent / name  # built by another process, in either location
+        else:  # 'disk'
+            paths = self.cache_path.with_name(f'{self.cache_path.stem}.{self.img_size}.{key[:8]}'),
+        for path in paths:
+            if ImageArena.exists(path):
+                arena = ImageArena(path)
+                if arena.files == self.im_files:
+                    LOGGER.info(f'{prefix}Attached to cached images ({arena.nbytes / (1 << 30):.1f}GB {cache}) '
+                                f'in {path}')
+                    return arena
+
+        # Plan the resized shapes from the label cache shapes, as in load_image()
+        hw0 = self.shapes[:, ::-1].astype(np.int64)  # original hw
+        r = self.img_size / hw0.max(1, keepdims=True) if self.resize_on_load else np.ones((self.n, 1))  # ratio
+        shapes = np.concatenate((np.where(r != 1, (hw0 * r).astype(np.int64), hw0), np.full((self.n, 1), 3)), 1)  # hwc
+        mem_required = int(shapes.prod(1).sum())
+        if cache == 'ram':
+            if not self.check_cache_ram(prefix=prefix, mem_required=mem_required):
+                return None
+            path = shm_path(name, self.cache_path.parent, mem_required)
+            if path.parent != SHM_DIR:
+                LOGGER.info(f'{prefix}{mem_required / (1 << 30):.1f}GB do not fit in {SHM_DIR}, caching images in '
+                            f'{path.parent} for this run')
+        if mem_required * 1.1 > shutil.disk_usage(path.parent).free:
+            LOGGER.warning(f'{prefix}WARNING ⚠️ {mem_required / (1 << 30):.1f}GB disk space required in {path.parent}, '
+                           f'not caching images')
+            return None
+
+        b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
+        try:
+            writer = ImageArenaWriter(path, shapes, hw0, self.im_files)
+        except OSError as e:
+            LOGGER.warning(f'{prefix}WARNING ⚠️ Cache directory {path.parent} is not writeable: {e}')  # not writeable
+            return None
+        with writer:
+            results = ThreadPool(NUM_THREADS).imap(self.load_image, range(self.n))
+            pbar = tqdm(enumerate(results), total=self.n, bar_format=BAR_FORMAT, disable=LOCAL_RANK > 0)
+            for i, (im, _, _) in pbar:
+                writer.write(i, im)
+                b += im.nbytes
+                pbar.desc = f'{prefix}Caching images ({b / gb:.1f}GB {cache})'
+            pbar.close()
+        arena = ImageArena(path)
+        return arena.remove_at_exit() if cache == 'ram' else arena
+
     def cache_labels(self, path=Path('./labels.cache'), prefix=''):
-        # Cache dataset labels, check images and read shapes
-        x = {}  # dict
-        nm, nf, ne, nc, msgs = 0, 0, 0, 0, []  # number missing, found, empty, corrupt, messages
-        desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels..."
-        with Pool(NUM_THREADS) as pool:
-            pbar = tqdm(pool.imap(verify_image_label, zip(self.im_files, self.label_files, repeat(prefix))),
-                        desc=desc,
-                        total=len(self.im_files),
-                        bar_format=BAR_FORMAT)
-            for im_file, lb, shape, segments, nm_f, nf_f, ne_f, nc_f, msg in pbar:
-                nm += nm_f
-                nf += nf_f
-                ne += ne_f
-                nc += nc_f
-                if im_file:
-                    x[im_file] = [lb, shape, segments]
-                if msg:
-                    msgs.append(msg)
-                pbar.desc = f"{desc}{nf} found, {nm} missing, {ne} empty, {nc} corrupt"
-
-        pbar.close()
-        if msgs:
-            LOGGER.info('\n'.join(msgs))
-        if nf == 0:
-            LOGGER.warning(f'{prefix}WARNING ⚠️ No labels found in {path}. {HELP_URL}')
-        x['hash'] = get_hash(self.label_files + self.im_files)
+        # Cache dataset labels, check images and read shapes. Cache entries are stamped with the size and mtime of their
+        # image and label files (or their shard record), only new or changed files are verified and merged into the cache.
+        # Returns ({im_file: [labels, shape, segments], 'results', 'msgs'}, whether no file needed verification)
+        stamps = self.file_stamps()
+        cache = self.load_label_cache(path)
+        index = {f: i for i, f in enumerate(cache['files'])}
+        j = np.array([index.get(f, -1) for f in self.im_files], dtype=np.int64)  # cache entry of each file, -1 if new
+        reuse = j >= 0
+        reuse[reuse] = (cache['stamps'][j[reuse]] == stamps[reuse]).all(1)
+
+        # Verify new and changed files
+        todo = (~reuse).nonzero()[0]
+        entries = {}  # im_file: (labels, shape, segments, status, msg)
+        if len(todo):
+            nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, corrupt
+            desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels..."
+            with Pool(NUM_THREADS) as pool:
+                pbar = tqdm(pool.imap(verify_image_label,
+                                      zip([self.im_files[i] for i in todo], [self.label_files[i] for i in todo],
+                                          repeat(prefix), repeat(self.shards and self.shards.stamp))),
+                            desc=desc,
+                            total=len(todo),
+                            bar_format=BAR_FORMAT)
+                for i, (im_file, lb, shape, segments, nm_f, nf_f, ne_f, nc_f, msg) in zip(todo, pbar):
+                    nm += nm_f
+                    nf += nf_f
+                    ne += ne_f
+                    nc += nc_f
+                    if im_file is None:  # corrupt, remembered so it is not verified again until it changes
+                        lb, shape, segments = np.zeros((0, 5), dtype=np.float32), (0, 0), []
+                    entries[self.im_files[i]] = lb, shape, segments, (nm_f, nf_f, ne_f, nc_f), msg
+                    pbar.desc = f"{desc}{nf} found, {nm} missing, {ne} empty, {nc} corrupt"
+            pbar.close()
+            msgs = [e[4] for e in entries.values() if e[4]]
+            if msgs:
+                LOGGER.info('\n'.join(msgs))
+
+            # Merge into the cache, keeping entries of files that are not part of this dataset
+            keep = np.ones(len(cache['files']), dtype=bool)
+            keep[j[j >= 0]] = False
+            keep[j[reuse]] = True
+            old = keep.nonzero()[0]
+            files = [cache['files'][i] for i in old] + list(entries)
+            n_old = np.diff(cache['offsets'])[old]
+            new_labels = [e[0] for e in entries.values()]
+            x = {
+                'version': self.cache_version,
+                'files': files,
+                'stamps': np.concatenate((cache['stamps'][old], stamps[todo]), 0),
+                'shapes': np.concatenate((cache['shapes'][old], np.array([e[1] for e in entries.values()],
+                                                                           dtype=np.int64).reshape(-1, 2)), 0),
+                'status': np.concatenate((cache['status'][old], np.array([e[3] for e in entries.values()],
+                                                                           dtype=np.uint8).reshape(-1, 4)), 0),
+                'offsets': np.concatenate(([0], np.cumsum(np.concatenate((n_old, [len(lb) for lb in new_labels]))))),
+                'labels': np.concatenate([cache['labels'][cache['offsets'][i]:cache['offsets'][i + 1]] for i in old] +
+                                         new_labels + [np.zeros((0, 5), dtype=np.float32)], 0),
+                'segments': {f: cache['segments'][f] for f in files if f in cache['segments'] and f not in entries},
+                'msgs': {f: cache['msgs'][f] for f in files if f in cache['msgs'] and f not in entries}}
+            x['segments'].update({f: e[2] for f, e in entries.items() if e[2]})
+            x['msgs'].update({f: e[4] for f, e in entries.items() if e[4]})
+            if x['status'][:, 1].sum() == 0:
+                LOGGER.warning(f'{prefix}WARNING ⚠️ No labels found in {path}. {HELP_URL}')
+            self.save_label_cache(path, x, prefix)
+            cache = x
+            index = {f: i for i, f in enumerate(files)}
+            j = np.array([index[f] for f in self.im_files], dtype=np.int64)
+
+        # Gather this dataset's entries from the packed cache, dropping corrupt files
+        status = cache['status'][j].astype(np.int64)
+        labels, offsets, segments = cache['labels'], cache['offsets'], cache['segments']
+        x = {self.im_files[k]: [labels[offsets[i]:offsets[i + 1]], cache['shapes'][i], segments.get(self.im_files[k], [])]
+             for k, i in enumerate(j) if not status[k, 3]}
+        nm, nf, ne, nc = status.sum(0).tolist()
         x['results'] = nf, nm, ne, nc, len(self.im_files)
-        x['msgs'] = msgs  # warnings
-        x['version'] = self.cache_version  # cache version
+        x['msgs'] = [cache['msgs'][f] for f in self.im_files if f in cache['msgs']]  # warnings
+        return x, not len(todo)
+
+    def file_stamps(self):
+        # Returns (n, 5) int64 stamps identifying the current version of each image-label pair, i.e. the size and mtime
+        # of the image and label files (-1 if missing), or the shard record of sharded datasets
+        if self.shards:
+            return np.array([self.shards.record(f) for f in self.im_files], dtype=np.int64).reshape(-1, 5)
+        stamps = ThreadPool(NUM_THREADS).map(file_stamp, zip(self.im_files, self.label_files), chunksize=256)
+        return np.array(stamps, dtype=np.int64).reshape(-1, 5)
+
+    def load_label_cache(self, path):
+        # Returns the labels cache at path, or an empty cache if it is missing or has another version
+        try:
+            cache = np.load(path, allow_pickle=True).item()  # load dict
+            assert cache['version'] == self.cache_version  # matches current version
+            return cache
+        except Exception:
+            return {
+                'version': self.cache_version,
+                'files': [],
+                'stamps': np.zeros((0, 5), dtype=np.int64),
+                'shapes': np.zeros((0, 2), dtype=np.int64),
+                'status': np.zeros((0, 4), dtype=np.uint8),
+                'offsets': np.zeros(1, dtype=np.int64),
+                'labels': np.zeros((0, 5), dtype=np.float32),
+                'segments': {},
+                'msgs': {}}
+
+    @staticmethod
+    def save_label_cache(path, x, prefix=''):
+        # Save labels cache dict x to path atomically, concurrent readers never see a partial cache
         try:
-            np.save(path, x)  # save cache for next time
-            path.with_suffix('.cache.npy').rename(path)  # remove .npy suffix
+            tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+            with open(tmp, 'wb') as f:
+                np.save(f, x)  # save cache for next time
+            os.replace(tmp, path)
             LOGGER.info(f'{prefix}New cache created: {path}')
         except Exception as e:
             LOGGER.warning(f'{prefix}WARNING ⚠️ Cache directory {path.parent} is not writeable: {e}')  # not writeable
-        return x
+
+    def get_hash(self):
+        # Returns the hash identifying the current image and label files, including shard files if sharded
+        return get_hash(self.label_files + self.im_files + (self.shards.hash_files() if self.shards else []))
+
+    def imread(self, f):
+        # Reads image file 'f' as BGR from disk or from shards
+        return self.shards.imread(f) if self.shards else cv2.imread(f)
 
     def __len__(self):
         return len(self.im_files)
@@ -669,14 +844,13 @@ class LoadImagesAndLabels(Dataset):
 
         else:
             # Load image
-            img, (h0, w0), (h, w) = self.load_image(index)
+            img, (h0, w0), (h, w), labels, _ = self.load_image_and_labels(index)
 
             # Letterbox
             shape = self.batch_shapes[self.batch[index]] if self.rect else self.img_size  # final letterboxed shape
             img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.augment)
             shapes = (h0, w0), ((h / h0, w / w0), pad)  # for COCO mAP rescaling
 
-            labels = self.labels[index].copy()
             if labels.size:  # normalized xywh to pixel xyxy format
                 labels[:, 1:] = xywhn2xyxy(labels[:, 1:], ratio[0] * w, ratio[1] * h, padw=pad[0], padh=pad[1])
 
@@ -729,26 +903,22 @@ class LoadImagesAndLabels(Dataset):
 
     def load_image(self, i):
         # Loads 1 image from dataset index 'i', returns (im, original hw, resized hw)
-        im, f, fn = self.ims[i], self.im_files[i], self.npy_files[i],
-        if im is None:  # not cached in RAM
-            if fn.exists():  # load npy
-                im = np.load(fn)
-            else:  # read image
-                im = cv2.imread(f)  # BGR
-                assert im is not None, f'Image Not Found {f}'
-            h0, w0 = im.shape[:2]  # orig hw
-            r = self.img_size / max(h0, w0)  # ratio
-            if r != 1:  # if sizes are not equal
-                interp = cv2.INTER_LINEAR if (self.augment or r > 1) else cv2.INTER_AREA
-                im = cv2.resize(im, (int(w0 * r), int(h0 * r)), interpolation=interp)
-            return im, (h0, w0), im.shape[:2]  # im, hw_original, hw_resized
-        return self.ims[i], self.im_hw0[i], self.im_hw[i]  # im, hw_original, hw_resized
-
-    def cache_images_to_disk(self, i):
-        # Saves an image as an *.npy file for faster loading
-        f = self.npy_files[i]
-        if not f.exists():
-            np.save(f.as_posix(), cv2.imread(self.im_files[i]))
+        if self.arena is not None:  # cached in shared memory
+            return self.arena.get(i)
+        f = self.im_files[i]
+        im = self.imread(f)  # BGR
+        assert im is not None, f'Image Not Found {f}'
+        h0, w0 = im.shape[:2]  # orig hw
+        r = self.img_size / max(h0, w0) if self.resize_on_load else 1  # ratio
+        if r != 1:  # if sizes are not equal
+            interp = cv2.INTER_LINEAR if (self.augment or r > 1) else cv2.INTER_AREA
+            im = cv2.resize(im, (int(w0 * r), int(h0 * r)), interpolation=interp)
+        return im, (h0, w0), im.shape[:2]  # im, hw_original, hw_resized
+
+    def load_image_and_labels(self, i):
+        # Loads 1 image and a copy of its normalized xywh labels and segments, returns (im, original hw, resized hw, labels, segments)
+        im, hw0, hw = self.load_image(i)
+        return im, hw0, hw, self.labels[i].copy(), self.segments[i].copy()
 
     def load_mosaic(self, index):
         # YOLOv5 4-mosaic loader. Loads 1 image + 3 random images into a 4-image mosaic
@@ -759,7 +929,7 @@ class LoadImagesAndLabels(Dataset):
         random.shuffle(indices)
         for i, index in enumerate(indices):
             # Load image
-            img, _, (h, w) = self.load_image(index)
+            img, _, (h, w), labels, segments = self.load_image_and_labels(index)
 
             # place img in img4
             if i == 0:  # top left
@@ -781,7 +951,6 @@ class LoadImagesAndLabels(Dataset):
             padh = y1a - y1b
 
             # Labels
-            labels, segments = self.labels[index].copy(), self.segments[index].copy()
             if labels.size:
                 labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padw, padh)  # normalized xywh to pixel xyxy format
                 segments = [xyn2xy(x, w, h, padw, padh) for x in segments]
@@ -817,7 +986,7 @@ class LoadImagesAndLabels(Dataset):
         hp, wp = -1, -1  # height, width previous
         for i, index in enumerate(indices):
             # Load image
-            img, _, (h, w) = self.load_image(index)
+            img, _, (h, w), labels, segments = self.load_image_and_labels(index)
 
             # place img in img9
             if i == 0:  # center
@@ -845,7 +1014,6 @@ class LoadImagesAndLabels(Dataset):
             x1, y1, x2, y2 = (max(x, 0) for x in c)  # allocate coords
 
             # Labels
-            labels, segments = self.labels[index].copy(), self.segments[index].copy()
             if labels.size:
                 labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padx, pady)  # normalized xywh to pixel xyxy format
                 segments = [xyn2xy(x, w, h, padx, pady) for x in segments]
@@ -886,16 +1054,16 @@ class LoadImagesAndLabels(Dataset):
 
     @staticmethod
     def collate_fn(batch):
-        im, label, path, shapes = zip(*batch)  # transposed
+        im, label, path, index = zip(*batch)  # transposed
         for i, lb in enumerate(label):
             lb[:, 0] = i  # add target image index for build_targets()
-        return torch.stack(im, 0), torch.cat(label, 0), path, shapes
+        return torch.stack(im, 0), torch.cat(label, 0), path, torch.tensor(index)  # dataset indices
 
     @staticmethod
     def collate_fn4(batch):
-        im, label, path, shapes = zip(*batch)  # transposed
-        n = len(shapes) // 4
-        im4, label4, path4, shapes4 = [], [], path[:n], shapes[:n]
+        im, label, path, index = zip(*batch)  # transposed
+        n = len(index) // 4
+        im4, label4, path4, index4 = [], [], path[:n], torch.tensor(index[:n])
 
         ho = torch.tensor([[0.0, 0, 0, 1, 0, 0]])
         wo = torch.tensor([[0.0, 0, 1, 0, 0, 0]])
@@ -915,7 +1083,7 @@ class LoadImagesAndLabels(Dataset):
         for i, lb in enumerate(label4):
             lb[:, 0] = i  # add target image index for build_targets()
 
-        return torch.stack(im4, 0), torch.cat(label4, 0), path4, shapes4
+        return torch.stack(im4, 0), torch.cat(label4, 0), path4, index4
 
 
 # Ancillary functions --------------------------------------------------------------------------------------------------
@@ -989,34 +1157,56 @@ def autosplit(path=DATASETS_DIR / 'coco128/images', weights=(0.9, 0.1, 0.0), ann
                 f.write(f'./{img.relative_to(path.parent).as_posix()}' + '\n')  # add image to txt file
 
 
+def file_stamp(args):
+    # Returns the [image size, image mtime, label size, label mtime, 0] stamp of an image-label pair, -1 if missing
+    stamp = []
+    for f in args:
+        try:
+            st = os.stat(f)
+            stamp += [st.st_size, st.st_mtime_ns]
+        except OSError:
+            stamp += [-1, -1]
+    return stamp + [0]
+
+
 def verify_image_label(args):
-    # Verify one image-label pair
-    im_file, lb_file, prefix = args
+    # Verify one image-label pair, read from disk or from the shards of a ShardReader.stamp if given
+    im_file, lb_file, prefix, shards = args
+    shards = open_shards(*shards) if shards else None  # opened once per worker process
     nm, nf, ne, nc, msg, segments = 0, 0, 0, 0, '', []  # number (missing, found, empty, corrupt), message, segments
     try:
         # verify images
-        im = Image.open(im_file)
+        im = Image.open(io.BytesIO(shards.image(im_file).tobytes()) if shards else im_file)
         im.verify()  # PIL verify
         shape = exif_size(im)  # image size
         assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
         assert im.format.lower() in IMG_FORMATS, f'invalid image format {im.format}'
         if im.format.lower() in ('jpg', 'jpeg'):
-            with open(im_file, 'rb') as f:
-                f.seek(-2, 2)
-                if f.read() != b'\xff\xd9':  # corrupt JPEG
-                    ImageOps.exif_transpose(Image.open(im_file)).save(im_file, 'JPEG', subsampling=0, quality=100)
-                    msg = f'{prefix}WARNING ⚠️ {im_file}: corrupt JPEG restored and saved'
+            if shards:
+                assert shards.image(im_file)[-2:].tobytes() == b'\xff\xd9', 'corrupt JPEG in shard'
+            else:
+                with open(im_file, 'rb') as f:
+                    f.seek(-2, 2)
+                    if f.read() != b'\xff\xd9':  # corrupt JPEG
+                        ImageOps.exif_transpose(Image.open(im_file)).save(im_file, 'JPEG', subsampling=0, quality=100)
+                        msg = f'{prefix}WARNING ⚠️ {im_file}: corrupt JPEG restored and saved'
 
         # verify labels
-        if os.path.isfile(lb_file):
-            nf = 1  # label found
+        if shards:
+            text = shards.label(lb_file)  # '' if empty, None if missing
+        elif os.path.isfile(lb_file):
             with open(lb_file) as f:
-                lb = [x.split() for x in f.read().strip().splitlines() if len(x)]
-                if any(len(x) > 6 for x in lb):  # is segment
-                    classes = np.array([x[0] for x in lb], dtype=np.float32)
-                    segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in lb]  # (cls, xy1...)
-                    lb = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
-                lb = np.array(lb, dtype=np.float32)
+                text = f.read()
+        else:
+            text = None
+        if text is not None:
+            nf = 1  # label found
+            lb = [x.split() for x in text.strip().splitlines() if len(x)]
+            if any(len(x) > 6 for x in lb):  # is segment
+                classes = np.array([x[0] for x in lb], dtype=np.float32)
+                segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in lb]  # (cls, xy1...)
+                lb = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
+            lb = np.array(lb, dtype=np.float32)
             nl = len(lb)
             if nl:
                 assert lb.shape[1] == 5, f'labels require 5 columns, {lb.shape[1]} columns detected'
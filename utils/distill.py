@@ -0,0 +1,120 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Knowledge distillation utils
+
+A frozen teacher model predicts every training batch and the student is trained with ComputeLoss plus
+    - objectness distillation, BCE of the student obj logits to the teacher obj probabilities on all anchors
+    - class distillation, BCE of the student class logits to the teacher class probabilities, weighted by the teacher
+      objectness so background cells do not dominate
+    - feature imitation, MSE of the student FPN outputs (Detect inputs), projected to the teacher channels by trainable
+      1x1 convolutions, to the teacher FPN outputs, relative to the teacher feature energy
+Student and teacher must have the same strides and number of anchors. The student takes the teacher anchors so both
+predict the same anchor slots. Loss gains are read from hyp: distill_obj, distill_cls (multiplied with obj and cls),
+distill_feat and the temperature distill_t.
+
+Teacher outputs can be cached to disk per dataset image (--teacher-cache), which is only valid if the training images
+do not change between epochs, i.e. with a hyp without augmentation.
+
+Usage:
+    $ python train.py --data data/Flower.yaml --cfg yolov5n.yaml --weights '' --teacher YOLOFlower.pt
+
+Usage - student forward pass:
+    with detect_inputs(model) as features:
+        pred = model(imgs)
+    loss, loss_items = compute_distill_loss(imgs, pred, features, ind)
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from utils.general import LOGGER, colorstr
+from utils.torch_utils import de_parallel
+
+PREFIX = colorstr('distill: ')
+AUGMENT_KEYS = ('hsv_h', 'hsv_s', 'hsv_v', 'degrees', 'translate', 'scale', 'shear', 'perspective', 'flipud', 'fliplr',
+                'mosaic', 'mixup', 'copy_paste')  # hyp keys of random train augmentations
+
+
+@contextmanager
+def detect_inputs(model):
+    # Context manager yielding a list that receives the Detect() inputs, the FPN outputs, of model forward passes
+    x = []
+
+    def hook(m, inputs):
+        x[:] = list(inputs[0])  # copy, Detect() replaces the list items in place
+
+    h = de_parallel(model).model[-1].register_forward_pre_hook(hook)  # removed on exit, models are saved without it
+    try:
+        yield x
+    finally:
+        h.remove()
+
+
+class ComputeDistillLoss(nn.Module):
+    # Distillation losses of a student to a frozen teacher, nn.Module for the trainable feature adaptation layers
+    def __init__(self, model, teacher, hyp):
+        super().__init__()
+        m, t = de_parallel(model).model[-1], teacher.model[-1]  # Detect() modules
+        assert m.nl == t.nl and m.na == t.na and torch.equal(m.stride.cpu(), t.stride.cpu()), \
+            f'{PREFIX}student and teacher need the same strides and anchors per layer'
+        assert m.nc == t.nc, f'{PREFIX}student nc={m.nc} and teacher nc={t.nc} differ'
+        m.anchors.data = t.anchors.data.to(m.anchors)  # same anchor slots, anchors in stride units
+
+        self.hyp, self.nc, self.balance = hyp, m.nc, {3: [4.0, 1.0, 0.4]}.get(m.nl, [4.0, 1.0, 0.25, 0.06, 0.02])
+        self.adapt = nn.ModuleList(nn.Conv2d(a.in_channels, b.in_channels, 1) for a, b in zip(m.m, t.m))
+        self.adapt.to(m.anchors.device)
+        self.teacher = teacher.eval()
+        for p in self.teacher.parameters():
+            p.requires_grad = False
+        self.cache = None  # teacher outputs cache directory
+        LOGGER.info(f'{PREFIX}teacher feature channels {[b.in_channels for b in t.m]}, '
+                    f'student {[a.in_channels for a in m.m]}, student anchors set to the teacher anchors')
+
+    def set_cache(self, path):
+        # Cache the teacher outputs of every dataset image in directory path, valid for fixed training images only
+        self.cache = Path(path)
+        self.cache.mkdir(parents=True, exist_ok=True)
+        LOGGER.info(f'{PREFIX}caching teacher outputs to {self.cache}')
+
+    @torch.no_grad()
+    def soft_targets(self, imgs, ind):
+        # Return the teacher raw predictions and FPN outputs [(b,...)] of a batch, from the cache if possible
+        files = [self.cache / f'{i}.pt' for i in ind.tolist()] if self.cache else []
+        if files and all(f.exists() for f in files):
+            x = [torch.load(f, map_location=imgs.device) for f in files]  # per image (p, features)
+            p, features = ([torch.stack(y).float() for y in zip(*z)] for z in zip(*x))
+            s = int(self.teacher.stride[0])
+            if p[0].shape[2:4] == (imgs.shape[2] // s, imgs.shape[3] // s):  # cached at this image size
+                return p, features
+        with detect_inputs(self.teacher) as features:
+            p = self.teacher(imgs)[1]  # eval mode (inference, raw predictions)
+        for j, f in enumerate(files):
+            torch.save(([x[j].half() for x in p], [x[j].half() for x in features]), f)
+        return p, features
+
+    def forward(self, imgs, p, features, ind):  # images, student predictions, student FPN outputs, dataset indices
+        tp, tfeatures = self.soft_targets(imgs, ind)
+        h, eps = self.hyp, 1E-9
+        T = h.get('distill_t', 1.0)  # temperature
+        lobj = torch.zeros(1, device=imgs.device)  # objectness distillation loss
+        lcls = torch.zeros(1, device=imgs.device)  # class distillation loss
+        lfeat = torch.zeros(1, device=imgs.device)  # feature imitation loss
+        for i, (pi, ti) in enumerate(zip(p, tp)):
+            tobj = (ti[..., 4] / T).sigmoid()
+            lobj += F.binary_cross_entropy_with_logits(pi[..., 4] / T, tobj) * self.balance[i]
+            if self.nc > 1:
+                w = ti[..., 4].sigmoid()  # teacher objectness weights
+                bce = F.binary_cross_entropy_with_logits(pi[..., 5:] / T, (ti[..., 5:] / T).sigmoid(), reduction='none')
+                lcls += (bce.mean(-1) * w).sum() / (w.sum() + eps)
+        for a, s, t in zip(self.adapt, features, tfeatures):
+            lfeat += F.mse_loss(a(s), t) / (t.pow(2).mean() + eps) / len(self.adapt)
+        lobj *= h['obj'] * h.get('distill_obj', 1.0) * T ** 2
+        lcls *= h['cls'] * h.get('distill_cls', 1.0) * T ** 2
+        lfeat *= h.get('distill_feat', 0.05)
+        bs = imgs.shape[0]  # batch size
+
+        return (lobj + lcls + lfeat) * bs, torch.cat((lobj, lcls, lfeat)).detach()
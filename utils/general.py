@@ -679,14 +679,17 @@ def colorstr(*input):
     return ''.join(colors[x] for x in args) + f'{string}' + colors['end']
 
 
-def labels_to_class_weights(labels, nc=80):
-    # Get class weights (inverse frequency) from training labels
-    if labels[0] is None:  # no labels loaded
+def labels_to_class_weights(labels, nc=80, class_counts=None):
+    # Get class weights (inverse frequency) from training labels, or from per-image class counts(n,nc) if given
+    if class_counts is not None:
+        weights = np.asarray(class_counts).sum(0)[:nc]  # occurrences per class
+        weights = np.pad(weights, (0, nc - len(weights)))
+    elif labels[0] is None:  # no labels loaded
         return torch.Tensor()
-
-    labels = np.concatenate(labels, 0)  # labels.shape = (866643, 5) for COCO
-    classes = labels[:, 0].astype(int)  # labels = [class xywh]
-    weights = np.bincount(classes, minlength=nc)  # occurrences per class
+    else:
+        labels = np.concatenate(labels, 0)  # labels.shape = (866643, 5) for COCO
+        classes = labels[:, 0].astype(int)  # labels = [class xywh]
+        weights = np.bincount(classes, minlength=nc)  # occurrences per class
 
     # Prepend gridpoint count (for uCE training)
     # gpi = ((320 / 32 * np.array([1, 2, 4])) ** 2 * 3).sum()  # gridpoints per image
@@ -698,10 +701,13 @@ def labels_to_class_weights(labels, nc=80):
     return torch.from_numpy(weights).float()
 
 
-def labels_to_image_weights(labels, nc=80, class_weights=np.ones(80)):
-    # Produces image weights based on class_weights and image contents
+def labels_to_image_weights(labels, nc=80, class_weights=np.ones(80), class_counts=None):
+    # Produces image weights based on class_weights and image contents, or per-image class counts(n,nc) if given
     # Usage: index = random.choices(range(n), weights=image_weights, k=1)  # weighted image sample
-    class_counts = np.array([np.bincount(x[:, 0].astype(int), minlength=nc) for x in labels])
+    if class_counts is None:
+        class_counts = np.array([np.bincount(x[:, 0].astype(int), minlength=nc) for x in labels])
+    class_counts = np.asarray(class_counts)[:, :nc]
+    class_counts = np.pad(class_counts, ((0, 0), (0, nc - class_counts.shape[1])))
     return (class_weights.reshape(1, nc) * class_counts).mean(1)
 
 
@@ -883,85 +889,72 @@ def non_max_suppression(
     # Settings
     # min_wh = 2  # (pixels) minimum box width and height
     max_wh = 7680  # (pixels) maximum box width and height
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
-    time_limit = 0.5 + 0.05 * bs  # seconds to quit after
-    redundant = True  # require redundant detections
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.nms()
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
-    merge = False  # use merge-NMS
 
-    t = time.time()
     mi = 5 + nc  # mask start index
-    output = [torch.zeros((0, 6 + nm), device=prediction.device)] * bs
-    for xi, x in enumerate(prediction):  # image index, image inference
-        # Apply constraints
-        # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
-        x = x[xc[xi]]  # confidence
-
-        # Cat apriori labels if autolabelling
-        if labels and len(labels[xi]):
-            lb = labels[xi]
-            v = torch.zeros((len(lb), nc + nm + 5), device=x.device)
-            v[:, :4] = lb[:, 1:5]  # box
-            v[:, 4] = 1.0  # conf
-            v[range(len(lb)), lb[:, 0].long() + 5] = 1.0  # cls
-            x = torch.cat((x, v), 0)
-
-        # If none remain process next image
-        if not x.shape[0]:
-            continue
-
-        # Compute conf
-        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
-
-        # Box/Mask
-        box = xywh2xyxy(x[:, :4])  # center_x, center_y, width, height) to (x1, y1, x2, y2)
-        mask = x[:, mi:]  # zero columns if no masks
-
-        # Detections matrix nx6 (xyxy, conf, cls)
-        if multi_label:
-            i, j = (x[:, 5:mi] > conf_thres).nonzero(as_tuple=False).T
-            x = torch.cat((box[i], x[i, 5 + j, None], j[:, None].float(), mask[i]), 1)
-        else:  # best class only
-            conf, j = x[:, 5:mi].max(1, keepdim=True)
-            x = torch.cat((box, conf, j.float(), mask), 1)[conf.view(-1) > conf_thres]
-
-        # Filter by class
-        if classes is not None:
-            x = x[(x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)]
-
-        # Apply finite constraint
-        # if not torch.isfinite(x).all():
-        #     x = x[torch.isfinite(x).all(1)]
-
-        # Check shape
-        n = x.shape[0]  # number of boxes
-        if not n:  # no boxes
-            continue
-        elif n > max_nms:  # excess boxes
-            x = x[x[:, 4].argsort(descending=True)[:max_nms]]  # sort by confidence
-        else:
-            x = x[x[:, 4].argsort(descending=True)]  # sort by confidence
-
-        # Batched NMS
-        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
-        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
-        if i.shape[0] > max_det:  # limit detections
-            i = i[:max_det]
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
-            # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-            iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
-            weights = iou * scores[None]  # box weights
-            x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
-            if redundant:
-                i = i[iou.sum(1) > 1]  # require redundancy
-
-        output[xi] = x[i]
-        if mps:
-            output[xi] = output[xi].to(device)
-        if (time.time() - t) > time_limit:
-            LOGGER.warning(f'WARNING ⚠️ NMS time limit {time_limit:.3f}s exceeded')
-            break  # time limit exceeded
+    xi, k = xc.nonzero(as_tuple=True)  # image index, anchor index of candidates
+    x = prediction[xi, k]  # confidence
+
+    # Cat apriori labels if autolabelling
+    if labels and sum(len(lb) for lb in labels):
+        lb = torch.cat(list(labels), 0).to(x)
+        v = torch.zeros((len(lb), nc + nm + 5), device=x.device)
+        v[:, :4] = lb[:, 1:5]  # box
+        v[:, 4] = 1.0  # conf
+        v[range(len(lb)), lb[:, 0].long() + 5] = 1.0  # cls
+        x = torch.cat((x, v), 0)
+        xi = torch.cat((xi, torch.repeat_interleave(torch.arange(bs, device=x.device),
+                                                    torch.tensor([len(lb) for lb in labels], device=x.device))))
+
+    # Compute conf
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box/Mask
+    box = xywh2xyxy(x[:, :4])  # center_x, center_y, width, height) to (x1, y1, x2, y2)
+    mask = x[:, mi:]  # zero columns if no masks
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:mi] > conf_thres).nonzero(as_tuple=False).T
+        x, xi = torch.cat((box[i], x[i, 5 + j, None], j[:, None].float(), mask[i]), 1), xi[i]
+    else:  # best class only
+        conf, j = x[:, 5:mi].max(1, keepdim=True)
+        keep = conf.view(-1) > conf_thres
+        x, xi = torch.cat((box, conf, j.float(), mask), 1)[keep], xi[keep]
+
+    # Filter by class
+    if classes is not None:
+        keep = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, xi = x[keep], xi[keep]
+
+    # Sort by image and confidence, limit boxes per image
+    i = x[:, 4].argsort(descending=True, stable=True)
+    i = i[xi[i].argsort(stable=True)]
+    x, xi = x[i], xi[i]
+    n = torch.bincount(xi, minlength=bs)  # boxes per image
+    if len(xi) and n.max() > max_nms:  # excess boxes
+        rank = torch.arange(len(xi), device=x.device) - (n.cumsum(0) - n)[xi]  # rank in image
+        x, xi = x[rank < max_nms], xi[rank < max_nms]
+
+    # Batched NMS, in one call with boxes offset by image for few boxes or per image for many like batched_nms()
+    c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+    boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
+    n = n.clamp(max=max_nms)  # boxes per image
+    if len(boxes) <= (1000 if boxes.device.type == 'cpu' else 20000):
+        b = boxes.double()  # float64 keeps the float32 boxes exact after the image offset
+        if len(b):
+            b += xi[:, None] * (b.max() - b.min() + 1)  # offset by image, beyond the extent of all boxes
+        i = torchvision.ops.nms(b, scores.double(), iou_thres)  # NMS
+        i = i[xi[i].argsort(stable=True)]  # by image, confidence
+    else:
+        first = (n.cumsum(0) - n).tolist()  # first box of each image
+        i = torch.cat([
+            torchvision.ops.nms(b, s, iou_thres) + f
+            for b, s, f in zip(boxes.split(n.tolist()), scores.split(n.tolist()), first)])
+    n = torch.bincount(xi[i], minlength=bs)  # detections per image
+    i = i[torch.arange(len(i), device=x.device) - (n.cumsum(0) - n)[xi[i]] < max_det]  # limit detections
+    output = list(x[i].to(device).split(n.clamp(max=max_det).tolist()))
 
     return output
 
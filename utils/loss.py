@@ -116,8 +116,7 @@ class ComputeLoss:
 
         # Sample weights
         if not weights is None:
-            weights = torch.tensor(weights, device=device)
-            self.globalweights = weights
+            self.globalweights = torch.as_tensor(weights, dtype=torch.float32, device=device)  # indexed by dataset index
         
         # Define criteria
         BCEcls = nn.BCEWithLogitsLoss(pos_weight=torch.tensor(h["cls_pw"], device=device))
@@ -157,8 +156,8 @@ class ComputeLoss:
         tcls, tbox, indices, anchors = self.build_targets(p, targets)  # targets
 
         if self.use_sample_weights:
-            weights = torch.tensor([self.globalweights[i] for i in ind], device=self.device)
-            weights /= weights.sum()
+            weights = self.globalweights[torch.as_tensor(ind, device=self.device)]  # gather batch sample weights
+            weights = weights / weights.sum()
         
         # Losses
         for i, pi in enumerate(p):  # layer index, layer predictions
@@ -28,6 +28,88 @@ def smooth(y, f=0.05):
     return np.convolve(yp, np.ones(nf) / nf, mode='valid')  # y-smoothed
 
 
+def interp_segments(x, xp, fp, seg, n, left=None):
+    # np.interp() of x (m,) on each of n segments of increasing xp (k,) with values fp (k,), returns (n,m). seg (k,) is the
+    # sorted segment index of every point, left the value below a segment (default its first value), empty segments are 0
+    start = np.searchsorted(seg, np.arange(n))  # first point of each segment
+    end = np.searchsorted(seg, np.arange(n), side='right')  # last point + 1
+    if len(xp):
+        lo = min(xp.min(), x.min())
+        span = max(xp.max(), x.max()) - lo + 1  # segment offset, larger than any x or xp difference
+        j = np.searchsorted((xp - lo) + seg * span, (x - lo)[None] + np.arange(n)[:, None] * span, side='right') - 1
+        j0 = np.clip(j, start[:, None], np.maximum(end - 2, start)[:, None]).clip(max=len(xp) - 1)  # xp[j0] <= x
+        j1 = np.minimum(j0 + 1, np.maximum(end - 1, 0)[:, None])  # x < xp[j1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y = (fp[j1] - fp[j0]) / (xp[j1] - xp[j0]) * (x[None] - xp[j0]) + fp[j0]  # np.interp() order of operations
+        y = np.where(j >= end[:, None] - 1, fp[np.maximum(end - 1, 0)][:, None], y)  # right of segment
+        y = np.where(j < start[:, None], fp[start.clip(max=len(fp) - 1)][:, None] if left is None else left, y)  # left
+    else:
+        y = np.zeros((n, len(x)))
+    return np.where((end > start)[:, None], y, 0.0)
+
+
+def pr_metrics(conf, tpc, fpc, seg, nt, eps=1e-16):
+    """ Precision-recall curves and AP of all classes and IoU thresholds at once.
+    # Arguments
+        conf:  Confidence of every curve point (nparray, n), sorted by seg and decreasing within a segment.
+        tpc:  Cumulative true positives of every point in its class (nparray, nx10).
+        fpc:  Cumulative false positives of every point in its class (nparray, nx10).
+        seg:  Class index of every point (nparray, n), into nt.
+        nt:  Number of targets per class (nparray, nc).
+    # Returns
+        AP (nc, 10), precision and recall at 1000 confidences (nc, 1000), and precision at 1000 recalls at IoU 0.5
+        (n, 1000) of the n classes with predictions and labels
+    """
+    nc, niou = len(nt), tpc.shape[1]
+    px = np.linspace(0, 1, 1000)
+    recall = tpc / (nt[seg, None] + eps)  # recall curves
+    precision = tpc / (tpc + fpc)  # precision curves
+    r = interp_segments(-px, -conf, recall[:, 0], seg, nc, left=0)  # negative x, xp because xp decreases
+    p = interp_segments(-px, -conf, precision[:, 0], seg, nc, left=1)  # p at pr_score
+
+    # Precision-recall curves of every IoU threshold (rows) and class (column segments) with sentinels
+    n = np.bincount(seg, minlength=nc)  # points per class
+    first = np.cumsum(n + 2) - n - 2  # first sentinel column of every class
+    mrec, mpre = np.zeros((niou, len(seg) + 2 * nc)), np.zeros((niou, len(seg) + 2 * nc))
+    i = np.arange(len(seg)) + 2 * seg + 1  # point columns
+    mrec[:, i], mpre[:, i] = recall.T, precision.T
+    mrec[:, first], mpre[:, first] = 0.0, 1.0
+    mrec[:, first + n + 1], mpre[:, first + n + 1] = 1.0, 0.0
+
+    # Precision envelopes, reversed cumulative maximum within every class
+    offset = 2.0 * (nc - np.repeat(np.arange(nc), n + 2))  # later classes offset less, so the maximum restarts
+    mpre = np.flip(np.maximum.accumulate(np.flip(mpre + offset, 1), 1), 1) - offset
+
+    # 101-point interpolated AP (COCO) of every curve, curve k = IoU threshold * nc + class
+    curve = (np.arange(niou)[:, None] * nc + np.repeat(np.arange(nc), n + 2)[None]).ravel()
+    x = np.linspace(0, 1, 101)
+    y = interp_segments(x, mrec.ravel(), mpre.ravel(), curve, niou * nc)
+    ap = ((y[:, 1:] + y[:, :-1]) / 2 * np.diff(x)).sum(1).reshape(niou, nc).T  # trapezoidal integration
+    py = interp_segments(px, mrec[0], mpre[0], curve[:mrec.shape[1]], nc)  # precision at mAP@0.5
+    valid = (n > 0) & (nt > 0)  # classes with predictions and labels
+    ap, p, r = (np.where(valid[:, None], v, 0.0) for v in (ap, p, r))
+    return ap, p, r, py[valid]
+
+
+def pr_results(ap, p, r, py, nt, unique_classes, plot=False, save_dir='.', names=(), eps=1e-16, prefix=''):
+    # ap_per_class() results of per class AP, precision and recall curves, at the confidence of maximum mean F1
+    px = np.linspace(0, 1, 1000)
+    f1 = 2 * p * r / (p + r + eps)  # harmonic mean of precision and recall
+    names = [v for k, v in names.items() if k in unique_classes]  # list: only classes that have data
+    names = dict(enumerate(names))  # to dict
+    if plot:
+        plot_pr_curve(px, py, ap, Path(save_dir) / f'{prefix}PR_curve.png', names)
+        plot_mc_curve(px, f1, Path(save_dir) / f'{prefix}F1_curve.png', names, ylabel='F1')
+        plot_mc_curve(px, p, Path(save_dir) / f'{prefix}P_curve.png', names, ylabel='Precision')
+        plot_mc_curve(px, r, Path(save_dir) / f'{prefix}R_curve.png', names, ylabel='Recall')
+
+    i = smooth(f1.mean(0), 0.1).argmax()  # max F1 index
+    p, r, f1 = p[:, i], r[:, i], f1[:, i]
+    tp = (r * nt).round()  # true positives
+    fp = (tp / (p + eps) - tp).round()  # false positives
+    return tp, fp, p, r, f1, ap, unique_classes.astype(int)
+
+
 def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names=(), eps=1e-16, prefix=""):
     """ Compute the average precision, given the recall and precision curves.
     Source: https://github.com/rafaelpadilla/Object-Detection-Metrics.
@@ -42,57 +124,56 @@ def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names
         The average precision as computed in py-faster-rcnn.
     """
 
-    # Sort by objectness
-    i = np.argsort(-conf)
-    tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
-
     # Find unique classes
     unique_classes, nt = np.unique(target_cls, return_counts=True)
-    nc = unique_classes.shape[0]  # number of classes, number of detections
-
-    # Create Precision-Recall curve and compute AP for each class
-    px, py = np.linspace(0, 1, 1000), []  # for plotting
-    ap, p, r = np.zeros((nc, tp.shape[1])), np.zeros((nc, 1000)), np.zeros((nc, 1000))
-    for ci, c in enumerate(unique_classes):
-        i = pred_cls == c
-        n_l = nt[ci]  # number of labels
-        n_p = i.sum()  # number of predictions
-        if n_p == 0 or n_l == 0:
-            continue
-
-        # Accumulate FPs and TPs
-        fpc = (1 - tp[i]).cumsum(0)
-        tpc = tp[i].cumsum(0)
-
-        # Recall
-        recall = tpc / (n_l + eps)  # recall curve
-        r[ci] = np.interp(-px, -conf[i], recall[:, 0], left=0)  # negative x, xp because xp decreases
-
-        # Precision
-        precision = tpc / (tpc + fpc)  # precision curve
-        p[ci] = np.interp(-px, -conf[i], precision[:, 0], left=1)  # p at pr_score
-
-        # AP from recall-precision curve
-        for j in range(tp.shape[1]):
-            ap[ci, j], mpre, mrec = compute_ap(recall[:, j], precision[:, j])
-            if plot and j == 0:
-                py.append(np.interp(px, mrec, mpre))  # precision at mAP@0.5
-
-    # Compute F1 (harmonic mean of precision and recall)
-    f1 = 2 * p * r / (p + r + eps)
-    names = [v for k, v in names.items() if k in unique_classes]  # list: only classes that have data
-    names = dict(enumerate(names))  # to dict
-    if plot:
-        plot_pr_curve(px, py, ap, Path(save_dir) / f'{prefix}PR_curve.png', names)
-        plot_mc_curve(px, f1, Path(save_dir) / f'{prefix}F1_curve.png', names, ylabel='F1')
-        plot_mc_curve(px, p, Path(save_dir) / f'{prefix}P_curve.png', names, ylabel='Precision')
-        plot_mc_curve(px, r, Path(save_dir) / f'{prefix}R_curve.png', names, ylabel='Recall')
 
-    i = smooth(f1.mean(0), 0.1).argmax()  # max F1 index
-    p, r, f1 = p[:, i], r[:, i], f1[:, i]
-    tp = (r * nt).round()  # true positives
-    fp = (tp / (p + eps) - tp).round()  # false positives
-    return tp, fp, p, r, f1, ap, unique_classes.astype(int)
+    # Sort by objectness, then by class, predictions of classes without labels are ignored
+    i = np.argsort(-conf)
+    i = i[np.isin(pred_cls[i], unique_classes)]
+    seg = np.searchsorted(unique_classes, pred_cls[i])  # class index
+    j = np.argsort(seg, kind='stable')
+    tp, conf, seg = tp[i[j]], conf[i[j]], seg[j]
+
+    # Accumulate TPs and FPs per class
+    n = np.bincount(seg, minlength=len(nt))  # predictions per class
+    start = np.repeat(np.cumsum(n) - n, n)  # first prediction of the class of every prediction
+    tpc = tp.cumsum(0)
+    tpc -= np.concatenate((np.zeros((1, tp.shape[1]), dtype=tpc.dtype), tpc))[start]
+    fpc = (np.arange(len(seg)) - start + 1)[:, None] - tpc
+
+    ap, p, r, py = pr_metrics(conf, tpc, fpc, seg, nt, eps)
+    return pr_results(ap, p, r, py, nt, unique_classes, plot, save_dir, names, eps, prefix)
+
+
+class MetricAccumulator:
+    # Streaming ap_per_class(), predictions are binned by confidence into fixed (nc, bins) prediction and (nc, bins, niou)
+    # true positive histograms on the device, so memory is constant in dataset size and the final metrics are instant
+    def __init__(self, nc, niou=10, bins=10000, device='cpu'):
+        self.nc, self.niou, self.bins = nc, niou, bins
+        self.n = torch.zeros(nc * bins, dtype=torch.int32, device=device)  # predictions
+        self.tp = torch.zeros((nc * bins, niou), dtype=torch.int32, device=device)  # true positives
+        self.nt = torch.zeros(nc, dtype=torch.long, device=device)  # targets
+
+    def update(self, correct, conf, pcls, tcls):
+        # Add the ap_per_class() inputs of one image, correct (n,niou), conf (n,), pcls (n,) and tcls (m,) tensors
+        k = pcls < self.nc  # predictions of unknown classes have no labels
+        i = pcls[k].long() * self.bins + (conf[k] * self.bins).long().clamp_(0, self.bins - 1)  # histogram bin
+        self.n.index_add_(0, i, torch.ones_like(i, dtype=torch.int32))
+        self.tp.index_add_(0, i, correct[k].int())
+        self.nt += torch.bincount(tcls.long(), minlength=self.nc)[:self.nc]
+
+    def compute(self, plot=False, save_dir='.', names=(), eps=1e-16, prefix=''):
+        # Return ap_per_class() results, confidences are rounded to their bin centers
+        unique_classes = np.flatnonzero(self.nt.cpu().numpy())  # classes with labels
+        nt = self.nt.cpu().numpy()[unique_classes]
+        n = self.n.view(self.nc, self.bins)[unique_classes].flip(1).cpu().numpy()  # by decreasing confidence
+        tp = self.tp.view(self.nc, self.bins, self.niou)[unique_classes].flip(1).cpu().numpy()
+        tpc = tp.cumsum(1)
+        fpc = n.cumsum(1)[..., None] - tpc
+        seg, b = np.nonzero(n)  # curve points, non-empty bins
+        conf = (self.bins - b - 0.5) / self.bins  # bin center
+        ap, p, r, py = pr_metrics(conf, tpc[seg, b], fpc[seg, b], seg, nt, eps)
+        return pr_results(ap, p, r, py, nt, unique_classes, plot, save_dir, names, eps, prefix)
 
 
 def compute_ap(recall, precision):
@@ -0,0 +1,188 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Structured channel pruning utils
+
+Output channels of Conv, C3 and SPPF layers are ranked by a saliency, the BN scale |gamma| (network slimming,
+https://arxiv.org/abs/1708.06519) or the first-order Taylor term |gamma * dL/dgamma| (https://arxiv.org/abs/1906.10771),
+and the weakest channels of the whole model are removed. Channels that are added together (C3 residual bottlenecks) are
+ranked and removed together. The pruned model is an ordinary Model built from a thinner yaml, with width_multiple 1.0,
+explicit channels per layer and explicit C3 expansion ratios, so it trains, exports and loads like any other model.
+
+Usage:
+    from utils.pruning import bn_saliency, prune_model
+    pruned = prune_model(model, bn_saliency(model), ratio=0.3)  # pruned.yaml is the thinner model yaml
+"""
+
+import math
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+
+from models.common import C3, SPPF, Concat, Conv
+from models.yolo import Detect, Model
+from utils.general import LOGGER, colorstr
+
+PREFIX = colorstr('prune: ')
+
+
+def bn_saliency(model):
+    # Return the |gamma| BN scale saliency {BatchNorm2d: (c,)} of all BN layers
+    return {m: m.weight.detach().abs().float() for m in model.modules() if isinstance(m, nn.BatchNorm2d)}
+
+
+def taylor_saliency(model, dataloader, compute_loss, batches=32):
+    # Return the first-order Taylor saliency {BatchNorm2d: (c,)}, |gamma * dL/dgamma| summed over batches of images
+    device = next(model.parameters()).device
+    bns = [m for m in model.modules() if isinstance(m, nn.BatchNorm2d)]
+    saliency = {m: torch.zeros_like(m.weight, dtype=torch.float) for m in bns}
+    for p in model.parameters():
+        p.requires_grad = True  # stripped checkpoints are frozen
+    model.eval()  # running BN statistics, the pruned model keeps them
+    for i, (imgs, targets, _, ind) in enumerate(dataloader):
+        if i == batches:
+            break
+        model.zero_grad()
+        p = model(imgs.to(device).float() / 255)[1]  # feature maps of the eval mode Detect() output
+        loss, _ = compute_loss(p, targets.to(device), ind)
+        loss.backward()
+        for m in bns:
+            saliency[m] += (m.weight * m.weight.grad).detach().abs().float()
+    model.zero_grad()
+    return saliency
+
+
+def _normalized(saliency, bns):
+    # Saliency of channels shared by the BN layers bns, every layer normalized to a unit mean
+    return sum(saliency[m] / saliency[m].mean().clamp(min=1e-12) for m in bns)
+
+
+class ChannelPlan:
+    # Global saliency threshold and channel rounding of one pruning run
+    def __init__(self, threshold, min_keep=0.1, divisor=8):
+        self.threshold, self.min_keep, self.divisor = threshold, min_keep, divisor
+
+    def count(self, s):
+        # Number of channels kept of a saliency s, above the threshold and rounded up to the divisor
+        n = len(s)
+        k = int((s > self.threshold).sum())
+        k = max(k, math.ceil(self.min_keep * n), self.divisor)
+        return min(math.ceil(k / self.divisor) * self.divisor, n)
+
+    @staticmethod
+    def top(s, k):
+        # Indices of the k channels of largest saliency s, sorted
+        return s.argsort(descending=True)[:k].sort()[0]
+
+    def keep(self, s, k=None):
+        # Sorted indices of the channels kept of a saliency s, the k most salient if k is given
+        return self.top(s, self.count(s) if k is None else k)
+
+
+def prune_model(model, saliency, ratio=0.3, min_keep=0.1, divisor=8):
+    # Return a thinner copy of model without the ratio of least salient channels, every tensor keeps at least min_keep
+    # of its channels and a multiple of divisor. model must be unfused (BN layers), saliency is {BatchNorm2d: (c,)}
+    source, model = list(model.modules()), deepcopy(model).float().cpu()
+    saliency = {m: saliency[o].float().cpu() for o, m in zip(source, model.modules()) if o in saliency}  # copy modules
+    layers = model.model
+
+    # Pruned tensors, shared channels of residual C3 bottlenecks together
+    groups = []  # (bns,) per tensor
+    for m in layers:
+        if isinstance(m, Conv):
+            groups.append((m.bn,))
+        elif type(m) is C3:
+            if m.m[0].add:
+                groups.append((m.cv1.bn, *(b.cv2.bn for b in m.m)))
+            else:
+                groups += [(m.cv1.bn,)] + [(b.cv2.bn,) for b in m.m]
+            groups += [(m.cv2.bn,), (m.cv3.bn,)] + [(b.cv1.bn,) for b in m.m]
+        elif isinstance(m, SPPF):
+            groups.append((m.cv2.bn,))
+        elif not isinstance(m, (nn.Upsample, Concat, Detect)):
+            raise NotImplementedError(f'{PREFIX}{type(m).__name__} layers are not supported')
+    s = torch.cat([_normalized(saliency, g) / len(g) for g in groups])
+    plan = ChannelPlan(s.quantile(ratio).item(), min_keep, divisor)
+
+    # Kept channels of every layer output, and the thinner yaml
+    d = deepcopy(model.yaml)
+    d['depth_multiple'], d['width_multiple'] = 1.0, 1.0
+    kept, chs, keep = [], [], {}  # kept and original output channels per layer, kept channels per Conv/Detect module
+    for i, (m, row) in enumerate(zip(layers, d['backbone'] + d['head'])):
+        f = m.f
+        if isinstance(m, Concat):
+            offsets = [sum(chs[x] for x in f[:j]) for j in range(len(f))]
+            kept.append(torch.cat([kept[x] + o for x, o in zip(f, offsets)]))
+            chs.append(sum(chs[x] for x in f))
+            continue
+        if isinstance(m, nn.Upsample):
+            kept.append(kept[f])
+            chs.append(chs[f])
+            continue
+        if isinstance(m, Detect):
+            keep[m] = [kept[x] for x in f]
+            continue
+        x = torch.arange(3) if i == 0 else kept[f]  # kept input channels
+        if isinstance(m, Conv):
+            out = plan.keep(_normalized(saliency, (m.bn,)))
+            keep[m] = (out, x)
+            row[3] = [len(out), *row[3][1:]]
+            c2 = m.conv.out_channels
+        elif type(m) is C3:
+            hidden = [(m.cv1.bn, *(b.cv2.bn for b in m.m))] if m.m[0].add else \
+                [(m.cv1.bn,)] + [(b.cv2.bn,) for b in m.m]
+            inner = [(m.cv2.bn,)] + [(b.cv1.bn,) for b in m.m]
+            h = max(plan.count(_normalized(saliency, g) / len(g)) for g in hidden + inner)  # one C3 width, c_
+            keep_h = lambda g: plan.keep(_normalized(saliency, g), h)  # noqa: E731
+            if m.m[0].add:  # residual stream
+                stream = [keep_h(hidden[0])] * (len(m.m) + 1)
+            else:
+                stream = [keep_h(g) for g in hidden]
+            keep[m.cv1] = (stream[0], x)
+            keep[m.cv2] = (keep_h(inner[0]), x)
+            for j, b in enumerate(m.m):
+                keep[b.cv1] = (keep_h((b.cv1.bn,)), stream[j])
+                keep[b.cv2] = (stream[j + 1], keep[b.cv1][0])
+            c_ = m.cv1.conv.out_channels
+            out = plan.keep(_normalized(saliency, (m.cv3.bn,)))
+            keep[m.cv3] = (out, torch.cat((stream[-1], keep[m.cv2][0] + c_)))
+            row[1] = len(m.m)
+            row[3] = [len(out), m.m[0].add, 1, round((h + 0.5) / len(out), 6)]  # c2, shortcut, g, e
+            c2 = m.cv3.conv.out_channels
+        elif isinstance(m, SPPF):
+            c_ = m.cv1.conv.out_channels
+            hidden = plan.keep(_normalized(saliency, (m.cv1.bn,)), len(x) // 2)  # SPPF width is its input width / 2
+            out = plan.keep(_normalized(saliency, (m.cv2.bn,)))
+            keep[m.cv1] = (hidden, x)
+            keep[m.cv2] = (out, torch.cat([hidden + c_ * j for j in range(4)]))
+            row[3] = [len(out), *row[3][1:]]
+            c2 = m.cv2.conv.out_channels
+        kept.append(out)
+        chs.append(c2)
+
+    # Thinner model with the kept weights
+    pruned = Model(d, ch=3, nc=model.yaml['nc'])
+    modules = dict(zip(model.modules(), pruned.modules()))  # same architecture, same module order
+    for m, k in keep.items():
+        if isinstance(m, Detect):
+            p = modules[m]
+            for conv, conv_p, x in zip(m.m, p.m, k):
+                conv_p.weight.data = conv.weight.data[:, x].clone()
+                conv_p.bias.data = conv.bias.data.clone()
+            p.anchors.data = m.anchors.data.clone()
+            p.stride = m.stride
+        else:
+            out, x = k
+            p = modules[m]
+            assert p.conv.weight.shape[:2] == (len(out), len(x)), f'{PREFIX}plan does not match the pruned yaml'
+            p.conv.weight.data = m.conv.weight.data[out][:, x].clone()
+            for a in 'weight', 'bias', 'running_mean', 'running_var':
+                getattr(p.bn, a).data = getattr(m.bn, a).data[out].clone()
+    for a in 'nc', 'names', 'hyp', 'class_weights':  # train.py model attributes
+        if hasattr(model, a):
+            setattr(pruned, a, getattr(model, a))
+    n0, n1 = (sum(x.numel() for x in m.parameters()) for m in (model, pruned))
+    LOGGER.info(f'{PREFIX}{ratio:.0%} of channels ranked below {plan.threshold:.3g}, '
+                f'parameters {n0} -> {n1} ({1 - n1 / n0:.1%} removed)')
+    return pruned
+
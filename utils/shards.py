@@ -0,0 +1,185 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Packed dataset shards
+
+A sharded dataset replaces the loose images/**/*.jpg and labels/**/*.txt pairs of a dataset directory with a handful
+of large binary shard files and a single JSON index. Every record holds the encoded image bytes and the YOLO label text
+of one image, and is addressed by its image path relative to the images/ directory (without suffix).
+
+Layout:
+    dataset/
+    └── shards/
+        ├── index.json        ← {'version', 'shards': [names], 'files': {key: [shard, im_offset, im_size, lb_offset, lb_size]}}
+        ├── shard_00000.bin   ← concatenated records
+        └── shard_00001.bin
+
+Usage:
+    from utils.shards import ShardWriter, ShardReader, open_shards
+    with ShardWriter('dataset') as w:
+        w.add('BJOR_01/img_0_0_640_640', jpg_bytes, 'label text')
+    reader = ShardReader('dataset')
+    im = reader.imread('dataset/images/BJOR_01/img_0_0_640_640.jpg')
+    reader = open_shards(*reader.stamp)  # same reader, cached per process
+"""
+
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+SHARD_DIR = 'shards'  # shard sub-directory of a dataset root
+SHARD_INDEX = 'index.json'  # shard index file name
+SHARD_VERSION = 1  # shard index version
+
+
+def shard_index_path(root):
+    # Return the shard index path for a dataset root directory
+    return Path(root) / SHARD_DIR / SHARD_INDEX
+
+
+def is_sharded(root):
+    # Is dataset root directory packed into shards?
+    return shard_index_path(root).is_file()
+
+
+def shard_key(path, root):
+    # Return the record key of an image or label path under dataset root, i.e. 'BJOR_01/img_0_0_640_640'
+    path, root = Path(path), Path(root)
+    for sub in 'images', 'labels':
+        try:
+            return path.relative_to(root / sub).with_suffix('').as_posix()
+        except ValueError:
+            continue
+    raise ValueError(f'{path} is not inside {root / "images"} or {root / "labels"}')
+
+
+class ShardWriter:
+    # Append image/label records to shard files, opening a new shard every shard_size bytes
+    def __init__(self, root, shard_size=1 << 30):
+        self.dir = Path(root) / SHARD_DIR
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.dir / SHARD_INDEX
+        self.shard_size = shard_size
+        if self.index_path.is_file():  # append to existing shards
+            with open(self.index_path) as f:
+                index = json.load(f)
+            assert index['version'] == SHARD_VERSION, f'Unsupported shard version {index["version"]} in {self.dir}'
+            self.shards, self.files = index['shards'], index['files']
+        else:
+            self.shards, self.files = [], {}
+        self.f = None  # current shard file handle
+        self.offset = 0  # current shard size in bytes
+
+    def _next_shard(self):
+        # Close the current shard and start a new one
+        if self.f:
+            self.f.close()
+        name = f'shard_{len(self.shards):05d}.bin'
+        self.shards.append(name)
+        self.f = open(self.dir / name, 'wb')
+        self.offset = 0
+
+    def add(self, key, im, label=''):
+        # Append one record, im is encoded image bytes, label is YOLO label text
+        lb = label.encode() if isinstance(label, str) else bytes(label)
+        if self.f is None or self.offset + len(im) + len(lb) > self.shard_size:
+            self._next_shard()
+        self.f.write(im)
+        self.f.write(lb)
+        self.files[key] = [len(self.shards) - 1, self.offset, len(im), self.offset + len(im), len(lb)]
+        self.offset += len(im) + len(lb)
+
+    def __contains__(self, key):
+        return key in self.files
+
+    def close(self):
+        # Flush the current shard and write the index
+        if self.f:
+            self.f.close()
+            self.f = None
+        tmp = self.index_path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'version': SHARD_VERSION, 'shards': self.shards, 'files': self.files}, f)
+        os.replace(tmp, self.index_path)  # atomic, readers never see a partial index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        self.close()
+
+
+@lru_cache(maxsize=8)
+def open_shards(root, mtime_ns=None, size=None):
+    # Return a ShardReader of dataset root that is opened once per process and index version (ShardReader.stamp), so
+    # multiprocessing tasks can pass the short stamp instead of pickling the full index with every task
+    return ShardReader(root)
+
+
+class ShardReader:
+    # Random access to shard records through read-only memory maps, safe to pickle into dataloader workers
+    def __init__(self, root):
+        self.root = Path(root)
+        self.index_path = shard_index_path(root)
+        st = os.stat(self.index_path)
+        self.stamp = str(self.root), st.st_mtime_ns, st.st_size  # identifies this index version, see open_shards()
+        with open(self.index_path) as f:
+            index = json.load(f)
+        assert index['version'] == SHARD_VERSION, f'Unsupported shard version {index["version"]} in {self.index_path}'
+        self.shards = [self.index_path.parent / x for x in index['shards']]
+        self.files = index['files']
+        self.maps = [None] * len(self.shards)  # opened lazily per process
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['maps'] = [None] * len(self.shards)  # memory maps are re-opened in the receiving process
+        return state
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, path):
+        return shard_key(path, self.root) in self.files
+
+    def im_files(self, suffix='.jpg'):
+        # Return the (virtual) image paths of all records
+        d = self.root / 'images'
+        return [str(d / f'{k}{suffix}') for k in self.files]
+
+    def hash_files(self):
+        # Return the on-disk files whose sizes identify this dataset version
+        return [str(self.index_path)] + [str(x) for x in self.shards]
+
+    def _map(self, i):
+        if self.maps[i] is None:
+            self.maps[i] = np.memmap(self.shards[i], dtype=np.uint8, mode='r')
+        return self.maps[i]
+
+    def _record(self, path):
+        key = shard_key(path, self.root)
+        if key not in self.files:
+            raise FileNotFoundError(f'{key} not found in {self.index_path}')
+        return self.files[key]
+
+    def record(self, path):
+        # Return the [shard, im_offset, im_size, lb_offset, lb_size] index entry of an image or label path
+        return self._record(path)
+
+    def image(self, path):
+        # Return the encoded image bytes of an image path as a uint8 array view
+        s, o, n, _, _ = self._record(path)
+        return self._map(s)[o:o + n]
+
+    def label(self, path):
+        # Return the YOLO label text of an image or label path, '' for background records, None if there is no record
+        if shard_key(path, self.root) not in self.files:
+            return None
+        s, _, _, o, n = self._record(path)
+        return bytes(self._map(s)[o:o + n]).decode() if n else ''
+
+    def imread(self, path, flags=None):
+        # cv2.imread() equivalent for shard records, returns BGR image or None
+        import cv2
+        return cv2.imdecode(np.asarray(self.image(path)), cv2.IMREAD_COLOR if flags is None else flags)
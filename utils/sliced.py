@@ -0,0 +1,297 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Sliced inference utils
+
+Full-resolution frames are cut into overlapping tiles with slicing.slicing.get_slice_bboxes(), like sahi does in
+production. Tiles of many frames are packed into full model batches, and tile detections are shifted back to frame
+coordinates and merged per frame by tensorized NMS, greedy non-maximum merging (NMM) or weighted box fusion (WBF).
+Merging can be made aware of boxes cut by inner tile borders, which are matched on the overlap strip both tiles saw.
+
+Usage:
+    from utils.sliced import create_sliced_dataloader, predict_tiles
+    loader, dataset = create_sliced_dataloader('../Processed/Reduced', 640, 32, overlap=0.1)
+    for tiles, slices, frames, targets, paths, shapes in loader:
+        preds = predict_tiles(model, tiles, slices, frames, len(paths), device, batch_size=32, merge='nmm', border=True)
+
+    from utils.sliced import predict_tiles, slice_frame  # single in-memory frames
+    tiles, slices = slice_frame(im, 640, overlap=0.1, bgr=False)  # RGB frame
+    det = predict_tiles(model, tiles, slices, torch.zeros(len(tiles), dtype=torch.long), 1, device, len(tiles))[0]
+"""
+
+import math
+import os
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+import torchvision
+from torch.utils.data import DataLoader
+
+from utils.dataloaders import LoadImagesAndLabels, seed_worker
+from utils.general import LOGGER, non_max_suppression
+
+MAX_WH = 7680  # (pixels) maximum box width and height, class offset for class-aware merging
+MERGE_METHODS = 'nms', 'nmm', 'wbf', 'none'  # tile detection merge strategies
+MERGE_METRICS = 'iou', 'ios'  # box match metrics, intersection over union or over the smaller box
+BORDER = 0.01  # box edges closer than this fraction of the tile size to an inner tile border are cut by the border
+
+
+def slice_boxes(h, w, tile_size=640, overlap=0.1):
+    # Return the (n,4) [x1, y1, x2, y2] tiles of a h x w frame, as used by sahi's get_sliced_prediction()
+    from slicing.slicing import get_slice_bboxes
+    s = tile_size
+    return np.array(get_slice_bboxes(h, w, s, s, False, overlap, overlap), dtype=np.int64).reshape(-1, 4)
+
+
+def slice_frame(im, tile_size=640, overlap=0.1, bgr=True):
+    # Cut a HWC uint8 frame into RGB tiles, returns uint8 tiles (n,3,s,s) padded right and bottom and slices (n,4)
+    boxes = slice_boxes(*im.shape[:2], tile_size, overlap)
+    tiles = np.full((len(boxes), tile_size, tile_size, 3), 114, dtype=np.uint8)
+    for t, (x1, y1, x2, y2) in zip(tiles, boxes):
+        t[:y2 - y1, :x2 - x1] = im[y1:y2, x1:x2]
+    tiles = tiles[..., ::-1] if bgr else tiles  # BGR to RGB
+    return torch.from_numpy(np.ascontiguousarray(tiles.transpose(0, 3, 1, 2))), torch.from_numpy(boxes)  # BCHW
+
+
+class LoadSlicedFrames(LoadImagesAndLabels):
+    # Full-resolution frames and their labels, every item holds all tiles of one frame
+    resize_on_load = False
+
+    def __init__(self, path, tile_size=640, batch_size=32, overlap=0.1, **kwargs):
+        super().__init__(path, img_size=tile_size, batch_size=batch_size, **kwargs)
+        self.tile_size = tile_size
+        self.overlap = overlap
+        shapes, i = np.unique(self.shapes, axis=0, return_inverse=True)  # frame shapes (w, h) may differ
+        self.tile_counts = np.array([len(self.tiles(h, w)) for w, h in shapes], dtype=np.int64)[i.reshape(-1)]
+
+    def tiles(self, h, w):
+        # Return the (n,4) [x1, y1, x2, y2] tiles of a h x w frame
+        return slice_boxes(h, w, self.tile_size, self.overlap)
+
+    def frame_batches(self, batch_size):
+        # Split the frames in order into batches that fill whole model batches of batch_size tiles where possible, a
+        # batch closes when its tiles are a multiple of batch_size or at the frames needed for that with every shape
+        k = self.tile_counts
+        frames = max((batch_size // math.gcd(int(x), batch_size) for x in np.unique(k)), default=1)  # max frames
+        batches, batch, n = [], [], 0
+        for i, x in enumerate(k.tolist()):
+            batch.append(i)
+            n += x
+            if n % batch_size == 0 or len(batch) == frames:
+                batches.append(batch)
+                batch, n = [], 0
+        return batches + [batch] if batch else batches
+
+    def __getitem__(self, index):
+        im, _, (h, w) = self.load_image(index)
+        tiles, boxes = slice_frame(im, self.tile_size, self.overlap)
+
+        labels = self.labels[index]
+        labels_out = torch.zeros((len(labels), 6))
+        labels_out[:, 1:] = torch.from_numpy(labels)  # normalized xywh in the frame
+        return tiles, boxes, labels_out, self.im_files[index], (h, w)
+
+    @staticmethod
+    def collate_fn(batch):
+        # Returns tiles (n,3,s,s), tile slices (n,4) xyxy in the frame, frame index of each tile (n,), targets, paths
+        # and frame shapes
+        tiles, slices, labels, paths, shapes = zip(*batch)
+        frames = torch.cat([torch.full((len(t),), i, dtype=torch.long) for i, t in enumerate(tiles)])
+        for i, lb in enumerate(labels):
+            lb[:, 0] = i  # add target frame index
+        return torch.cat(tiles, 0), torch.cat(slices, 0), frames, torch.cat(labels, 0), paths, shapes
+
+
+def create_sliced_dataloader(path, tile_size, batch_size, overlap=0.1, single_cls=False, workers=8, prefix=''):
+    # Dataloader of full frames of any shapes, loading as many frames per batch as fill whole model batches of
+    # batch_size tiles, i.e. the smallest frame count with a multiple of batch_size tiles if all frames have one shape
+    dataset = LoadSlicedFrames(path, tile_size, batch_size, overlap=overlap, single_cls=single_cls, prefix=prefix)
+    batches = dataset.frame_batches(batch_size)
+    frames = max(len(b) for b in batches)
+    nw = min([os.cpu_count(), frames if frames > 1 else 0, workers])  # number of workers
+    k, shapes = dataset.tile_counts, np.unique(dataset.shapes, axis=0)  # tiles per frame, frame shapes (w, h)
+    s = f'{k[0]} tiles of {tile_size}x{tile_size} per {shapes[0][0]}x{shapes[0][1]} frame' if len(shapes) == 1 else \
+        f'{k.min()}-{k.max()} tiles of {tile_size}x{tile_size} per frame, {len(shapes)} frame shapes'
+    LOGGER.info(f'{prefix}{s}, up to {frames} frames per batch')
+    generator = torch.Generator()
+    generator.manual_seed(6148914691236517205)
+    loader = DataLoader(dataset,
+                        batch_sampler=batches,
+                        num_workers=nw,
+                        pin_memory=True,
+                        collate_fn=LoadSlicedFrames.collate_fn,
+                        worker_init_fn=seed_worker,
+                        generator=generator)
+    return loader, dataset
+
+
+def box_overlap(box1, box2, metric='iou', eps=1e-7, pairwise=False):
+    # Intersection over union, or over the smaller area (sahi's IOS), of (n,4) and (m,4) xyxy boxes, returns (n,m), or
+    # (n,) of the pairs box1[i], box2[i] if pairwise
+    (ax1, ay1, ax2, ay2), (bx1, by1, bx2, by2) = (box1.unbind(1), box2.unbind(1)) if pairwise else \
+        (box1[:, :, None].unbind(1), box2.T[:, None].unbind(0))
+    inter = (torch.min(ax2, bx2) - torch.max(ax1, bx1)).clamp_(0) * \
+        (torch.min(ay2, by2) - torch.max(ay1, by1)).clamp_(0)
+    area1, area2 = (ax2 - ax1) * (ay2 - ay1), (bx2 - bx1) * (by2 - by1)
+    return inter / ((area1 + area2 - inter) if metric == 'iou' else torch.min(area1, area2)).add_(eps)
+
+
+def cut_boxes(boxes, slices):
+    # Return the (n,) mask of boxes (n,4) with an edge at an inner border of their tile slice (n,4), cut by the tile
+    w, h = slices[:, 2].max(), slices[:, 3].max()  # frame size, slices cover the frame
+    inner = torch.stack((slices[:, 0] > 0, slices[:, 1] > 0, slices[:, 2] < w, slices[:, 3] < h), 1)
+    d = torch.cat((boxes[:, :2] - slices[:, :2], slices[:, 2:] - boxes[:, 2:]), 1)  # box edge to slice edge distance
+    return ((d < BORDER * (slices[:, 2:3] - slices[:, 0:1])) & inner).any(1)
+
+
+def border_match(boxes, slices, cut, iou_thres=0.5, eps=1e-7):
+    # Match cut boxes to the boxes of other tiles by the IoU of both boxes clipped to the overlap of their slices, two
+    # partial views of one object agree on the strip both tiles saw. Returns the symmetric (n,n) match matrix
+    n, cut = len(boxes), cut.nonzero()[:, 0]
+    match = torch.zeros((n, n), dtype=torch.bool, device=boxes.device)
+    if len(cut):
+        r1 = torch.max(slices[cut, None, :2], slices[None, :, :2])  # slice overlap x1y1 (cut,n,2)
+        r2 = torch.min(slices[cut, None, 2:], slices[None, :, 2:])  # slice overlap x2y2
+        a1, a2 = boxes[cut, None, :2].maximum(r1), boxes[cut, None, 2:].minimum(r2)  # cut boxes clipped to overlap
+        b1, b2 = boxes[None, :, :2].maximum(r1), boxes[None, :, 2:].minimum(r2)  # other boxes clipped to overlap
+        inter = (torch.min(a2, b2) - torch.max(a1, b1)).clamp(0).prod(2)
+        union = (a2 - a1).clamp(0).prod(2) + (b2 - b1).clamp(0).prod(2) - inter
+        other = (slices[cut, None] != slices[None]).any(2)  # boxes of other tiles
+        match[cut] = (inter / (union + eps) > iou_thres) & other
+    return match | match.T
+
+
+def greedy_keep(match):
+    # Greedy NMS on a (n,n) boolean match matrix of boxes sorted by decreasing confidence, returns the (n,) keep mask.
+    # Cluster-NMS iterations converge to the exact sequential result, https://arxiv.org/abs/2005.03572
+    match = match.triu(1)
+    keep = torch.ones(len(match), dtype=torch.bool, device=match.device)
+    while True:
+        k = ~(match & keep[:, None]).any(0)  # not suppressed by a kept box
+        if torch.equal(k, keep):
+            return keep
+        keep = k
+
+
+def greedy_union(boxes, owner, conf, iou_thres=0.5, metric='iou'):
+    # Grow every kept box (owner == index) to the union of the boxes it suppressed, one box at a time by decreasing
+    # confidence and only while the grown box still matches, like sahi's greedy NMM merge. Boxes that matched their
+    # owner by the border rule only are always merged. Returns the (n,4) boxes, grown at the kept indices
+    j = (owner != torch.arange(len(owner), device=owner.device)).nonzero()[:, 0]  # merged boxes
+    j = j[conf[j].argsort(descending=True, stable=True)]
+    j = j[owner[j].argsort(stable=True)]  # by owner, then by decreasing confidence
+    n = torch.bincount(owner[j], minlength=len(owner))
+    rank = torch.arange(len(j), device=j.device) - (n.cumsum(0) - n)[owner[j]]  # merge step per owner
+    merged = boxes.clone()
+    for r in range(int(rank.max()) + 1 if len(j) else 0):
+        k = j[rank == r]  # at most one box per owner
+        o, b = owner[k], boxes[k]
+        ok = (box_overlap(merged[o], b, metric, pairwise=True) > iou_thres) | \
+            (box_overlap(boxes[o], b, metric, pairwise=True) <= iou_thres)  # still matches, or a border match
+        o, b = o[ok], b[ok]
+        merged[o] = torch.cat((torch.min(merged[o, :2], b[:, :2]), torch.max(merged[o, 2:], b[:, 2:])), 1)
+    return merged
+
+
+def merge_detections(det, method='nms', iou_thres=0.5, agnostic=False, metric='iou', slices=None):
+    # Merge the detections (n,6) [xyxy, conf, cls] of overlapping tiles of one frame, match at IoU or IOS > iou_thres
+    #   nms: keep the highest confidence box of every overlapping group
+    #   nmm: greedy non-maximum merging, kept boxes grow to the union of the boxes they suppress while these still
+    #        match the grown box, as sahi's GreedyNMMPostprocess
+    #   wbf: weighted box fusion, kept boxes move to the confidence-weighted mean of the boxes they suppress
+    # With the tile slices (n,4) of the detections, boxes cut by inner tile borders also match on the tile overlap
+    if method == 'none' or len(det) < 2:
+        return det
+    if method not in MERGE_METHODS or metric not in MERGE_METRICS:
+        raise ValueError(f'Unknown merge {method} {metric}, use one of {MERGE_METHODS} and {MERGE_METRICS}')
+    if metric == 'iou' and slices is None:  # torchvision NMS, matches of kept boxes only
+        c = det[:, 5:6] * (0 if agnostic else MAX_WH)  # classes
+        i = torchvision.ops.nms(det[:, :4] + c, det[:, 4], iou_thres)  # kept, by decreasing confidence
+        if method == 'nms':
+            return det[i]
+        boxes, cut = det[:, :4], torch.zeros_like(det[:, 4], dtype=torch.bool)
+        owner = torch.arange(len(det), device=det.device)
+        j = torch.ones_like(cut).index_fill_(0, i, False).nonzero()[:, 0]  # suppressed
+        if len(j):  # the first kept box a suppressed box matches suppressed it
+            owner[j] = i[(box_overlap(boxes[i] + c[i], boxes[j] + c[j]) > iou_thres).byte().argmax(0)]
+    else:  # greedy matching per class on the match matrix
+        cut = torch.zeros_like(det[:, 4], dtype=torch.bool) if slices is None else cut_boxes(det[:, :4], slices.to(det))
+        order = (det[:, 4] - 2 * cut).argsort(descending=True)  # by confidence, boxes cut by tile borders last
+        if not agnostic:
+            order = order[det[order, 5].argsort(stable=True)]  # by class
+        det, boxes, cut = det[order], det[order, :4], cut[order]
+        n = [len(det)] if agnostic else torch.unique_consecutive(det[:, 5], return_counts=True)[1].tolist()
+        i, owner = [], []
+        for j0, j1 in zip(np.cumsum([0] + n[:-1]).tolist(), np.cumsum(n).tolist()):  # class blocks
+            m = box_overlap(boxes[j0:j1], boxes[j0:j1], metric) > iou_thres
+            if slices is not None:
+                m |= border_match(boxes[j0:j1], slices[order[j0:j1]].to(boxes), cut[j0:j1], iou_thres)
+            k = greedy_keep(m).nonzero()[:, 0]  # kept, whole boxes and by decreasing confidence first
+            m = m[k]
+            m[torch.arange(len(k), device=m.device), k] = True
+            i.append(k + j0)
+            owner.append(k[m.byte().argmax(0)] + j0)  # the first kept box a box matches suppressed it
+        i = torch.cat(i)
+        if method == 'nms':
+            return det[i]
+        owner = torch.cat(owner)
+
+    # Merge every box into the kept box that suppressed it, its owner
+    merged = det.clone()
+    if method == 'nmm':  # union
+        merged[:, :4] = greedy_union(boxes, owner, det[:, 4], iou_thres, metric)
+    else:  # confidence-weighted mean, cut boxes barely move whole boxes
+        w = det[:, 4:5] * (1 - 0.999 * cut[:, None])
+        merged[:, :4] = torch.zeros_like(boxes).index_add_(0, owner, boxes * w) / \
+            torch.zeros_like(w).index_add_(0, owner, w)
+    return merged[i]
+
+
+def predict_tiles(model,
+                  tiles,
+                  slices,
+                  frames,
+                  nf,
+                  device,
+                  batch_size=32,
+                  conf_thres=0.001,
+                  iou_thres=0.6,
+                  max_det=300,
+                  merge='nms',
+                  merge_thres=0.5,
+                  agnostic=False,
+                  half=False,
+                  metric='iou',
+                  border=False,
+                  static=False,
+                  dt=(nullcontext(), nullcontext(), nullcontext())):
+    # Detect on uint8 tiles (n,3,s,s) at slices (n,4) in model batches, returns the merged (n,6) [xyxy, conf, cls]
+    # detections of each of the nf frames in frame pixels. border merges boxes cut by tile borders, static pads the
+    # last batch to batch_size for fixed-shape exports, dt are optional (pre-process, inference, NMS) Profile()s
+    dets = []
+    for x in tiles.split(batch_size):
+        with dt[0]:
+            n = len(x)
+            x = x.to(device, non_blocking=True)
+            x = (x.half() if half else x.float()) / 255  # uint8 to fp16/32, 0 - 255 to 0.0 - 1.0
+            if static and n < batch_size:
+                x = torch.cat((x, x.new_zeros((batch_size - n, *x.shape[1:]))), 0)
+        with dt[1]:
+            pred = model(x)
+        with dt[2]:
+            dets += non_max_suppression(pred, conf_thres, iou_thres, agnostic=agnostic, multi_label=True,
+                                        max_det=max_det)[:n]
+
+    with dt[2]:
+        tile = torch.repeat_interleave(torch.arange(len(dets), device=device),
+                                       torch.tensor([len(d) for d in dets], device=device))  # tile of each detection
+        det = torch.cat(dets, 0)
+        slices = slices.to(device)[tile].float()
+        det[:, :4] += slices[:, :2].repeat(1, 2)  # tile to frame pixels
+        frame = frames.to(device)[tile]
+        out = []
+        for f in range(nf):
+            i = frame == f
+            d = merge_detections(det[i], merge, merge_thres, agnostic, metric, slices[i] if border else None)
+            out.append(d[d[:, 4].argsort(descending=True)[:max_det]])
+    return out
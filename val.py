@@ -41,8 +41,9 @@ from utils.dataloaders import create_dataloader
 from utils.general import (LOGGER, Profile, check_dataset, check_img_size, check_requirements, check_yaml,
                            coco80_to_coco91_class, colorstr, increment_path, non_max_suppression, print_args,
                            scale_boxes, xywh2xyxy, xyxy2xywh)
-from utils.metrics import ConfusionMatrix, ap_per_class, box_iou
+from utils.metrics import ConfusionMatrix, MetricAccumulator, box_iou
 from utils.plots import output_to_target, plot_images, plot_val_study
+from utils.sliced import MERGE_METHODS, MERGE_METRICS, create_sliced_dataloader, predict_tiles
 from utils.torch_utils import select_device, smart_inference_mode
 
 
@@ -69,6 +70,26 @@ def save_one_json(predn, jdict, path, class_map):
             'score': round(p[4], 5)})
 
 
+def save_matches_npz(matches, iouv, names, file):
+    # Save the [predn, correct, tcls, path] predictions, matches and labels of all images to a compressed *.npz for
+    # tune_thresholds.py. Correct (n,niou) matrices are bit-packed, predictions and labels keep their image index
+    predn, correct, tcls, files = zip(*matches) if matches else ([np.zeros((0, 6))], [np.zeros((0, len(iouv)))], [], [])
+    image = np.repeat(np.arange(len(files)), [len(x) for x in predn]).astype(np.int32)
+    timage = np.repeat(np.arange(len(files)), [len(x) for x in tcls]).astype(np.int32)
+    predn = np.concatenate(predn, 0)
+    np.savez_compressed(file,
+                        boxes=predn[:, :4].astype(np.float32),
+                        conf=predn[:, 4].astype(np.float32),
+                        cls=predn[:, 5].astype(np.int16),
+                        correct=np.packbits(np.concatenate(correct, 0).astype(bool), axis=1),
+                        image=image,
+                        tcls=np.concatenate(tcls or [np.zeros(0)]).astype(np.int16),
+                        timage=timage,
+                        iouv=iouv.cpu().numpy(),
+                        files=np.array([str(f) for f in files]),
+                        names=np.array([names[i] for i in sorted(names)]))
+
+
 def process_batch(detections, labels, iouv):
     """
     Return correct prediction matrix
@@ -124,6 +145,13 @@ def run(
         plots=True,
         callbacks=Callbacks(),
         compute_loss=None,
+        save_matches=False,  # save predictions and their matches to matches.npz
+        sliced=False,  # evaluate sliced inference on full frames of the task dataset, or of this frames directory
+        overlap=0.1,  # sliced tile overlap ratio
+        merge='nms',  # sliced tile detection merge method, nms, nmm, wbf or none
+        merge_thres=0.5,  # sliced tile detection merge match threshold
+        merge_metric='iou',  # sliced tile detection merge match metric, iou or ios
+        merge_border=False,  # sliced merge of boxes cut by tile borders on the tile overlap
 ):
     # Initialize/load model and set device
     training = model is not None
@@ -148,8 +176,9 @@ def run(
         else:
             device = model.device
             if not (pt or jit):
-                batch_size = 1  # export.py models default to batch-size 1
-                LOGGER.info(f'Forcing --batch-size 1 square inference (1,3,{imgsz},{imgsz}) for non-PyTorch models')
+                batch_size = getattr(model, 'batch_size', 1)  # static batch of ONNX and OpenVINO exports, else 1
+                LOGGER.info(f'Forcing --batch-size {batch_size} square inference ({batch_size},3,{imgsz},{imgsz}) '
+                            f'for non-PyTorch models')
 
         # Data
         data = check_dataset(data)  # check
@@ -171,15 +200,24 @@ def run(
         model.warmup(imgsz=(1 if pt else batch_size, 3, imgsz, imgsz))  # warmup
         pad, rect = (0.0, False) if task == 'speed' else (0.5, pt)  # square inference for benchmarks
         task = task if task in ('train', 'val', 'test') else 'val'  # path to train/val/test images
-        dataloader = create_dataloader(data[task],
-                                       imgsz,
-                                       batch_size,
-                                       stride,
-                                       single_cls,
-                                       pad=pad,
-                                       rect=rect,
-                                       workers=workers,
-                                       prefix=colorstr(f'{task}: '))[0]
+        if sliced:  # full frames, cut into imgsz tiles
+            dataloader = create_sliced_dataloader(sliced if isinstance(sliced, str) else data[task],
+                                                  imgsz,
+                                                  batch_size,
+                                                  overlap=overlap,
+                                                  single_cls=single_cls,
+                                                  workers=workers,
+                                                  prefix=colorstr(f'{task}: '))[0]
+        else:
+            dataloader = create_dataloader(data[task],
+                                           imgsz,
+                                           batch_size,
+                                           stride,
+                                           single_cls,
+                                           pad=pad,
+                                           rect=rect,
+                                           workers=workers,
+                                           prefix=colorstr(f'{task}: '))[0]
 
     seen = 0
     confusion_matrix = ConfusionMatrix(nc=nc)
@@ -191,43 +229,57 @@ def run(
     tp, fp, p, r, f1, mp, mr, map50, ap50, map = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
     dt = Profile(), Profile(), Profile()  # profiling times
     loss = torch.zeros(3, device=device)
-    jdict, stats, ap, ap_class = [], [], [], []
+    jdict, ap, ap_class = [], [], []
+    metrics = MetricAccumulator(nc, niou, device=device)  # streaming (correct, conf, pcls, tcls) stats
+    matches = []  # [predn, correct, tcls, path] of every image if save_matches
     callbacks.run('on_val_start')
     pbar = tqdm(dataloader, desc=s, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}')  # progress bar
-    for batch_i, (im, targets, paths, ind) in enumerate(pbar):
-        
-        # print("im:", im, "\ntargets:", targets, "\npaths:", paths, "\nshapes:", shapes)
-        
-        shapes = [[None, None] for i in ind]
-        
+    for batch_i, batch in enumerate(pbar):
         callbacks.run('on_val_batch_start')
-        with dt[0]:
-            if cuda:
-                im = im.to(device, non_blocking=True)
-                targets = targets.to(device)
-            im = im.half() if half else im.float()  # uint8 to fp16/32
-            im /= 255  # 0 - 255 to 0.0 - 1.0
-            nb, _, height, width = im.shape  # batch size, channels, height, width
-
-        # Inference
-        with dt[1]:
-            preds, train_out = model(im) if compute_loss else (model(im, augment=augment), None)
-
-        # Loss
-        if compute_loss:
-            loss += compute_loss(train_out, targets, ind)[1]  # box, obj, cls
-
-        # NMS
-        targets[:, 2:] *= torch.tensor((width, height, width, height), device=device)  # to pixels
-        lb = [targets[targets[:, 0] == i, 1:] for i in range(nb)] if save_hybrid else []  # for autolabelling
-        with dt[2]:
-            preds = non_max_suppression(preds,
-                                        conf_thres,
-                                        iou_thres,
-                                        labels=lb,
-                                        multi_label=True,
-                                        agnostic=single_cls,
-                                        max_det=max_det)
+        if sliced:
+            # Inference on tiles and merge per frame, targets to frame pixels
+            tiles, slices, frames, targets, paths, shapes = batch
+            preds = predict_tiles(model, tiles, slices, frames, len(paths), device, batch_size, conf_thres, iou_thres,
+                                  max_det, merge, merge_thres, single_cls, half, merge_metric, merge_border,
+                                  static=not (training or pt or jit), dt=dt)
+            im, nb = None, len(paths)
+            targets = targets.to(device)
+            whwh = torch.tensor(shapes, device=device, dtype=torch.float32)[:, [1, 0, 1, 0]]  # frame whwh
+            targets[:, 2:] *= whwh[targets[:, 0].long()]  # to pixels
+            shapes = [[None, None] for _ in paths]
+        else:
+            im, targets, paths, ind = batch
+            shapes = [[None, None] for i in ind]
+            preds = None
+
+        if preds is None:
+            with dt[0]:
+                if cuda:
+                    im = im.to(device, non_blocking=True)
+                    targets = targets.to(device)
+                im = im.half() if half else im.float()  # uint8 to fp16/32
+                im /= 255  # 0 - 255 to 0.0 - 1.0
+                nb, _, height, width = im.shape  # batch size, channels, height, width
+
+            # Inference
+            with dt[1]:
+                preds, train_out = model(im) if compute_loss else (model(im, augment=augment), None)
+
+            # Loss
+            if compute_loss:
+                loss += compute_loss(train_out, targets, ind)[1]  # box, obj, cls
+
+            # NMS
+            targets[:, 2:] *= torch.tensor((width, height, width, height), device=device)  # to pixels
+            lb = [targets[targets[:, 0] == i, 1:] for i in range(nb)] if save_hybrid else []  # for autolabelling
+            with dt[2]:
+                preds = non_max_suppression(preds,
+                                            conf_thres,
+                                            iou_thres,
+                                            labels=lb,
+                                            multi_label=True,
+                                            agnostic=single_cls,
+                                            max_det=max_det)
 
         # Metrics
         for si, pred in enumerate(preds):
@@ -239,9 +291,11 @@ def run(
 
             if npr == 0:
                 if nl:
-                    stats.append((correct, *torch.zeros((2, 0), device=device), labels[:, 0]))
+                    metrics.update(correct, *torch.zeros((2, 0), device=device), labels[:, 0])
                     if plots:
                         confusion_matrix.process_batch(detections=None, labels=labels[:, 0])
+                if save_matches:
+                    matches.append([x.cpu().numpy() for x in (pred, correct, labels[:, 0])] + [path])
                 continue
 
             # Predictions
@@ -260,29 +314,30 @@ def run(
                 correct = process_batch(predn, labelsn, iouv)
                 if plots:
                     confusion_matrix.process_batch(predn, labelsn)
-            stats.append((correct, pred[:, 4], pred[:, 5], labels[:, 0]))  # (correct, conf, pcls, tcls)
+            metrics.update(correct, pred[:, 4], pred[:, 5], labels[:, 0])  # (correct, conf, pcls, tcls)
 
             # Save/log
             if save_txt:
                 save_one_txt(predn, save_conf, shape, file=save_dir / 'labels' / f'{path.stem}.txt')
             if save_json:
                 save_one_json(predn, jdict, path, class_map)  # append to COCO-JSON dictionary
-            callbacks.run('on_val_image_end', pred, predn, path, names, im[si])
+            if save_matches:
+                matches.append([x.cpu().numpy() for x in (predn, correct, labels[:, 0])] + [path])
+            callbacks.run('on_val_image_end', pred, predn, path, names, im[si] if im is not None else None)
 
         # Plot images
-        if plots and batch_i < 3:
+        if plots and batch_i < 3 and im is not None:
             plot_images(im, targets, paths, save_dir / f'val_batch{batch_i}_labels.jpg', names)  # labels
             plot_images(im, output_to_target(preds), paths, save_dir / f'val_batch{batch_i}_pred.jpg', names)  # pred
 
         callbacks.run('on_val_batch_end', batch_i, im, targets, paths, shapes, preds)
 
     # Compute metrics
-    stats = [torch.cat(x, 0).cpu().numpy() for x in zip(*stats)]  # to numpy
-    if len(stats) and stats[0].any():
-        tp, fp, p, r, f1, ap, ap_class = ap_per_class(*stats, plot=plots, save_dir=save_dir, names=names)
+    if metrics.tp.any():
+        tp, fp, p, r, f1, ap, ap_class = metrics.compute(plot=plots, save_dir=save_dir, names=names)
         ap50, ap = ap[:, 0], ap.mean(1)  # AP@0.5, AP@0.5:0.95
         mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
-    nt = np.bincount(stats[3].astype(int), minlength=nc)  # number of targets per class
+    nt = metrics.nt.cpu().numpy()  # number of targets per class
 
     # Print results
     pf = '%22s' + '%11i' * 2 + '%11.3g' * 4  # print format
@@ -291,7 +346,7 @@ def run(
         LOGGER.warning(f'WARNING ⚠️ no labels found in {task} set, can not compute metrics without labels')
 
     # Print results per class
-    if (verbose or (nc < 50 and not training)) and nc > 1 and len(stats):
+    if (verbose or (nc < 50 and not training)) and nc > 1 and len(ap_class):
         for i, c in enumerate(ap_class):
             LOGGER.info(pf % (names[c], seen, nt[c], p[i], r[i], ap50[i], ap[i]))
     
@@ -299,13 +354,19 @@ def run(
     t = tuple(x.t / seen * 1E3 for x in dt)  # speeds per image
     if not training:
         shape = (batch_size, 3, imgsz, imgsz)
-        LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {shape}' % t)
+        per = 'frame' if sliced else 'image'
+        LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per {per} at shape {shape}' % t)
     
     # Plots
     if plots:
         confusion_matrix.plot(save_dir=save_dir, names=list(names.values()))
         callbacks.run('on_val_end', nt, tp, fp, p, r, f1, ap, ap50, ap_class, confusion_matrix)
 
+    # Save matches
+    if save_matches and not training:
+        save_matches_npz(matches, iouv, names, save_dir / 'matches.npz')
+        LOGGER.info(f"Predictions and matches saved to {save_dir / 'matches.npz'}, tune with tune_thresholds.py")
+
     # Save JSON
     if save_json and len(jdict):
         w = Path(weights[0] if isinstance(weights, list) else weights).stem if weights is not None else ''  # weights
@@ -377,6 +438,13 @@ def parse_opt():
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
+    parser.add_argument('--save-matches', action='store_true', help='save predictions and matches to matches.npz')
+    parser.add_argument('--sliced', nargs='?', const=True, default=False, help='sliced inference on full frames dir')
+    parser.add_argument('--overlap', type=float, default=0.1, help='--sliced tile overlap ratio')
+    parser.add_argument('--merge', default='nms', choices=MERGE_METHODS, help='--sliced tile detection merge method')
+    parser.add_argument('--merge-thres', type=float, default=0.5, help='--sliced tile detection merge match threshold')
+    parser.add_argument('--merge-metric', default='iou', choices=MERGE_METRICS, help='--sliced merge match metric')
+    parser.add_argument('--merge-border', action='store_true', help='--sliced merge boxes cut by tile borders')
     opt = parser.parse_args()
     opt.data = check_yaml(opt.data)  # check YAML
     opt.save_json |= opt.data.endswith('coco.yaml')